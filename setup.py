@@ -49,7 +49,8 @@ setup(
     zip_safe=False,
 
     # what packages/distributions (python) need to be installed when this one is. (Roughly what is imported in source code)
-    install_requires=['attrs', 'tqdm', 'click', 'sklearn', 'mutagen', 'PyInquirer', 'youtube_dl', 'pyreadline', 'lxml'],
+    python_requires='>=3.7',
+    install_requires=['attrs', 'numpy', 'tqdm', 'click', 'sklearn', 'mutagen', 'PyInquirer', 'youtube_dl', 'pyreadline', 'lxml'],
 
     # A string or list of strings specifying what other distributions need to be present in order for the setup script to run.
     # (Note: projects listed in setup_requires will NOT be automatically installed on the system where the setup script is being run.
@@ -74,11 +75,8 @@ setup(
         'Natural Language :: English',
         'Operating System :: Microsoft :: Windows',
         'Operating System :: POSIX :: Linux',
-        'Programming Language :: Python :: 2',
-        'Programming Language :: Python :: 2.7',
         'Programming Language :: Python :: 3',
-        'Programming Language :: Python :: 3.5',
-        'Programming Language :: Python :: 3.6',
+        'Programming Language :: Python :: 3 :: Only',
         'Programming Language :: Python :: 3.7',
         'Topic :: Home Automation',
         'Topic :: Multimedia :: Video :: Conversion',
@@ -100,6 +98,10 @@ setup(
     entry_points={
         'console_scripts': [
             'create-album = music_album_creation.create_album:main',
+            'retag-library = music_album_creation.music_library:main',
+            'index-library = music_album_creation.library_index:main',
+            'create-album-batch = music_album_creation.batch:main',
+            'album-daemon = music_album_creation.daemon:main',
         ]
     },
     # A dictionary mapping names of "extras" (optional features of your project: eg imports that a console_script uses) to strings or lists of strings
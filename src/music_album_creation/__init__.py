@@ -1,16 +1,38 @@
 __version__ = '1.3.2'
 
-import logging.config
+import logging
+from importlib import import_module
 from os import path
 
-from .audio_segmentation import AudioSegmenter
-from .format_classification import FormatClassifier
-from .metadata import MetadataDealer
-from .tracks_parsing import StringParser
+logger = logging.getLogger(__name__)
 
-logging.config.fileConfig(path.join(path.dirname(path.realpath(__file__)), 'logging.ini'), disable_existing_loggers=False)
+# the public classes get imported from their modules on first access (PEP 562), so that importing the package (ie to run
+# one of its commands) does not pay for dependencies (sklearn, mutagen, numpy) the command at hand may not need
+_lazy_exports = {
+    'StringParser': '.tracks_parsing',
+    'MetadataDealer': '.metadata',
+    'FormatClassifier': '.format_classification',
+    'AudioSegmenter': '.audio_segmentation',
+}
 
-logger = logging.getLogger(__name__)
+
+def __getattr__(name):
+    if name not in _lazy_exports:
+        raise AttributeError("module '{}' has no attribute '{}'".format(__name__, name))
+    value = getattr(import_module(_lazy_exports[name], __name__), name)
+    globals()[name] = value  # so that this function is not called again for the name
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_lazy_exports))
+
+
+def configure_logging():
+    """Configures logging as defined in the package's logging.ini, which also logs to a 'file.log' in the current directory.
+    Called by the entry points (ie console scripts) only, so that importing the package has no side effects."""
+    import logging.config
+    logging.config.fileConfig(path.join(path.dirname(path.realpath(__file__)), 'logging.ini'), disable_existing_loggers=False)
 
 
-__all__ = ['StringParser', 'MetadataDealer', 'FormatClassifier', 'AudioSegmenter']
+__all__ = ['StringParser', 'MetadataDealer', 'FormatClassifier', 'AudioSegmenter', 'configure_logging']
@@ -0,0 +1,9 @@
+from .decoding import DecodingError, decode, decode_raw
+from .fingerprinting import (Duplicate, Fingerprint, Fingerprinter,
+                             find_duplicates, fingerprint_files)
+from .loudness import (AlbumLoudness, LoudnessMeter, TrackLoudness,
+                       analyze_album, write_replaygain)
+from .pcm_cache import DecodedAudio, PcmCache
+
+__all__ = ['decode', 'decode_raw', 'DecodingError', 'PcmCache', 'DecodedAudio', 'Fingerprint', 'Fingerprinter', 'Duplicate', 'fingerprint_files', 'find_duplicates',
+           'LoudnessMeter', 'TrackLoudness', 'AlbumLoudness', 'analyze_album', 'write_replaygain']
@@ -0,0 +1,66 @@
+import logging
+import subprocess
+import tempfile
+
+import numpy as np
+
+from .. import profiling
+
+logger = logging.getLogger(__name__)
+
+
+def decode(audio_file, sample_rate=None, channels=1, chunk_frames=65536):
+    """
+    Decodes an audio file with ffmpeg into raw PCM, streaming it from ffmpeg's standard output; so that memory stays bounded
+    regardless of the length of the audio.\n
+    :param str audio_file:
+    :param int sample_rate: the sample rate to resample to; None to keep the file's one
+    :param int channels: the number of channels to down (or up) mix to
+    :param int chunk_frames: number of frames (samples per channel) in each yielded chunk
+    :return: chunks of samples, as float32 arrays in [-1, 1] of shape (frames,) if mono, or (frames, channels) otherwise
+    :rtype: generator
+    """
+    for data in decode_raw(audio_file, sample_rate=sample_rate, channels=channels, chunk_frames=chunk_frames):
+        samples = np.frombuffer(data, dtype='<i2').astype(np.float32) / 32768.0
+        yield samples if channels == 1 else samples.reshape(-1, channels)
+
+
+def decode_raw(audio_file, sample_rate=None, channels=1, chunk_frames=65536):
+    """
+    Like decode, but yields the raw PCM; 16 bit signed little endian samples, interleaved by channel, in whole frames.\n
+    :rtype: generator of bytes
+    """
+    args = ['ffmpeg', '-v', 'error', '-nostdin', '-i', audio_file, '-f', 's16le', '-acodec', 'pcm_s16le', '-ac', str(channels)] + \
+           (['-ar', str(sample_rate)] if sample_rate else []) + ['-']
+    logger.debug("Decoding: '{}'".format(' '.join(args)))
+    frame_bytes = 2 * channels
+    with tempfile.TemporaryFile() as stderr:  # a file, so that a chatty ffmpeg can never block on a full pipe
+        try:
+            process = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=stderr, stdin=subprocess.DEVNULL)
+        except OSError as e:
+            raise DecodingError("Could not run ffmpeg to decode '{}': {}".format(audio_file, e))
+        profiling.count_subprocess(args)
+        try:
+            remainder = b''
+            while True:
+                data = process.stdout.read(chunk_frames * frame_bytes)
+                if not data:
+                    break
+                data = remainder + data
+                usable = len(data) - len(data) % frame_bytes
+                remainder = data[usable:]
+                if usable:
+                    profiling.count('bytes_decoded', usable)
+                    yield data[:usable]
+            returncode = process.wait()
+        finally:  # ie the consumer stopped iterating early
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+            process.stdout.close()
+        if returncode != 0:
+            stderr.seek(0)
+            raise DecodingError("Command '{}' failed with exit code {}: {}".format(' '.join(args), returncode, stderr.read().decode('utf-8', 'replace').strip()))
+
+
+class DecodingError(Exception): pass
@@ -0,0 +1,197 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import attr
+import numpy as np
+
+from .decoding import DecodingError, decode
+
+logger = logging.getLogger(__name__)
+
+# number of bits set in each byte value
+_POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+@attr.s
+class Fingerprint(object):
+    """
+    A compact spectral fingerprint of a piece of audio: a 32 bit hash per (overlapping) frame, where each bit tells whether a
+    frequency band has more energy than the next one. Such bits survive re-encoding, resampling and volume changes, so that
+    two uploads of the same track have (almost) the same hashes.\n
+    :param numpy.ndarray hashes: uint32 hashes, one per frame
+    :param float frame_rate: hashes per second of audio
+    """
+    hashes = attr.ib(init=True, converter=lambda x: np.asarray(x, dtype=np.uint32))
+    frame_rate = attr.ib(init=True, converter=float)
+
+    @property
+    def duration(self):
+        """The (approximate) duration, in seconds, of the fingerprinted audio"""
+        return len(self.hashes) / self.frame_rate
+
+    def to_bytes(self):
+        return self.hashes.astype('<u4').tobytes()
+
+    @classmethod
+    def from_bytes(cls, data, frame_rate):
+        return Fingerprint(np.frombuffer(data, dtype='<u4'), frame_rate)
+
+    def bit_error_rate(self, other, max_shift=5.0, min_overlap=0.5):
+        """
+        The fraction of bits that differ between the two fingerprints, at their best alignment; ie 0 for identical audio and
+        about 0.5 for unrelated audio. Alignments shifting one fingerprint against the other by up to 'max_shift' seconds are
+        tried, so that tracks cut slightly differently still match.\n
+        :param Fingerprint other:
+        :param float max_shift: maximum shift in seconds
+        :param float min_overlap: the minimum fraction of the shorter fingerprint that an alignment has to overlap
+        :return: the bit error rate; 1 if no alignment overlaps enough or the fingerprints have different frame rates
+        :rtype: float
+        """
+        a, b = self.hashes, other.hashes
+        shortest = min(len(a), len(b))
+        if not shortest or abs(self.frame_rate - other.frame_rate) > 1e-6:
+            return 1.0
+        best = 1.0
+        max_frames = int(round(max_shift * self.frame_rate))
+        for shift in range(-max_frames, max_frames + 1):
+            x, y = (a[shift:], b) if 0 <= shift else (a, b[-shift:])
+            n = min(len(x), len(y))
+            if n < min_overlap * shortest:
+                continue
+            errors = int(_POPCOUNT[np.bitwise_xor(x[:n], y[:n]).view(np.uint8)].sum(dtype=np.int64))
+            best = min(best, errors / (32.0 * n))
+        return best
+
+    def matches(self, other, threshold=0.35, max_shift=5.0):
+        """Whether the two fingerprints (most probably) belong to the same audio; see bit_error_rate"""
+        return self.bit_error_rate(other, max_shift=max_shift) < threshold
+
+
+class Fingerprinter(object):
+    """
+    Computes fingerprints out of audio downmixed to mono, by taking the FFT of overlapping (hann windowed) frames and the
+    energies of 33 bands, logarithmically spaced between the 'bands' frequencies. Frames are defined in seconds, so that
+    audio decoded at any sample rate (ie shared through a PcmCache) yields comparable fingerprints. Audio gets consumed in
+    streaming chunks, each transformed with a single (vectorized) FFT call, so memory stays bounded for long audio.\n
+    :param int sample_rate: the sample rate audio gets decoded at, when not read from a PcmCache
+    :param float frame_duration: seconds per frame
+    :param float hop_duration: seconds between the starts of consecutive frames
+    :param tuple bands: the lowest and highest frequency (Hz) considered
+    """
+    def __init__(self, sample_rate=12000, frame_duration=0.2, hop_duration=0.1, bands=(300.0, 2000.0)):
+        self.sample_rate = sample_rate
+        self.frame_duration = frame_duration
+        self.hop_duration = hop_duration
+        self.bands = bands
+        self.frame_size = int(round(frame_duration * sample_rate))
+        self.hop_size = int(round(hop_duration * sample_rate))
+        self._window = np.hanning(self.frame_size).astype(np.float32)
+        edges = np.geomspace(bands[0], bands[1], 34) * self.frame_size / float(sample_rate)
+        self._edges = np.unique(np.round(edges).astype(int))
+        if len(self._edges) != 34:
+            raise ValueError("Frames of {} seconds are too short to resolve 33 bands between {} and {} Hz".format(frame_duration, *bands))
+
+    @property
+    def frame_rate(self):
+        return 1.0 / self.hop_duration
+
+    def at_sample_rate(self, sample_rate):
+        """A Fingerprinter for audio of the given sample rate, producing fingerprints comparable to this one's"""
+        if sample_rate == self.sample_rate:
+            return self
+        return Fingerprinter(sample_rate=sample_rate, frame_duration=self.frame_duration, hop_duration=self.hop_duration, bands=self.bands)
+
+    def fingerprint_file(self, audio_file, cache=None):
+        """
+        :param str audio_file: any file ffmpeg can decode
+        :param PcmCache cache: if given, the audio is read from (or decoded once into) the cache, in the cache's PCM format
+        :rtype: Fingerprint
+        """
+        if cache is not None:
+            decoded = cache.get(audio_file)
+            return self.at_sample_rate(decoded.sample_rate).fingerprint_chunks(decoded.chunks())
+        return self.fingerprint_chunks(decode(audio_file, sample_rate=self.sample_rate, channels=1))
+
+    def fingerprint_chunks(self, chunks):
+        """
+        :param chunks: an iterable of float sample arrays at 'sample_rate'; of shape (frames,), or (frames, channels) to downmix
+        :rtype: Fingerprint
+        """
+        hashes = []
+        buffer = np.zeros(0, dtype=np.float32)
+        for chunk in chunks:
+            chunk = np.asarray(chunk, dtype=np.float32)
+            buffer = np.concatenate([buffer, chunk.mean(axis=1) if chunk.ndim == 2 else chunk])
+            if len(buffer) < self.frame_size:
+                continue
+            nb_frames = 1 + (len(buffer) - self.frame_size) // self.hop_size
+            frames = np.lib.stride_tricks.as_strided(buffer, shape=(nb_frames, self.frame_size), writeable=False,
+                                                     strides=(self.hop_size * buffer.strides[0], buffer.strides[0]))
+            hashes.append(_pack(np.diff(self._band_energies(frames), axis=1) < 0))  # whether each band has more energy than the next
+            buffer = buffer[nb_frames * self.hop_size:]
+        return Fingerprint(np.concatenate(hashes) if hashes else np.zeros(0, dtype=np.uint32), self.frame_rate)
+
+    def _band_energies(self, frames):
+        spectrum = np.fft.rfft(frames * self._window, axis=1)
+        return np.add.reduceat(spectrum.real ** 2 + spectrum.imag ** 2, self._edges, axis=1)[:, :33]
+
+
+def _pack(bits):
+    """Packs the 32 boolean columns of each row into a uint32, the first column being the least significant bit"""
+    return np.packbits(np.ascontiguousarray(bits[:, ::-1]), axis=1).view('>u4').ravel().astype(np.uint32)
+
+
+@attr.s(frozen=True)
+class Duplicate(object):
+    """A track found to be (most probably) the same audio as an 'original' one, along with the bit error rate of the match"""
+    track = attr.ib(init=True)
+    original = attr.ib(init=True)
+    bit_error_rate = attr.ib(init=True)
+
+
+def fingerprint_files(audio_files, fingerprinter=None, nb_workers=4, cache=None):
+    """
+    Fingerprints audio files concurrently; decoding happens in ffmpeg processes and numpy releases the GIL while transforming.\n
+    :param list audio_files:
+    :param Fingerprinter fingerprinter:
+    :param int nb_workers:
+    :param PcmCache cache: to share the decoded audio with other analysis stages
+    :return: the fingerprints, in the order of the files; None for the files that could not be decoded
+    :rtype: list
+    """
+    fingerprinter = fingerprinter if fingerprinter else Fingerprinter()
+
+    def fingerprint(audio_file):
+        try:
+            return fingerprinter.fingerprint_file(audio_file, cache=cache)
+        except DecodingError as e:
+            logger.warning("Could not fingerprint '{}': {}".format(audio_file, e))
+            return None
+    with ThreadPoolExecutor(max_workers=nb_workers) as executor:
+        return list(executor.map(fingerprint, audio_files))
+
+
+def find_duplicates(index, fingerprints, threshold=0.35, max_shift=5.0):
+    """
+    Call this method to check whether (new) tracks are already in the library, comparing their fingerprints with the ones
+    stored in the library index. Only indexed tracks of similar duration, fingerprinted at the same frame rate, are compared.\n
+    :param music_album_creation.library_index.LibraryIndex index:
+    :param dict fingerprints: Fingerprint objects by track path
+    :param float threshold: the maximum bit error rate of a match
+    :param float max_shift: maximum shift, in seconds, between matching audio
+    :return: the tracks found in the library, along with the indexed track they match
+    :rtype: list of Duplicate
+    """
+    duplicates = []
+    for track, fingerprint in sorted(fingerprints.items()):
+        best = None
+        for original, candidate in index.fingerprints(duration=fingerprint.duration, tolerance=2 * max_shift, frame_rate=fingerprint.frame_rate):
+            if original == track:
+                continue
+            error_rate = fingerprint.bit_error_rate(candidate, max_shift=max_shift)
+            if error_rate < threshold and (best is None or error_rate < best.bit_error_rate):
+                best = Duplicate(track, original, error_rate)
+        if best is not None:
+            logger.info("Track '{}' duplicates '{}' (bit error rate {:.3f})".format(best.track, best.original, best.bit_error_rate))
+            duplicates.append(best)
+    return duplicates
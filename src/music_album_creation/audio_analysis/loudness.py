@@ -0,0 +1,189 @@
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import attr
+import numpy as np
+
+from .decoding import decode
+
+logger = logging.getLogger(__name__)
+
+# the two biquads of the K-weighting filter (a high shelf and a high pass), as specified for 48 kHz by ITU-R BS.1770-4
+_K_WEIGHTING = [([1.53512485958697, -2.69169618940638, 1.19839281085285], [1.0, -1.69065929318241, 0.73248077421585]),
+                ([1.0, -2.0, 1.0], [1.0, -1.99004745483398, 0.99007225036621])]
+
+
+class LoudnessMeter(object):
+    """
+    Measures loudness as specified by ITU-R BS.1770-4 (and used by ReplayGain 2.0): the mean square of the K-weighted audio,
+    over 400 ms blocks overlapping by 75%, gated at -70 LUFS and at 10 LU below the loudness of the blocks passing that gate.
+
+    Audio gets consumed in streaming chunks of 100 ms segments. Instead of running the (recursive) K-weighting filter sample
+    by sample, the power of every segment of a chunk is computed at once in the frequency domain: a single FFT call and a
+    product with the filter's squared magnitude response (Parseval's theorem). Only a power per segment is kept, so memory
+    stays bounded for multi-hour albums.\n
+    :param int sample_rate: the sample rate audio gets decoded at; up to 48000
+    :param int channels: number of channels audio gets decoded to; each weighted by 1 (as left and right are)
+    """
+    segment_duration = 0.1
+
+    def __init__(self, sample_rate=48000, channels=2):
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.segment_size = int(round(sample_rate * self.segment_duration))
+        frequencies = np.fft.rfftfreq(self.segment_size, d=1.0 / sample_rate)
+        z = np.exp(-2j * np.pi * frequencies / 48000.0)
+        response = np.ones(len(frequencies))
+        for b, a in _K_WEIGHTING:
+            response *= np.abs(np.polyval(b[::-1], z) / np.polyval(a[::-1], z)) ** 2
+        # weights turning the squared FFT magnitudes of a segment into the mean square of the (filtered) segment
+        weights = np.full(len(frequencies), 2.0)
+        weights[0] = 1.0
+        if self.segment_size % 2 == 0:
+            weights[-1] = 1.0
+        self._weights = weights * response / float(self.segment_size) ** 2
+
+    def measure_file(self, audio_file, cache=None):
+        """
+        :param str audio_file: any file ffmpeg can decode
+        :param PcmCache cache: if given, the audio is read from (or decoded once into) the cache
+        :rtype: TrackLoudness
+        """
+        if cache is not None:
+            chunks = cache.get(audio_file, sample_rate=self.sample_rate, channels=self.channels).chunks()
+        else:
+            chunks = decode(audio_file, sample_rate=self.sample_rate, channels=self.channels)
+        measurement = self.measure_chunks(chunks)
+        return attr.evolve(measurement, file=audio_file)
+
+    def measure_chunks(self, chunks):
+        """
+        :param chunks: an iterable of float sample arrays, of shape (frames, channels), or (frames,) if mono
+        :rtype: TrackLoudness
+        """
+        powers, peak = [], 0.0
+        buffer = np.zeros((0, self.channels), dtype=np.float32)
+        for chunk in chunks:
+            chunk = np.asarray(chunk, dtype=np.float32).reshape(-1, self.channels)
+            if len(chunk):
+                peak = max(peak, float(np.abs(chunk).max()))
+            buffer = np.concatenate([buffer, chunk])
+            nb_segments = len(buffer) // self.segment_size
+            if nb_segments:
+                segments = buffer[:nb_segments * self.segment_size].reshape(nb_segments, self.segment_size, self.channels)
+                spectrum = np.fft.rfft(segments, axis=1)
+                powers.append(np.einsum('sbc,b->s', spectrum.real ** 2 + spectrum.imag ** 2, self._weights))
+                buffer = buffer[nb_segments * self.segment_size:]
+        return TrackLoudness(None, np.concatenate(powers) if powers else np.zeros(0), peak)
+
+
+@attr.s(frozen=True)
+class TrackLoudness(object):
+    """
+    The loudness measurement of a track: the (K-weighted, summed over channels) mean square of every 100 ms segment and the
+    sample peak, as a fraction of full scale.\n
+    :param str file:
+    :param numpy.ndarray segment_powers:
+    :param float peak:
+    """
+    file = attr.ib(init=True)
+    segment_powers = attr.ib(init=True, repr=False)
+    peak = attr.ib(init=True)
+
+    @property
+    def block_powers(self):
+        """The mean squares of the 400 ms gating blocks, overlapping by 75%"""
+        return _block_powers(self.segment_powers)
+
+    @property
+    def loudness(self):
+        """The integrated loudness in LUFS; -inf for silence (or audio shorter than 400 ms)"""
+        return integrated_loudness(self.block_powers)
+
+    @property
+    def gain(self):
+        return replaygain(self.loudness)
+
+
+@attr.s(frozen=True)
+class AlbumLoudness(object):
+    """The loudness measurements of the tracks of an album; the album loudness gates the blocks of all tracks together"""
+    tracks = attr.ib(init=True)
+
+    @property
+    def loudness(self):
+        return integrated_loudness(np.concatenate([x.block_powers for x in self.tracks] + [np.zeros(0)]))
+
+    @property
+    def gain(self):
+        return replaygain(self.loudness)
+
+    @property
+    def peak(self):
+        return max([x.peak for x in self.tracks] + [0.0])
+
+    def frames(self, track):
+        """The ReplayGain values of a track of the album, by MetadataDealer metadata name; gains are left out for silent audio"""
+        frames = {'replaygain_track_peak': '{:.6f}'.format(track.peak), 'replaygain_album_peak': '{:.6f}'.format(self.peak)}
+        if track.gain is not None:
+            frames['replaygain_track_gain'] = '{:+.2f} dB'.format(track.gain)
+        if self.gain is not None:
+            frames['replaygain_album_gain'] = '{:+.2f} dB'.format(self.gain)
+        return frames
+
+
+def _block_powers(segment_powers):
+    if len(segment_powers) < 4:
+        return np.zeros(0)
+    return np.convolve(segment_powers, np.full(4, 0.25), mode='valid')
+
+
+def integrated_loudness(block_powers):
+    """
+    The gated loudness (in LUFS) of the given 400 ms block mean squares; see LoudnessMeter.\n
+    :param numpy.ndarray block_powers:
+    :rtype: float
+    """
+    block_powers = np.asarray(block_powers, dtype=np.float64)
+    gated = block_powers[-0.691 + 10 * np.log10(np.maximum(block_powers, 1e-20)) > -70.0]
+    if not len(gated):
+        return float('-inf')
+    threshold = -0.691 + 10 * np.log10(gated.mean()) - 10.0
+    gated = gated[-0.691 + 10 * np.log10(gated) > threshold]
+    return float(-0.691 + 10 * np.log10(gated.mean()))
+
+
+def replaygain(loudness, reference=-18.0):
+    """The gain (in dB) bringing audio of the given loudness to the ReplayGain 2.0 reference level; None for silence"""
+    return None if np.isinf(loudness) else reference - loudness
+
+
+def analyze_album(audio_files, meter=None, nb_workers=4, cache=None):
+    """
+    Measures the loudness of the tracks of an album, each decoded once (streaming), by a pool of threads; decoding happens in
+    ffmpeg processes and numpy releases the GIL while transforming.\n
+    :param list audio_files:
+    :param LoudnessMeter meter:
+    :param int nb_workers:
+    :param PcmCache cache: to share the decoded audio with other analysis stages
+    :rtype: AlbumLoudness
+    """
+    meter = meter if meter else LoudnessMeter()
+    with ThreadPoolExecutor(max_workers=nb_workers) as executor:
+        return AlbumLoudness(list(executor.map(lambda x: meter.measure_file(x, cache=cache), audio_files)))
+
+
+def write_replaygain(album_loudness, nb_workers=None):
+    """
+    Writes the ReplayGain values of each track (as TXXX frames), through the MetadataDealer; only the frames that changed.\n
+    :param AlbumLoudness album_loudness:
+    :param int nb_workers: number of threads writing files concurrently
+    :return: the success or failure per file
+    :rtype: music_album_creation.metadata.AlbumTaggingResult
+    """
+    from music_album_creation.metadata import AlbumTaggingResult, MetadataDealer
+    plan = [(track.file, album_loudness.frames(track)) for track in album_loudness.tracks]
+    outcomes = MetadataDealer.write_plan(plan, nb_workers=nb_workers, incremental=True)
+    album_directory = os.path.dirname(plan[0][0]) if plan else ''
+    return AlbumTaggingResult(album_directory, sorted(outcomes, key=lambda x: x.file))
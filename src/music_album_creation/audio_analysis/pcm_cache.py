@@ -0,0 +1,172 @@
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+
+import attr
+import numpy as np
+
+from .decoding import decode_raw
+
+logger = logging.getLogger(__name__)
+
+
+@attr.s(frozen=True)
+class DecodedAudio(object):
+    """
+    An audio file decoded to 16 bit PCM in a scratch file of a PcmCache, memory mapped (read only).\n
+    :param str file: the audio file
+    :param int sample_rate:
+    :param int channels:
+    :param numpy.memmap samples: the int16 samples, of shape (frames, channels)
+    """
+    file = attr.ib(init=True)
+    sample_rate = attr.ib(init=True)
+    channels = attr.ib(init=True)
+    samples = attr.ib(init=True, repr=False)
+
+    @property
+    def duration(self):
+        return len(self.samples) / float(self.sample_rate)
+
+    def chunks(self, chunk_frames=65536):
+        """
+        The samples as float32 chunks in [-1, 1], of shape (frames, channels); like the ones audio_analysis.decode yields
+        for multichannel audio. Each chunk is converted from a view of the mapped file, so memory stays bounded.\n
+        :rtype: generator
+        """
+        for start in range(0, len(self.samples), chunk_frames):
+            yield self.samples[start:start + chunk_frames].astype(np.float32) / 32768.0
+
+
+class PcmCache(object):
+    """
+    Decodes audio files once per job and shares the PCM among the analysis stages (ie fingerprinting and loudness measurement)
+    through memory mapped scratch files, keyed by a hash of the file's content and the PCM format. Concurrent requests for
+    the same audio wait for a single decode. The scratch files live in the job's workspace directory: the least recently used
+    ones get evicted whenever the cache grows beyond 'max_bytes' and all of them are removed when the job closes the cache.
+
+    Tracks cut out of an album can be declared as segments of it (see 'add_segment'), so that the album gets decoded once,
+    in a single ffmpeg process, and each track's audio is a slice of the album's PCM.\n
+    :param str workspace: the job's directory to hold the scratch files; defaults to a new temporary directory
+    :param int max_bytes: the size the scratch files are allowed to take in total
+    :param int sample_rate: the sample rate audio gets decoded at, if not requested otherwise
+    :param int channels: the number of channels audio gets decoded to, if not requested otherwise
+    """
+    def __init__(self, workspace=None, max_bytes=4 * 1024 ** 3, sample_rate=48000, channels=2):
+        self._own_workspace = workspace is None
+        self.workspace = tempfile.mkdtemp(prefix='pcm-cache-') if workspace is None else workspace
+        if not os.path.isdir(self.workspace):
+            os.makedirs(self.workspace)
+        self.max_bytes = max_bytes
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self._entries = OrderedDict()  # scratch file paths by key, least recently used first
+        self._lock = threading.Lock()
+        self._key_locks = {}
+        self._segments = {}  # (source file, start, end) by segment file path
+        self.nb_decodes = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def add_segment(self, audio_file, source_file, start, end=None):
+        """
+        Declares that an audio file holds the audio of another one from 'start' to 'end'; ie a track cut out of an album,
+        so that getting the track slices the album's PCM instead of decoding the track.\n
+        :param str audio_file: ie the track
+        :param str source_file: ie the album
+        :param float start: in seconds
+        :param float end: in seconds; None for the end of the source
+        """
+        with self._lock:
+            self._segments[os.path.abspath(audio_file)] = (source_file, float(start), None if end is None else float(end))
+
+    def get(self, audio_file, sample_rate=None, channels=None):
+        """
+        :param str audio_file:
+        :param int sample_rate: defaults to the cache's one
+        :param int channels: defaults to the cache's one
+        :rtype: DecodedAudio
+        """
+        sample_rate = sample_rate or self.sample_rate
+        channels = channels or self.channels
+        segment = self._segments.get(os.path.abspath(audio_file))
+        if segment is not None:
+            source_file, start, end = segment
+            samples = self.get(source_file, sample_rate=sample_rate, channels=channels).samples
+            return DecodedAudio(audio_file, sample_rate, channels,
+                                samples[int(round(start * sample_rate)):None if end is None else int(round(end * sample_rate))])
+        key = '{}-{}-{}'.format(content_hash(audio_file), sample_rate, channels)
+        with self._lock:
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+        with key_lock:  # so that only one of the stages requesting the same audio decodes it
+            with self._lock:
+                scratch_file = self._entries.get(key)
+                if scratch_file is not None:
+                    self._entries.move_to_end(key)
+            if scratch_file is None:
+                scratch_file = self._decode(audio_file, key, sample_rate, channels)
+            samples = np.memmap(scratch_file, dtype='<i2', mode='r') if os.path.getsize(scratch_file) else np.zeros(0, dtype='<i2')
+        return DecodedAudio(audio_file, sample_rate, channels, samples.reshape(-1, channels))
+
+    def _decode(self, audio_file, key, sample_rate, channels):
+        scratch_file = os.path.join(self.workspace, '{}.pcm'.format(key))
+        temporary = '{}.tmp'.format(scratch_file)
+        logger.info("Decoding '{}' into '{}'".format(audio_file, scratch_file))
+        try:
+            with open(temporary, 'wb') as f:
+                for data in decode_raw(audio_file, sample_rate=sample_rate, channels=channels):
+                    f.write(data)
+        except BaseException:
+            os.remove(temporary)
+            raise
+        os.replace(temporary, scratch_file)
+        with self._lock:
+            self.nb_decodes += 1
+            self._entries[key] = scratch_file
+            self._evict(keep=key)
+        return scratch_file
+
+    def _evict(self, keep):
+        """Removes the least recently used scratch files until the cache fits in 'max_bytes'; memory maps already handed out stay valid on posix"""
+        sizes = {k: os.path.getsize(v) for k, v in self._entries.items()}
+        total = sum(sizes.values())
+        for key in list(self._entries):
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            _remove(self._entries.pop(key))
+            total -= sizes[key]
+
+    def close(self):
+        """Removes the scratch files; and the workspace directory, if the cache created it"""
+        with self._lock:
+            for scratch_file in self._entries.values():
+                _remove(scratch_file)
+            self._entries.clear()
+        if self._own_workspace:
+            shutil.rmtree(self.workspace, ignore_errors=True)
+
+
+def content_hash(file_path, block_size=1024 ** 2):
+    """A (sha1) hash of the file's content; so that the same audio gets found in the cache under any path or name"""
+    digest = hashlib.sha1()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _remove(file_path):
+    try:
+        os.remove(file_path)
+    except OSError as e:  # ie still mapped, on windows
+        logger.warning("Could not remove scratch file '{}': {}".format(file_path, e))
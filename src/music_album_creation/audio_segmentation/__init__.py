@@ -1,4 +1,4 @@
-from .album_segmentation import AudioSegmenter
+from .album_segmentation import AudioSegmenter, SpeculativeSegmentation
 from .data import SegmentationInformation, Timestamp, TracksInformation
 
-__all__ = ['AudioSegmenter', 'TracksInformation', 'Timestamp', 'SegmentationInformation']
+__all__ = ['AudioSegmenter', 'SpeculativeSegmentation', 'TracksInformation', 'Timestamp', 'SegmentationInformation']
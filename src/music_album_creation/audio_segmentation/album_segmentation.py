@@ -1,9 +1,13 @@
 import logging
 import os
+import shutil
 import subprocess
 import tempfile
+import threading
 import time
 
+from music_album_creation import events, profiling
+from music_album_creation.process_watchdog import ProcessWatchdog
 from music_album_creation.tracks_parsing import StringParser
 
 from .data import SegmentationInformation
@@ -13,8 +17,26 @@ logger = logging.getLogger(__name__)
 
 class AudioSegmenter(object):
 
-    def __init__(self, target_directory=tempfile.gettempdir()):
+    def __init__(self, target_directory=tempfile.gettempdir(), timeout=None, stall_timeout=None, id3_padding=None):
+        """
+        :param str target_directory:
+        :param float timeout: seconds allowed for each ffmpeg invocation; None for no limit
+        :param float stall_timeout: seconds allowed for an ffmpeg invocation to make no progress; None for no limit
+        :param int id3_padding: bytes of ID3 padding to reserve in each created track, so that tagging it later does not
+         rewrite the whole file; None to leave the tracks as created by ffmpeg
+        """
         self._dir = target_directory
+        self.timeout = timeout
+        self.stall_timeout = stall_timeout
+        self.id3_padding = id3_padding
+        self._watchdog = None
+        self._cancelled = False
+
+    def cancel(self):
+        """Kills the running ffmpeg invocation, if any, and makes segmenting raise a SegmentationCancelledError; from any thread"""
+        self._cancelled = True
+        if self._watchdog is not None:
+            self._watchdog.cancel()
 
     @property
     def target_directory(self):
@@ -40,15 +62,18 @@ class AudioSegmenter(object):
         """
         exit_code = 0
         i = 0
+        start = time.time()
         while exit_code == 0 and i < len(data) - 1:
             time.sleep(sleep_seconds)
             exit_code = self._segment(album_file, *self._trans(list(data[i])), supress_stdout=supress_stdout, supress_stderr=supress_stderr)
             i += 1
+            _progress(i, len(data), start)
         if exit_code != 0:
             raise FfmpegCommandError("Command '{}' failed".format(' '.join(self._args)))
         exit_code = self._segment(album_file, *self._trans(list(data[-1])), supress_stdout=supress_stdout, supress_stderr=supress_stderr)
         if exit_code != 0:
             raise FfmpegCommandError("Command '{}' failed".format(' '.join(self._args)))
+        _progress(len(data), len(data), start)
         return [os.path.join(self._dir, '{}.mp3'.format(list(x)[0])) for x in data]
 
     def segment_from_list(self, album_file, data, supress_stdout=True, supress_stderr=True, sleep_seconds=0):
@@ -69,15 +94,18 @@ class AudioSegmenter(object):
         data = StringParser.convert_tracks_data(data, album_file, target_directory=self._dir)
         audio_file_paths = [x[0] for x in data]
         i = 0
+        start = time.time()
         while exit_code == 0 and i < len(data) - 1:
             time.sleep(sleep_seconds)
             exit_code = self._segment(album_file, *data[i], supress_stdout=supress_stdout, supress_stderr=supress_stderr)
             i += 1
+            _progress(i, len(data), start)
         if exit_code != 0:
             raise FfmpegCommandError("Command '{}' failed".format(' '.join(self._args)))
         exit_code = self._segment(album_file, *data[-1], supress_stdout=supress_stdout, supress_stderr=supress_stderr)
         if exit_code != 0:
             raise FfmpegCommandError("Command '{}' failed".format(' '.join(self._args)))
+        _progress(len(data), len(data), start)
         return audio_file_paths
 
     def segment_from_file(self, album_file, tracks_file, hhmmss_type, supress_stdout=True, supress_stderr=True, sleep_seconds=0):
@@ -108,20 +136,114 @@ class AudioSegmenter(object):
         args = ['ffmpeg', '-y', '-i', '-acodec', 'copy', '-ss']
         self._args = args[:3] + ['{}'.format(album_file)] + args[3:] + [start] + (lambda: ['-to', str(end)] if end else [])() + ['{}'.format(track_file)]
         logger.info("Segmenting: '{}'".format(' '.join(self._args)))
-        return subprocess.check_call(self._args, **self.__std_parameters(supress_stdout, supress_stderr))
-        # ro = subprocess.run(self._args, **self.__std_parameters(supress_stdout, supress_stderr))
-        # return ro.returncode
+        if self._cancelled:
+            raise SegmentationCancelledError("Segmentation of '{}' cancelled".format(album_file))
+        start_time = time.time()
+        self._watchdog = ProcessWatchdog(timeout=self.timeout, stall_timeout=self.stall_timeout)
+        if self._cancelled:  # cancelled while the watchdog got created
+            self._watchdog.cancel()
+        with profiling.stage('cut', track=os.path.basename(track_file)):
+            # the growth of the track file counts as progress, as ffmpeg's output may not be captured
+            ro = self._watchdog.run(
+                self._args, capture_stdout=supress_stdout, capture_stderr=supress_stderr, watch_paths=[track_file])
+            if ro.returncode != 0:
+                raise subprocess.CalledProcessError(ro.returncode, self._args, output=ro.stdout)
+            if self.id3_padding is not None:
+                from music_album_creation.metadata import MetadataDealer  # imported on first use, along with mutagen
+                MetadataDealer.reserve_padding(track_file, padding=self.id3_padding)
+            profiling.count('bytes_written', os.path.getsize(track_file))
+        events.publish(events.TrackCut, track=track_file, start=start, end=end, size=os.path.getsize(track_file), elapsed=time.time() - start_time)
+        return ro.returncode
 
-    @classmethod
-    def __std_parameters(cls, std_out_flag, std_error_flag):
-        """If an input flag is True then the stream  (either 'out' or 'err') can be obtained ie obj = subprocess.run(..); str(obj.stdout, encoding='utf-8')).\n
-        If an input flag is False then the stream will be normally outputted; ie at the terminal"""
-        return {v: subprocess.PIPE for k, v in zip([std_out_flag, std_error_flag], ['stdout', 'stderr']) if k}
+
+def _progress(done, total, start):
+    events.publish(events.StageProgress, stage='segmentation', done=done, total=total, unit='track', elapsed=time.time() - start)
+
+
+class SpeculativeSegmentation(object):
+    """
+    Segments an album in a background thread, following a predicted interpretation ('timestamps' or 'durations') of the
+    tracks' hh:mm:ss information, while the user is still asked to confirm it. Tracks are created in a dedicated temporary
+    directory so that, if the prediction gets rejected, the speculative outputs can simply be thrown away.\n
+    :param str album_file:
+    :param TracksInformation tracks_info:
+    :param str hhmmss_type: the predicted interpretation; {'timestamps', 'durations'}
+    :param int id3_padding: bytes of ID3 padding to reserve in each created track; see AudioSegmenter
+    :param float timeout: seconds allowed for each ffmpeg invocation; None for no limit
+    :param float stall_timeout: seconds allowed for an ffmpeg invocation to make no progress; None for no limit
+    """
+    def __init__(self, album_file, tracks_info, hhmmss_type, id3_padding=None, timeout=None, stall_timeout=None, **kwargs):
+        self.hhmmss_type = hhmmss_type.lower()
+        self._segmenter = AudioSegmenter(target_directory=tempfile.mkdtemp(prefix='speculative-segmentation-'), timeout=timeout,
+                                         stall_timeout=stall_timeout, id3_padding=id3_padding)
+        self._audio_file_paths = None
+        self._exception = None
+        self._finished = False
+        self._discarded = False
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, args=(album_file, tracks_info, kwargs))
+        self._thread.daemon = True
+        self._thread.start()
+
+    @property
+    def target_directory(self):
+        """The (temporary) directory where the speculatively created tracks are stored"""
+        return self._segmenter.target_directory
+
+    def _run(self, album_file, tracks_info, kwargs):
+        try:
+            segmentation_info = SegmentationInformation.from_tracks_information(tracks_info, hhmmss_type=self.hhmmss_type)
+            self._audio_file_paths = self._segmenter.segment(album_file, segmentation_info, **kwargs)
+        except Exception as e:  # surfaced to the caller, if the speculation gets confirmed
+            self._exception = e
+        with self._lock:
+            self._finished = True
+            if self._discarded:
+                shutil.rmtree(self.target_directory, ignore_errors=True)
+
+    def matches(self, hhmmss_type):
+        """Call this method to check whether the input 'hhmmss' interpretation (ie as answered by the user) is the one speculated upon"""
+        return hhmmss_type.lower().startswith('timestamp') == self.hhmmss_type.startswith('timestamp')
+
+    def result(self):
+        """
+        Blocks until the speculative segmentation finishes and returns the paths of the created tracks. If segmenting failed, the
+        exception raised in the background thread is raised here instead.\n
+        :return: full paths to audio tracks
+        :rtype: list
+        """
+        self._thread.join()
+        if self._exception is not None:
+            raise self._exception
+        return self._audio_file_paths
+
+    def discard(self):
+        """Throws away the speculative outputs, without waiting for a possibly still running segmentation to finish; the
+        running ffmpeg invocation gets killed and the directory is removed once the background thread exits"""
+        with self._lock:
+            self._discarded = True
+            if self._finished:
+                shutil.rmtree(self.target_directory, ignore_errors=True)
+            else:
+                self._segmenter.cancel()
+
+    def close(self):
+        """Removes the speculatively created tracks; call it once they are no longer needed, whether confirmed or not"""
+        self.discard()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
 
 
 class FfmpegCommandError(Exception): pass
 
 
+class SegmentationCancelledError(Exception): pass
+
+
 if __name__ == '__main__':
     import sys
 
@@ -1,7 +1,9 @@
 import re
-import time
+import threading
+from collections import OrderedDict
 
 import attr
+import numpy as np
 from music_album_creation.tracks_parsing import StringParser
 
 
@@ -15,81 +17,198 @@ def segmentation_information(tracks_timestamps_info):
     :return: each iner list contains track path and timestamp in seconds
     :rtype: list of lists
     """
-    return [list(_) for _ in _generate_segmentation_spans(tracks_timestamps_info)]
+    return [list(_) for _ in TrackTable.from_timestamps(*_columns(tracks_timestamps_info)).spans()]
 
 
-def _generate_segmentation_spans(tracks_info):
-    """
-    Given a data list, with each element representing an album's track (as an inner 2-element list with 1st element the 'track_name' and 2nd a timetamp in hh:mm:ss format (the track starts it's playback at that timestamp in relation with the total album playtime), the path to the alum file at hand and the desired output directory or potentially storing the track files,
-    generates 3-length tuples with the track_file_path, starting timestamp and ending timestamp. Purpose is for the yielded tripplets to be digested for audio segmentation. The exception being the last tuple yielded that has 2 elements; it naturally misses the ending timestamp.\n
-    :param list tracks_info:
-    :returns: 3-element tuples with track_file_path, starting_timestamp, ending_timestamp
-    :rtype: tuple
-    """
-    track_index_generator = iter((lambda x: str(x) if 9 < x else '0' + str(x))(_) for _ in range(1, len(tracks_info) + 1))
-    for i in range(len(tracks_info)-1):
-        if Timestamp(tracks_info[i + 1][1]) <= Timestamp(tracks_info[i][1]):
-            raise TrackTimestampsSequenceError(
-                "Track '{} - {}' starting timestamp '{}' should be 'bigger' than track's '{} - {}'; '{}'".format(
-                    i + 2, tracks_info[i + 1][0], tracks_info[i + 1][1],
-                    i + 1, tracks_info[i][0], tracks_info[i][1]))
-        yield (
-            '{} - {}'.format(next(track_index_generator), tracks_info[i][0]),
-            str(int(Timestamp(tracks_info[i][1]))),
-            str(int(Timestamp(tracks_info[i + 1][1])))
-        )
-    yield (
-        '{} - {}'.format(next(track_index_generator), tracks_info[-1][0]),
-        str(int(Timestamp(tracks_info[-1][1]))),
-    )
-
 def to_timestamps_info(tracks_durations_info):
     """Call this method to transform a list of 2-legnth lists of track_name - duration_hhmmss pairs to the equivalent list of lists but with starting timestamps in hhmmss format inplace of the durations.\n
     :param list tracks_durations_info: eg: [['Know your enemy', '3:45'], ['Wake up', '4:53'], ['Testify', '4:32']]
     :return: eg: [['Know your enemy', '0:00'], ['Wake up', '3:45'], ['Testify', '8:38']]
     :rtype: list
     """
-    return [list(_) for _ in _gen_timestamp_data(tracks_durations_info)]
+    table = TrackTable.from_durations(*_columns(tracks_durations_info), validate=False)
+    return [list(_) for _ in zip(table.names, table.timestamps())]
+
+
+def _columns(tracks_info):
+    """Splits track_name - hhmmss pairs into a list of names and a list of hhmmss strings"""
+    if isinstance(tracks_info, TracksInformation):
+        return tracks_info.track_names, tracks_info.hhmmss_list
+    return [x[0] for x in tracks_info], [x[1] for x in tracks_info]
 
 
-def _gen_timestamp_data(tracks_duration_info):
+class TrackTable(object):
     """
-    :param list of lists tracks_duration_info: each inner list has as 1st element a track name and as 2nd the track duration in hh:mm:s format
-    :return: list of lists with timestamps instead of durations ready to feed for segmentation
-    :rtype: list
+    An album's tracks in columnar form: the track names and their start and end offsets (in milliseconds) as numpy integer
+    arrays. The last track's end is the (implied) end of the album, held as -1. Converting durations to starting timestamps,
+    validating that the timestamps strictly increase and generating the segmentation spans are done on whole columns.\n
+    :param list names: the track names
+    :param starts: the tracks' starting offsets in milliseconds
+    :param list file_names: the tracks' file names (without extension); defaults to the names prefixed with the track numbers
     """
-    i = 1
-    p = Timestamp('0:00')
-    yield tracks_duration_info[0][0], str(p)
-    while i < len(tracks_duration_info):
-        try:
-            yield tracks_duration_info[i][0], str(p + Timestamp(tracks_duration_info[i - 1][1]))
-        except WrongTimestampFormat as e:
-            raise e
-        p += Timestamp(tracks_duration_info[i - 1][1])
-        i += 1
+    def __init__(self, names, starts, file_names=None):
+        self.names = list(names)
+        self.starts = np.asarray(starts, dtype=np.int64)
+        self.ends = np.append(self.starts[1:], -1)
+        if file_names is None:
+            file_names = ['{:02d} - {}'.format(i, name) for i, name in enumerate(self.names, 1)]
+        self.file_names = list(file_names)
+
+    @classmethod
+    def from_timestamps(cls, names, hhmmss_list):
+        """
+        :param list names: the track names
+        :param list hhmmss_list: the tracks' starting timestamps, in hh:mm:ss format
+        :rtype: TrackTable
+        """
+        table = cls(names, [_parse_milliseconds(x) for x in hhmmss_list])
+        table.validate(hhmmss_list)
+        return table
+
+    @classmethod
+    def from_durations(cls, names, hhmmss_list, validate=True):
+        """
+        :param list names: the track names
+        :param list hhmmss_list: the tracks' durations, in hh:mm:ss format
+        :param bool validate: whether to check that the resulting timestamps strictly increase (ie no zero durations)
+        :rtype: TrackTable
+        """
+        durations = np.fromiter((_parse_milliseconds(x) for x in hhmmss_list), dtype=np.int64, count=len(hhmmss_list))
+        starts = np.zeros(len(durations), dtype=np.int64)
+        np.cumsum(durations[:-1], out=starts[1:])
+        table = cls(names, starts)
+        if validate:
+            table.validate()
+        return table
+
+    @classmethod
+    def from_spans(cls, spans):
+        """
+        The inverse of 'spans': a table out of segmentation spans (ie the list of lists SegmentationInformation used to hold).
+        The file names are kept as given; a track's end is taken to be the next track's start.\n
+        :param list spans: [file_name, start_seconds(, end_seconds)] lists or tuples; the seconds as strings or numbers
+        :rtype: TrackTable
+        """
+        file_names = [span[0] for span in spans]
+        names = [_numbered_name.sub('', x) for x in file_names]
+        table = cls(names, [int(round(float(span[1]) * 1000)) for span in spans], file_names=file_names)
+        table.validate()
+        return table
+
+    @classmethod
+    def from_tracks_information(cls, tracks_information, hhmmss_type):
+        """
+        :param tracks_information: track_name - hhmmss pairs; a TracksInformation or a list of lists
+        :param str hhmmss_type: how to interpret the hhmmss strings; {'timestamps', 'durations'}
+        :rtype: TrackTable
+        """
+        if hhmmss_type.lower().startswith('timestamp'):
+            return cls.from_timestamps(*_columns(tracks_information))
+        return cls.from_durations(*_columns(tracks_information))
+
+    def __len__(self):
+        return len(self.names)
+
+    def __eq__(self, other):
+        if not isinstance(other, TrackTable):
+            return NotImplemented
+        return self.names == other.names and self.file_names == other.file_names and np.array_equal(self.starts, other.starts)
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    __hash__ = None
+
+    def __repr__(self):
+        return '{}(names={!r}, starts={!r})'.format(type(self).__name__, self.names, self.starts.tolist())
+
+    def validate(self, hhmmss_list=None):
+        """
+        Raises a TrackTimestampsSequenceError, reporting the first offending pair of tracks, if the starting timestamps do not strictly increase.\n
+        :param list hhmmss_list: the timestamps, as given by the user, to report; defaults to the table's timestamps
+        """
+        wrong = np.flatnonzero(self.starts[1:] <= self.starts[:-1])
+        if wrong.size:
+            i = int(wrong[0])
+            hhmmss = hhmmss_list if hhmmss_list is not None else self.timestamps()
+            raise TrackTimestampsSequenceError(
+                "Track '{} - {}' starting timestamp '{}' should be 'bigger' than track's '{} - {}'; '{}'".format(
+                    i + 2, self.names[i + 1], hhmmss[i + 1],
+                    i + 1, self.names[i], hhmmss[i]))
+
+    def timestamps(self):
+        """The starting timestamps as hh:mm:ss strings, eg ['0:00', '3:45', '1:02:08']"""
+        seconds, milliseconds = np.divmod(self.starts, 1000)
+        minutes, seconds = np.divmod(seconds, 60)
+        hours, minutes = np.divmod(minutes, 60)
+        return [_format_hhmmss(*_) for _ in zip(hours.tolist(), minutes.tolist(), seconds.tolist(), milliseconds.tolist())]
+
+    def spans(self):
+        """
+        Generates the segmentation spans: 3-element tuples with the track file name (prefixed with its number), the starting and
+        the ending offsets, in seconds, as strings. The last tuple has 2 elements; it naturally misses the ending offset.\n
+        :rtype: list
+        """
+        starts = [_seconds_string(x) for x in self.starts.tolist()]
+        return list(zip(self.file_names[:-1], starts[:-1], starts[1:])) + [(self.file_names[-1], starts[-1])]
+
+    def span(self, index):
+        """The segmentation span of a single track (see 'spans'); negative indices count from the end"""
+        index = range(len(self))[index]
+        file_name = self.file_names[index]
+        if index == len(self) - 1:
+            return file_name, _seconds_string(int(self.starts[index]))
+        return file_name, _seconds_string(int(self.starts[index])), _seconds_string(int(self.ends[index]))
+
+
+_numbered_name = re.compile(r'^\d+ - ')
+
+
+def _to_table(tracks):
+    """A TrackTable out of a TrackTable or out of segmentation spans (a list of lists); see TrackTable.from_spans"""
+    return tracks if isinstance(tracks, TrackTable) else TrackTable.from_spans(tracks)
+
 
 ##############################################
-@attr.s
+@attr.s(init=False)
 class SegmentationInformation(object):
-    """Encapsulates per track: ['track-name', 'start-timestamp', 'end-timestamp']. Last entry does not have 'end-timestamp' because the end of the album is implied."""
-    tracks_info = attr.ib(init=True)
+    """
+    Encapsulates per track: ['track-name', 'start-timestamp', 'end-timestamp']. Last entry does not have 'end-timestamp' because the end of the album is implied.
+    Backed by a TrackTable; constructing it out of the list of lists (as the 'tracks_info' argument, or positionally) is still supported.\n
+    :param TrackTable table: or a list of lists of segmentation spans
+    :param list tracks_info: segmentation spans; an alternative to 'table'
+    """
+    table = attr.ib()
+
+    def __init__(self, table=None, tracks_info=None):
+        if (table is None) == (tracks_info is None):
+            raise TypeError("Expected exactly one of 'table' and 'tracks_info'")
+        self.table = _to_table(table if table is not None else tracks_info)
+
+    @property
+    def tracks_info(self):
+        """The segmentation spans as a list of lists, generated from the table on each access"""
+        return [list(_) for _ in self.table.spans()]
 
     @classmethod
     def from_tracks_information(cls, tracks_information, hhmmss_type):
-        if hhmmss_type.lower().startswith('timestamp'):
-            return SegmentationInformation(segmentation_information(list(tracks_information)))
-        return SegmentationInformation(segmentation_information(to_timestamps_info(list(tracks_information))))
+        return SegmentationInformation(TrackTable.from_tracks_information(tracks_information, hhmmss_type))
 
     @classmethod
     def from_multiline(cls, string, hhmmss_type):
         return cls.from_tracks_information(TracksInformation.from_multiline(string), hhmmss_type)
 
     def __len__(self):
-        return len(self.tracks_info)
+        return len(self.table)
+
+    def __iter__(self):
+        return iter(self.tracks_info)
 
     def __getitem__(self, item):
-        return self.tracks_info[item]
+        if isinstance(item, slice):
+            return self.tracks_info[item]
+        return list(self.table.span(item))
 
 @attr.s
 class TracksInformation(object):
@@ -114,88 +233,146 @@ class TracksInformation(object):
 
 ##########################################################
 class Timestamp(object):
-    instances = {}
+    """
+    An immutable point in time (or duration) of an album's playback, held as an integer number of milliseconds. Constructed
+    from strings in [[h:]m:]s[.fff] format, eg '1:02:03.5'; hours are unbounded so that albums and mixes longer than a day are
+    supported. Instances are interned in a bounded (least recently used) cache, so equal timestamps built repeatedly share
+    one object without the cache growing for ever in long running processes.
+    """
+    __slots__ = ('_ms',)
+
+    cache_size = 4096
+    _cache = OrderedDict()
+    _cache_lock = threading.Lock()
+
+    def __new__(cls, hhmmss):
+        return cls.from_milliseconds(_parse_milliseconds(hhmmss))
 
     @classmethod
-    def __str(cls, element):
-        if len(element) == 1:
-            return '0{}'.format(int(element))
-        return element
+    def from_milliseconds(cls, milliseconds):
+        if milliseconds < 0:
+            raise WrongTimestampFormat("Negative timestamp '{}' milliseconds.".format(milliseconds))
+        with cls._cache_lock:
+            instance = cls._cache.get(milliseconds)
+            if instance is not None:
+                cls._cache.move_to_end(milliseconds)
+                return instance
+            instance = super(Timestamp, cls).__new__(cls)
+            instance._ms = milliseconds
+            cls._cache[milliseconds] = instance
+            if cls.cache_size < len(cls._cache):
+                cls._cache.popitem(last=False)
+            return instance
 
     @classmethod
-    def __pos(cls, array):
-        i = 0
-        while i < len(array) and array[i] == 0:
-            i += 1
-        return i
-
-    def __new__(cls, *args, **kwargs):
-        hhmmss = args[0]
-        m = re.compile(r'^(?:(\d?\d):){0,2}(\d?\d)$').search(hhmmss)
-        if not m:
-            raise WrongTimestampFormat("Timestamp given: '{}'. Please use the 'hh:mm:ss' format.".format(hhmmss))
-        groups = hhmmss.split(':')
-        if not all([0 <= int(_) <= 60 for _ in groups]):
-            raise WrongTimestampFormat("Timestamp given: '{}'. Please use the 'hh:mm:ss' format.".format(hhmmss))
-
-        ind = cls.__pos(groups)
-        if len(groups) == 1:
-            minlength_string = '{}:{}'.format(0, cls.__str(groups[0]))
-        elif len(groups) - ind - 1 < 2:
-            minlength_string = '{}:{}'.format(int(groups[-2]), cls.__str(groups[-1]))
-        else:
-            minlength_string = ':'.join([str(int(groups[ind]))] + [y for y in groups[ind + 1:]])
-        stripped_string = ':'.join((str(int(_)) for _ in minlength_string.split(':')))
-
-        if stripped_string in cls.instances:
-            return cls.instances[stripped_string]
-        x = super(Timestamp, cls).__new__(cls)
-        x.__minlength_string = minlength_string
-        x._a = 'gg'
-        x.__stripped_string = stripped_string
-        x.__s = sum([60 ** i * int(gr) for i, gr in enumerate(reversed(groups))])
-        cls.instances[x.__stripped_string] = x
-        return x
-
-    def __init__(self, hhmmss):
-        pass
-
-    @staticmethod
-    def from_duration(seconds):
-        return Timestamp(time.strftime('%H:%M:%S', time.gmtime(seconds)))
+    def from_duration(cls, seconds):
+        """:param float seconds: an int or float amount of seconds"""
+        return cls.from_milliseconds(int(round(seconds * 1000)))
+
+    @property
+    def milliseconds(self):
+        return self._ms
+
+    @property
+    def seconds(self):
+        """The seconds as a string, eg '72' or '72.5', as expected by ffmpeg's -ss and -to options"""
+        return _seconds_string(self._ms)
+
+    def __reduce__(self):
+        return Timestamp.from_milliseconds, (self._ms,)
 
     def __int__(self):
-        return self.__s
+        return self._ms // 1000
+
+    def __float__(self):
+        return self._ms / 1000.0
 
     def __repr__(self):
-        return self.__minlength_string
+        return str(self)
 
     def __str__(self):
-        return self.__minlength_string
+        seconds, milliseconds = divmod(self._ms, 1000)
+        minutes, seconds = divmod(seconds, 60)
+        hours, minutes = divmod(minutes, 60)
+        return _format_hhmmss(hours, minutes, seconds, milliseconds)
 
     def __hash__(self):
-        return self.__s
+        return hash(self._ms / 1000.0)  # consistent with comparisons against plain seconds
 
     def __eq__(self, other):
-        return hash(self) == hash(other)
+        try:
+            return self._ms == _milliseconds(other)
+        except (TypeError, ValueError):
+            return NotImplemented
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
 
     def __lt__(self, other):
-        return int(self) < int(other)
+        return self._ms < _milliseconds(other)
 
     def __le__(self, other):
-        return int(self) <= int(other)
+        return self._ms <= _milliseconds(other)
 
     def __gt__(self, other):
-        return int(other) < int(self)
+        return self._ms > _milliseconds(other)
 
     def __ge__(self, other):
-        return int(other) <= int(self)
+        return self._ms >= _milliseconds(other)
 
     def __add__(self, other):
-        return Timestamp.from_duration(int(self) + int(other))
+        return Timestamp.from_milliseconds(self._ms + _milliseconds(other))
 
     def __sub__(self, other):
-        return Timestamp.from_duration(int(self) - int(other))
+        return Timestamp.from_milliseconds(self._ms - _milliseconds(other))
+
+
+_DIGITS = '0123456789'
+
+
+def _parse_milliseconds(hhmmss):
+    """Parses a [[h:]m:]s[.fff] string, where minutes and seconds are up to 2 digits (and up to 60) and the fraction up to 3 digits"""
+    error = WrongTimestampFormat("Timestamp given: '{}'. Please use the 'hh:mm:ss' format.".format(hhmmss))
+    if not isinstance(hhmmss, str):
+        raise error
+    whole, dot, fraction = hhmmss.partition('.')
+    milliseconds = 0
+    if dot:
+        if not 0 < len(fraction) <= 3 or fraction.strip(_DIGITS):
+            raise error
+        milliseconds = int(fraction.ljust(3, '0'))
+    groups = whole.split(':')
+    if 3 < len(groups):
+        raise error
+    seconds = 0
+    for i, group in enumerate(groups):
+        if not group or group.strip(_DIGITS):
+            raise error
+        value = int(group)
+        if not (i == 0 and len(groups) == 3) and (2 < len(group) or 60 < value):
+            raise error
+        seconds = seconds * 60 + value
+    return seconds * 1000 + milliseconds
+
+
+def _milliseconds(other):
+    if isinstance(other, Timestamp):
+        return other._ms
+    return int(round(float(other) * 1000))
+
+
+def _format_hhmmss(hours, minutes, seconds, milliseconds):
+    string = '{}:{:02d}:{:02d}'.format(hours, minutes, seconds) if hours else '{}:{:02d}'.format(minutes, seconds)
+    if milliseconds:
+        return '{}.{:03d}'.format(string, milliseconds)
+    return string
+
+
+def _seconds_string(milliseconds):
+    if milliseconds % 1000:
+        return '{}.{:03d}'.format(milliseconds // 1000, milliseconds % 1000).rstrip('0')
+    return str(milliseconds // 1000)
 
 
 class WrongTimestampFormat(Exception): pass
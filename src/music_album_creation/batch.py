@@ -0,0 +1,348 @@
+import csv
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import attr
+import click
+
+from . import configure_logging, events, profiling
+
+logger = logging.getLogger(__name__)
+
+# seconds a download, or an ffmpeg invocation, may run for and may make no progress for, when nobody is watching it
+DEFAULT_TIMEOUT = 3600.0
+DEFAULT_STALL_TIMEOUT = 300.0
+
+hhmmss_types = ('timestamps', 'durations', 'auto')
+
+
+@attr.s(frozen=True)
+class ManifestEntry(object):
+    """
+    An album to create: where its audio comes from (a youtube 'url' or a local audio 'file'), its tracklist (inline or in a
+    'tracklist_file'), how to interpret the tracklist's hh:mm:ss values and the album's tags and destination directory.
+    A missing destination is derived from the tags, as '<artist>/<album> (<year>)' under the music library. The tracks
+    already in the library are reported; they are also left out of the album if 'skip_duplicates'.\n
+    :param str id: names the entry in the results; defaults to its (1-based) position in the manifest
+    """
+    id = attr.ib(init=True)
+    url = attr.ib(init=True, default=None)
+    file = attr.ib(init=True, default=None)
+    tracklist = attr.ib(init=True, default=None)
+    tracklist_file = attr.ib(init=True, default=None)
+    hhmmss_type = attr.ib(init=True, default='auto')
+    artist = attr.ib(init=True, default='')
+    album_artist = attr.ib(init=True, default='')
+    album = attr.ib(init=True, default='')
+    year = attr.ib(init=True, default='')
+    track_name = attr.ib(init=True, default=True)
+    track_number = attr.ib(init=True, default=True)
+    destination = attr.ib(init=True, default=None)
+    skip_duplicates = attr.ib(init=True, default=False)
+
+    def read_tracklist(self):
+        if self.tracklist:
+            return self.tracklist
+        with open(self.tracklist_file, 'r') as f:
+            return f.read()
+
+    def destination_directory(self, music_library):
+        if self.destination:
+            return os.path.join(music_library, os.path.expanduser(self.destination))
+        album = '{} ({})'.format(self.album, self.year) if self.year else self.album
+        return os.path.join(music_library, self.artist, album)
+
+
+_fields = [x.name for x in attr.fields(ManifestEntry)]
+_flags = ('track_name', 'track_number', 'skip_duplicates')
+
+
+def load_manifest(file_path):
+    """
+    Reads the albums to create out of a json, yaml (requires PyYAML) or csv file, according to the file's extension. A json
+    or yaml manifest holds a list of objects (or an object with such a list under 'albums'), a csv one has a header row
+    naming the fields. Relative file paths in entries are resolved against the manifest's directory.\n
+    :param str file_path:
+    :rtype: list of ManifestEntry
+    """
+    extension = os.path.splitext(file_path)[1].lower()
+    with open(file_path, 'r') as f:
+        if extension == '.json':
+            records = json.load(f)
+        elif extension in ('.yaml', '.yml'):
+            try:
+                import yaml
+            except ImportError:
+                raise ManifestError("Reading yaml manifests requires PyYAML; install it with 'pip install PyYAML' or use a json or csv manifest")
+            records = yaml.safe_load(f)
+        elif extension == '.csv':
+            records = [{k: v for k, v in row.items() if v not in (None, '')} for row in csv.DictReader(f)]
+        else:
+            raise ManifestError("Unsupported manifest '{}'; expected a .json, .yaml, .yml or .csv file".format(file_path))
+    if isinstance(records, dict):
+        records = records.get('albums')
+    if not isinstance(records, list):
+        raise ManifestError("Manifest '{}' should hold a list of albums".format(file_path))
+    base_directory = os.path.dirname(os.path.abspath(file_path))
+    return [parse_entry(record, i + 1, base_directory) for i, record in enumerate(records)]
+
+
+def parse_entry(record, position, base_directory):
+    """
+    Validates a manifest record (a dictionary of ManifestEntry fields) and turns it into an entry.\n
+    :param dict record:
+    :param int position: the (1-based) position of the record; the default id of the entry
+    :param str base_directory: the directory relative file paths get resolved against
+    :rtype: ManifestEntry
+    """
+    if not isinstance(record, dict):
+        raise ManifestError("Entry {} should be a mapping of fields; got '{}'".format(position, record))
+    unknown = sorted(set(record) - set(_fields))
+    if unknown:
+        raise ManifestError("Entry {} has unknown fields [{}]; supported are [{}]".format(position, ', '.join(unknown), ', '.join(_fields)))
+    record = dict(record, id=str(record.get('id', position)))
+    for flag in _flags:
+        if isinstance(record.get(flag), str):
+            record[flag] = record[flag].strip().lower() in ('1', 'true', 'yes', 'y')
+    for name in ('file', 'tracklist_file'):
+        if record.get(name):
+            record[name] = os.path.join(base_directory, os.path.expanduser(record[name]))
+    entry = ManifestEntry(**{k: v if k in _flags else ('' if v is None else str(v)) for k, v in record.items()})
+    if bool(entry.url) == bool(entry.file):
+        raise ManifestError("Entry '{}' should give exactly one of 'url' and 'file'".format(entry.id))
+    if not entry.tracklist and not entry.tracklist_file:
+        raise ManifestError("Entry '{}' should give a 'tracklist' or a 'tracklist_file'".format(entry.id))
+    if entry.hhmmss_type not in hhmmss_types:
+        raise ManifestError("Entry '{}' has hhmmss_type '{}'; expected one of [{}]".format(entry.id, entry.hhmmss_type, ', '.join(hhmmss_types)))
+    if not entry.destination and not entry.album:
+        raise ManifestError("Entry '{}' should give a 'destination' or at least an 'album' to derive it from".format(entry.id))
+    return entry
+
+
+@attr.s
+class EntryResult(object):
+    """The outcome of creating the album of a manifest entry; stored as json"""
+    id = attr.ib(init=True)
+    status = attr.ib(init=True, default='failed')
+    album_directory = attr.ib(init=True, default=None)
+    tracks = attr.ib(init=True, default=attr.Factory(list))
+    hhmmss_type = attr.ib(init=True, default=None)
+    predicted = attr.ib(init=True, default=False)
+    duplicates = attr.ib(init=True, default=attr.Factory(list))
+    warnings = attr.ib(init=True, default=attr.Factory(list))
+    error = attr.ib(init=True, default=None)
+    elapsed = attr.ib(init=True, default=0.0)
+
+    @property
+    def succeeded(self):
+        return self.status == 'succeeded'
+
+    def save(self, results_directory):
+        with open(os.path.join(results_directory, '{}.json'.format(_safe_name(self.id))), 'w') as f:
+            json.dump(attr.asdict(self), f, indent=2)
+
+
+class BatchProcessor(object):
+    """
+    Creates albums without any interaction, out of manifest entries, by a pool of threads; downloading, segmenting and
+    decoding run in subprocesses. Each entry gets its own working directory, removed once the entry is processed. The
+    classifier (used for entries whose hh:mm:ss type is 'auto') is loaded once, in the background.\n
+    :param str music_library: the directory relative destinations are resolved against
+    :param int nb_workers: number of entries processed concurrently
+    :param bool replaygain: whether to measure the loudness of the tracks and write the ReplayGain frames
+    :param str work_directory: where the entries' working directories get created; defaults to the system's temporary directory
+    :param music_album_creation.library_index.LibraryIndex index: the index to record the albums in (and to look for duplicates);
+    defaults to one at LibraryIndex.default_file_path(), opened for the duration of a run
+    :param float timeout: seconds allowed for a download, or an ffmpeg invocation; None for no limit
+    :param float stall_timeout: seconds allowed for a download, or an ffmpeg invocation, to make no progress; None for no limit
+    """
+    def __init__(self, music_library, nb_workers=2, replaygain=True, work_directory=None, index=None, timeout=DEFAULT_TIMEOUT,
+                 stall_timeout=DEFAULT_STALL_TIMEOUT):
+        self.music_library = music_library
+        self.nb_workers = nb_workers
+        self.replaygain = replaygain
+        self.work_directory = work_directory
+        self.index = index
+        self.timeout = timeout
+        self.stall_timeout = stall_timeout
+        self._classifier = None
+        self._lock = threading.Lock()
+
+    def run(self, entries, results_directory=None):
+        """
+        :param list entries: ManifestEntry objects
+        :param str results_directory: if given, the result of each entry is stored there as '<id>.json', as soon as it is ready
+        :return: the results, in the order of the entries
+        :rtype: list of EntryResult
+        """
+        if results_directory and not os.path.isdir(results_directory):
+            os.makedirs(results_directory)
+
+        def process(entry):
+            result = self.process(entry)
+            if results_directory:
+                result.save(results_directory)
+            return result
+        from .library_index import LibraryIndex
+        owns_index = self.index is None
+        if owns_index:
+            self.index = LibraryIndex()
+        try:
+            with ThreadPoolExecutor(max_workers=self.nb_workers) as executor:
+                return list(executor.map(process, entries))
+        finally:
+            if owns_index:
+                self.index.close()
+                self.index = None
+
+    def process(self, entry, job_id=None):
+        """
+        Creates the album of a single entry; failures are reported in the result instead of being raised.\n
+        :param ManifestEntry entry:
+        :param str job_id: the job the events published while processing belong to; defaults to the entry's id
+        :rtype: EntryResult
+        """
+        result = EntryResult(entry.id)
+        start = time.time()
+        work_directory = tempfile.mkdtemp(prefix='create-album-batch-', dir=self.work_directory)
+        try:
+            with events.job(job_id or entry.id):
+                try:
+                    self._create_album(entry, work_directory, result)
+                    result.status = 'succeeded'
+                except Exception as e:  # reported per entry, so that one bad entry does not abort the batch
+                    logger.exception("Entry '{}' failed".format(entry.id))
+                    result.error = '{}: {}'.format(type(e).__name__, e)
+                    events.publish(events.ErrorOccurred, stage='album', error=result.error)
+        finally:
+            shutil.rmtree(work_directory, ignore_errors=True)
+            result.elapsed = round(time.time() - start, 3)
+        return result
+
+    def _create_album(self, entry, work_directory, result):
+        from .audio_segmentation import (AudioSegmenter,
+                                         SegmentationInformation,
+                                         TracksInformation)
+        from .metadata import MetadataDealer
+        from .pipeline import AlbumPipeline
+        from .web_parsing import video_id
+
+        # AUDIO
+        if entry.url:
+            from .music_master import MusicMaster
+            album_file = MusicMaster(self.music_library, download_dir=os.path.join(work_directory, 'download'), timeout=self.timeout,
+                                     stall_timeout=self.stall_timeout).url2mp3(entry.url)
+        else:
+            album_file = entry.file
+
+        # SEGMENTATION
+        tracks_info = TracksInformation.from_multiline(entry.read_tracklist().strip())
+        result.hhmmss_type = entry.hhmmss_type
+        if entry.hhmmss_type == 'auto':
+            with profiling.stage('classification', python=True):
+                result.hhmmss_type = 'durations' if int(self.classifier().is_durations(tracks_info.hhmmss_list)) == 1 else 'timestamps'
+            result.predicted = True
+        segmentation_info = SegmentationInformation.from_tracks_information(tracks_info, hhmmss_type=result.hhmmss_type)
+        segmenter = AudioSegmenter(target_directory=os.path.join(work_directory, 'tracks'), timeout=self.timeout,
+                                   stall_timeout=self.stall_timeout, id3_padding=MetadataDealer.id3_padding)
+        os.mkdir(segmenter.target_directory)
+        with profiling.stage('segmentation'):
+            tracks = segmenter.segment(album_file, segmentation_info, supress_stdout=True, supress_stderr=True)
+
+        # ANALYSIS, STORAGE, METADATA AND INDEXING
+        pipeline = AlbumPipeline(album_file, tracks, segmentation_info, self.index)
+        result.warnings.extend(pipeline.analyze(replaygain=self.replaygain, workspace=os.path.join(work_directory, 'pcm')))
+        result.duplicates = [{'track': os.path.basename(x.track), 'original': x.original} for x in pipeline.find_duplicates()]
+        result.album_directory = entry.destination_directory(self.music_library)
+        result.warnings.extend(pipeline.store(result.album_directory, skip_duplicates=entry.skip_duplicates))
+        result.tracks = list(pipeline.stored)
+        failed = pipeline.tag(track_number=entry.track_number, track_name=entry.track_name, artist=entry.artist,
+                              album_artist=entry.album_artist, album=entry.album, year=entry.year)
+        if failed:
+            raise TaggingError("Failed to tag [{}]".format(', '.join("'{}': {}".format(x.file, x.error) for x in failed)))
+        pipeline.index_album(video_id=video_id(entry.url) if entry.url else None)
+
+    def warm_up(self):
+        """Starts loading the classifier in the background, if not already; otherwise the first 'auto' entry loads it"""
+        with self._lock:
+            if self._classifier is None:
+                from .format_classification import FormatClassifier
+                self._classifier = FormatClassifier.warm_up()
+        return self._classifier
+
+    def classifier(self):
+        return self.warm_up().result()
+
+
+def _safe_name(name):
+    return ''.join(c if c.isalnum() or c in '-_.' else '_' for c in name)
+
+
+class ManifestError(Exception): pass
+
+
+class TaggingError(Exception): pass
+
+
+@click.command()
+@click.argument('manifest', type=click.Path(exists=True, dir_okay=False))
+@click.option('--workers', '-w', type=int, default=2, show_default=True, help="Number of albums to create concurrently.")
+@click.option('--results-dir', '-r', type=click.Path(file_okay=False), help="Directory to store the result of each entry, as '<id>.json'.  [default: 'results' next to the manifest]")
+@click.option('--library-dir', '-l', help="The music library directory relative destinations are resolved against.  [default: the MUSIC_LIB_ROOT environment variable]")
+@click.option('--replaygain/--no-replaygain', default=True, show_default=True, help="Whether to measure the loudness of the tracks and write the ReplayGain frames.")
+@click.option('--timeout', type=float, default=DEFAULT_TIMEOUT, show_default=True,
+              help="Seconds a download, or an ffmpeg invocation, may run for; 0 for no limit.")
+@click.option('--stall-timeout', type=float, default=DEFAULT_STALL_TIMEOUT, show_default=True,
+              help="Seconds a download, or an ffmpeg invocation, may make no progress for; 0 for no limit.")
+@click.option('--profile', type=click.Path(dir_okay=False), help="Write a json report of the time spent per stage and per track, the bytes moved, the subprocesses spawned and the peak memory to this file.")
+@click.option('--profile-python', is_flag=True, help="Along with the --profile report, dump cProfile statistics of the Python-side stages and the top allocations traced by tracemalloc.")
+@click.option('--events', 'events_file', type=click.File('w'), help="Stream the progress events (stages, track cuts, tags written, errors) to this file, as json lines; '-' for the standard output.")
+def main(manifest, workers, results_dir, library_dir, replaygain, timeout, stall_timeout, profile, profile_python, events_file):
+    """Creates the albums listed in MANIFEST (a .json, .yaml or .csv file), without any interaction. Exits with a non zero
+    code if any of them failed."""
+    configure_logging()
+    library_dir = library_dir or os.getenv('MUSIC_LIB_ROOT', None)
+    if library_dir is None:
+        click.echo("Please give a library directory or set the environment variable MUSIC_LIB_ROOT to point to a directory that stores music.", err=True)
+        sys.exit(2)
+    try:
+        entries = load_manifest(manifest)
+    except (ManifestError, ValueError) as e:
+        click.echo("Invalid manifest: {}".format(e), err=True)
+        sys.exit(2)
+    results_dir = results_dir or os.path.join(os.path.dirname(os.path.abspath(manifest)), 'results')
+    processor = BatchProcessor(library_dir, nb_workers=workers, replaygain=replaygain, timeout=timeout or None,
+                               stall_timeout=stall_timeout or None)
+    if events_file is not None:
+        lock = threading.Lock()
+
+        def write_event(event):
+            with lock:
+                events_file.write(json.dumps(event.to_dict()) + '\n')
+                events_file.flush()
+        events.subscribe(write_event)
+    if profile is None:
+        results = processor.run(entries, results_directory=results_dir)
+    else:
+        with profiling.Profiler(report_file=profile, python_profiling=profile_python):
+            results = processor.run(entries, results_directory=results_dir)
+    for result in results:
+        if result.succeeded:
+            click.echo("[{}] created '{}' ({} tracks, {:.1f}s)".format(result.id, result.album_directory, len(result.tracks), result.elapsed))
+        else:
+            click.echo("[{}] failed: {}".format(result.id, result.error), err=True)
+    failed = [x for x in results if not x.succeeded]
+    click.echo("Created {} of {} albums; results in '{}'".format(len(results) - len(failed), len(results), results_dir))
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,22 +2,17 @@
 
 import glob
 import os
-import shutil
 import sys
+import threading
+from contextlib import contextmanager
 from time import sleep
 
 import click
-import mutagen
-
-from . import FormatClassifier, MetadataDealer, StringParser
-from .audio_segmentation import (AudioSegmenter, SegmentationInformation,
-                                 TracksInformation)
-from .audio_segmentation.data import TrackTimestampsSequenceError
-# 'front-end', interface, interactive dialogs are imported below
-from .dialogs import DialogCommander as inout
+
+from . import configure_logging, events
 from .downloading import (InvalidUrlError, TokenParameterNotInVideoInfoError,
                           UnavailableVideoError)
-from .music_master import MusicMaster
+from .tracks_parsing import StringParser
 
 if os.name == 'nt':
     from pyreadline import Readline
@@ -26,6 +21,84 @@ if os.name == 'nt':
 this_dir = os.path.dirname(os.path.realpath(__file__))
 
 
+class _LazyDialogs(object):
+    """The 'front-end', interface, interactive dialogs; imported (along with PyInquirer) on first use"""
+    def __getattr__(self, name):
+        from .dialogs import DialogCommander
+        return getattr(DialogCommander, name)
+
+
+inout = _LazyDialogs()
+
+
+class _ConsoleProgress(object):
+    """
+    Renders the progress events of the pipeline on the terminal: the progress of the running stage, on a line of its own that
+    gets rewritten, the tracks cut and the errors that did not abort the run (ie failing to tag a file). The download's
+    progress is left to youtube-dl, which renders its own. Events published while a dialog is open (ie by the speculative
+    segmentation) are held back and rendered once it closes, so that they do not garble the dialog.\n
+    :param stream: a text stream; defaults to sys.stdout
+    """
+    types = (events.StageProgress, events.TrackCut, events.ErrorOccurred)
+
+    def __init__(self, stream=None):
+        self.stream = stream or sys.stdout
+        self._line = ''  # the progress line currently rendered, if any
+        self._held = None
+        self._lock = threading.Lock()
+
+    def __call__(self, event):
+        with self._lock:
+            if self._held is not None:
+                self._held.append(event)
+            else:
+                self._render(event)
+
+    @contextmanager
+    def holding(self):
+        """Holds back the events published in the enclosed block, ie while a dialog is open"""
+        with self._lock:
+            self._held = []
+        try:
+            yield
+        finally:
+            with self._lock:
+                held, self._held = self._held, None
+                for event in held:
+                    self._render(event)
+
+    def _render(self, event):
+        if isinstance(event, events.StageProgress):
+            if event.stage != 'download':
+                self._progress(event)
+        elif isinstance(event, events.TrackCut):
+            self._print(" Cut track '{}' ({} - {})".format(os.path.basename(event.track), _hhmmss(event.start), _hhmmss(event.end) if event.end else 'end'))
+        elif isinstance(event, events.ErrorOccurred):
+            self._print(" Failed to {} '{}': {}".format(event.stage, event.file, event.error) if event.file else " {} failed: {}".format(event.stage, event.error))
+        self.stream.flush()
+
+    def _progress(self, event):
+        eta = ', {}s left'.format(int(round(event.eta))) if event.eta and event.done < event.total else ''
+        line = ' {}: {}/{} {}s{}'.format(event.stage.capitalize(), event.done, event.total, event.unit, eta)
+        self.stream.write('\r{}'.format(line.ljust(len(self._line))))
+        self._line = line
+        if event.total <= event.done:
+            self.stream.write('\n')
+            self._line = ''
+
+    def _print(self, text):
+        """Prints a line above the progress line, which gets rendered again below it"""
+        if self._line:
+            self.stream.write('\r{}\r'.format(' ' * len(self._line)))
+        self.stream.write('{}\n'.format(text))
+        if self._line:
+            self.stream.write(self._line)
+
+
+def _hhmmss(seconds):
+    return StringParser.hhmmss_format(float(seconds))
+
+
 def music_lib_directory(verbose=True):
     music_dir = os.getenv('MUSIC_LIB_ROOT', None)
     if music_dir is None:
@@ -54,7 +127,48 @@ def music_lib_directory(verbose=True):
 @click.option('--artist', '-a', help="If given, then value shall be used as the PTE1 tag: 'Lead performer(s)/Soloist(s)'.  In the music player 'clementine' it corresponds to the 'artist' column (and not the 'Album artist column) ")
 @click.option('--album_artist', help="If given, then value shall be used as the TPE2 tag: 'Band/orchestra/accompaniment'.  In the music player 'clementine' it corresponds to the 'Album artist' column")
 @click.option('--video_url', '-u', help='the youtube video url')
-def main(tracks_info, track_name, track_number, artist, album_artist, video_url):
+@click.option('--skip-duplicates', is_flag=True, help="Do not store the tracks whose audio is already in the music library (as found by their fingerprints); by default they are only reported.")
+@click.option('--replaygain/--no-replaygain', default=True, show_default=True, help="Whether to measure the loudness of the tracks and write the ReplayGain frames, for players to normalize loudness.")
+@click.option('--timeout', type=float, default=0, help="Seconds a download, or an ffmpeg invocation, may run for.  [default: no limit]")
+@click.option('--stall-timeout', type=float, default=0,
+              help="Seconds a download, or an ffmpeg invocation, may make no progress for.  [default: no limit]")
+@click.option('--profile', type=click.Path(dir_okay=False), help="Write a json report of the time spent per stage and per track, the bytes moved, the subprocesses spawned and the peak memory to this file.")
+@click.option('--profile-python', is_flag=True, help="Along with the --profile report, dump cProfile statistics of the Python-side stages and the top allocations traced by tracemalloc.")
+def main(tracks_info, track_name, track_number, artist, album_artist, video_url, skip_duplicates, replaygain, timeout, stall_timeout,
+         profile, profile_python):
+    progress = events.subscribe(_ConsoleProgress(), types=_ConsoleProgress.types)
+    limits = {'timeout': timeout or None, 'stall_timeout': stall_timeout or None}
+    try:
+        if profile is None:
+            return _create_album(tracks_info, track_name, track_number, artist, album_artist, video_url, skip_duplicates, replaygain,
+                                 progress, limits)
+        from .profiling import Profiler
+        with Profiler(report_file=profile, python_profiling=profile_python):
+            _create_album(tracks_info, track_name, track_number, artist, album_artist, video_url, skip_duplicates, replaygain, progress,
+                          limits)
+    finally:
+        events.unsubscribe(progress)
+
+
+def _create_album(tracks_info, track_name, track_number, artist, album_artist, video_url, skip_duplicates, replaygain, progress, limits):
+    # heavy dependencies (mutagen, numpy) are imported here, so that ie 'create-album --help' does not pay for them
+    import mutagen
+
+    from .format_classification import FormatClassifier
+    from .metadata import MetadataDealer
+    from .audio_segmentation import (AudioSegmenter, SegmentationInformation,
+                                     SpeculativeSegmentation,
+                                     TracksInformation)
+    from .audio_segmentation.data import TrackTimestampsSequenceError
+    from .library_index import LibraryIndex
+    from .music_master import MusicMaster
+    from .pipeline import AlbumPipeline
+    from .profiling import stage
+    from .web_parsing import video_id
+
+    configure_logging()
+    # importing sklearn and loading the model takes seconds; it happens while the user answers the first dialogs
+    classifier = FormatClassifier.warm_up()
 
     music_dir = music_lib_directory(verbose=True)
     print("Music library: {}".format(music_dir))
@@ -67,9 +181,14 @@ def main(tracks_info, track_name, track_number, artist, album_artist, video_url)
         video_url = inout.input_youtube_url_dialog()
         print('\n')
 
+    library_index = LibraryIndex()
+    existing = library_index.album_for_video(video_id(video_url)) if video_id(video_url) else None
+    if existing is not None:
+        print("Note: this video is already in the music library, as album '{}'\n".format(existing.path))
+
     ## Init
-    music_master = MusicMaster(music_dir)
-    audio_segmenter = AudioSegmenter()
+    music_master = MusicMaster(music_dir, **limits)
+    audio_segmenter = AudioSegmenter(id3_padding=MetadataDealer.id3_padding, **limits)
 
     ## DOWNLOAD
     while 1:
@@ -100,33 +219,77 @@ def main(tracks_info, track_name, track_number, artist, album_artist, video_url)
         print()
 
     ### PREDICTION SERVICE
-    fc = FormatClassifier.load_version()
-    # fc = FormatClassifier.load(os.path.join(this_dir, "format_classification/data/model.pickle"))
-    predicted_label = fc.is_durations(tracks_info.hhmmss_list)
-    # print('Predicted class {}; 0: timestamp input, 1:duration input'.format(predicted_label))
-    answer = inout.track_information_type_dialog(prediction={1: 'durations'}.get(int(predicted_label), 'timestamps'))
-
-    segmentation_info = SegmentationInformation.from_tracks_information(tracks_info, hhmmss_type=answer.lower())
-
-    try:  # SEGMENTATION
-        audio_file_paths = audio_segmenter.segment(album_file, segmentation_info, supress_stdout=True, supress_stderr=True, sleep_seconds=0)
-    except TrackTimestampsSequenceError as e:
-        print(e)
+    with stage('classification', python=True):
+        fc = classifier.result()
+        # fc = FormatClassifier.load(os.path.join(this_dir, "format_classification/data/model.pickle"))
+        predicted_label = fc.is_durations(tracks_info.hhmmss_list)
+        # print('Predicted class {}; 0: timestamp input, 1:duration input'.format(predicted_label))
+        prediction = {1: 'durations'}.get(int(predicted_label), 'timestamps')
+
+    # start segmenting according to the prediction, while the user confirms it; the speculatively created tracks get removed
+    # once stored in the library, whether the speculation gets confirmed or not
+    with SpeculativeSegmentation(album_file, tracks_info, prediction, id3_padding=MetadataDealer.id3_padding, supress_stdout=True,
+                                 supress_stderr=True, sleep_seconds=0, **limits) as speculation:
+        with progress.holding():
+            answer = inout.track_information_type_dialog(prediction=prediction)
+
+        try:  # SEGMENTATION
+            with stage('segmentation'):
+                segmentation_info = SegmentationInformation.from_tracks_information(tracks_info, hhmmss_type=answer.lower())
+                if speculation.matches(answer):
+                    audio_file_paths = speculation.result()
+                else:
+                    speculation.discard()
+                    audio_file_paths = audio_segmenter.segment(album_file, segmentation_info, supress_stdout=True, supress_stderr=True, sleep_seconds=0)
+        except TrackTimestampsSequenceError as e:
+            print(e)
+            sys.exit(1)
+            # TODO capture ctrl-D to signal possible change of type from timestamp to durations and vice-versa...
+            # in order to put the above statement outside of while loop
+
+        durations = [StringParser.hhmmss_format(getattr(mutagen.File(t).info, 'length', 0)) for t in audio_file_paths]
+        max_row_length = max(len(_[0]) + len(_[1]) for _ in zip(audio_file_paths, durations))
+        print("\n\nThese are the tracks created.\n")
+        print('\n'.join(sorted([' {}{}  {}'.format(t, (max_row_length - len(t) - len(d)) * ' ', d) for t, d in zip(audio_file_paths, durations)])), '\n')
+
+        ### ANALYSE THE TRACKS; sliced out of the album, decoded once for both fingerprinting and measuring loudness
+        pipeline = AlbumPipeline(album_file, audio_file_paths, segmentation_info, library_index)
+        for warning in pipeline.analyze(replaygain=replaygain):
+            print(warning)
+
+        ### CHECK FOR TRACKS ALREADY IN THE LIBRARY
+        duplicates = pipeline.find_duplicates()
+        for duplicate in duplicates:
+            print(" Track '{}' is already in the library as '{}'".format(os.path.basename(duplicate.track), duplicate.original))
+        if duplicates:
+            print()
+
+        ### STORE TRACKS IN DIR in MUSIC LIBRARY ROOT
+        _store_tracks(pipeline, music_dir, music_master.guessed_info, skip_duplicates)
+
+    ### WRITE METADATA; to the stored tracks only, along with the ReplayGain frames if the loudness got measured
+    answers = inout.interactive_metadata_dialogs(**music_master.guessed_info)
+    failed = pipeline.tag(track_number=track_number, track_name=track_name, artist=answers['artist'], album_artist=answers['album-artist'],
+                          album=answers['album'], year=answers['year'])
+    if failed:  # ie files whose names could not be parsed, or that could not be written
+        print("\nFailed to tag {} files:".format(len(failed)))
+        for outcome in failed:
+            print(" '{}': {}".format(outcome.file, outcome.error))
+
+    ### RECORD THE ALBUM IN THE LIBRARY INDEX
+    with library_index:
+        pipeline.index_album(video_id=video_id(video_url))
+    if failed:
         sys.exit(1)
-        # TODO capture ctrl-D to signal possible change of type from timestamp to durations and vice-versa...
-        # in order to put the above statement outside of while loop
 
-    durations = [StringParser.hhmmss_format(getattr(mutagen.File(t).info, 'length', 0)) for t in audio_file_paths]
-    max_row_length = max(len(_[0]) + len(_[1]) for _ in zip(audio_file_paths, durations))
-    print("\n\nThese are the tracks created.\n")
-    print('\n'.join(sorted([' {}{}  {}'.format(t, (max_row_length - len(t) - len(d)) * ' ', d) for t, d in zip(audio_file_paths, durations)])), '\n')
 
-    ### STORE TRACKS IN DIR in MUSIC LIBRARY ROOT
+def _store_tracks(pipeline, music_dir, guessed_info, skip_duplicates):
+    """Asks for the album directory, until the tracks get copied into it"""
     while 1:
-        print(type(music_dir), type(music_master.guessed_info))
+        print(type(music_dir), type(guessed_info))
         print(music_dir)
-        print(music_master.guessed_info)
-        album_dir = inout.album_directory_path_dialog(music_dir, **music_master.guessed_info)
+        print(guessed_info)
+        album_dir = inout.album_directory_path_dialog(music_dir, **guessed_info)
         try:
             os.makedirs(album_dir)
         except FileExistsError:
@@ -139,23 +302,13 @@ def main(tracks_info, track_name, track_number, artist, album_artist, video_url)
             print("You don't have permision to create a directory in path '{}'".format(album_dir))
             continue
         try:
-            for track in audio_file_paths:
-                destination_file_path = os.path.join(album_dir, os.path.basename(track))
-                if os.path.isfile(destination_file_path):
-                    print(" File '{}' already exists. in '{}'. Skipping".format(os.path.basename(track), album_dir))
-                else:
-                    shutil.copyfile(track, destination_file_path)
+            for warning in pipeline.store(album_dir, skip_duplicates=skip_duplicates):
+                print(' {}'.format(warning))
             print("Album tracks reside in '{}'".format(album_dir))
-            break
+            return
         except PermissionError:
             print("Can't copy tracks to '{}' folder. You don't have write permissions in this directory".format(album_dir))
 
-    ### WRITE METADATA
-    md = MetadataDealer()
-    answers = inout.interactive_metadata_dialogs(**music_master.guessed_info)
-    md.set_album_metadata(album_dir, track_number=track_number, track_name=track_name, artist=answers['artist'],
-                          album_artist=answers['album-artist'], album=answers['album'], year=answers['year'])
-
 
 class TabCompleter:
     """A tab completer that can either complete from the filesystem or from a list."""
@@ -0,0 +1,517 @@
+import binascii
+import hmac
+import http.client
+import itertools
+import json
+import logging
+import os
+import re
+import signal
+import socket
+import socketserver
+import sys
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import attr
+import click
+
+from . import configure_logging, events
+from .batch import (DEFAULT_STALL_TIMEOUT, DEFAULT_TIMEOUT, BatchProcessor,
+                    ManifestError, load_manifest, parse_entry)
+
+logger = logging.getLogger(__name__)
+
+
+def _runtime_directory():
+    return os.getenv('XDG_RUNTIME_DIR') or os.path.join(os.path.expanduser('~'), '.cache', 'music_album_creation')
+
+
+def default_socket_path():
+    return os.path.join(_runtime_directory(), 'album-daemon.sock')
+
+
+def default_token_path():
+    """Where a daemon serving http writes the token its clients have to present"""
+    return os.path.join(_runtime_directory(), 'album-daemon.token')
+
+
+@attr.s
+class Job(object):
+    """A manifest entry submitted to the daemon, along with its state: 'queued', 'running', 'succeeded' or 'failed'"""
+    id = attr.ib(init=True)
+    entry = attr.ib(init=True)
+    status = attr.ib(init=True, default='queued')
+    submitted = attr.ib(init=True, default=attr.Factory(time.time))
+    started = attr.ib(init=True, default=None)
+    result = attr.ib(init=True, default=None)
+
+    @property
+    def done(self):
+        return self.status in ('succeeded', 'failed')
+
+    def to_dict(self):
+        return {'id': self.id, 'entry': self.entry.id, 'status': self.status, 'submitted': self.submitted, 'started': self.started,
+                'result': attr.asdict(self.result) if self.result is not None else None}
+
+
+class AlbumDaemon(object):
+    """
+    Creates albums out of jobs (manifest entries, see music_album_creation.batch) submitted over the daemon's lifetime, so
+    that the startup costs (imports, loading the classifier, opening the library index) are paid once instead of per album.
+    Jobs are queued and run by the processor's number of worker threads, in the order they were submitted. The latest
+    progress events (see music_album_creation.events) are kept, for clients to follow the jobs, and so are the latest
+    finished jobs; the older ones get dropped, so that a daemon running for long does not grow for ever.\n
+    :param BatchProcessor processor: creates the album of each job; its index is kept open while the daemon runs
+    :param int nb_events: number of latest events kept
+    :param int nb_finished_jobs: number of latest finished jobs kept (along with their results)
+    """
+    def __init__(self, processor, nb_events=10000, nb_finished_jobs=1000):
+        self.processor = processor
+        self.nb_finished_jobs = nb_finished_jobs
+        self.started = time.time()
+        self._jobs = OrderedDict()
+        self._finished = deque()  # the ids of the finished jobs kept, in the order they finished
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=processor.nb_workers)
+        self._futures = set()  # of the jobs queued or running
+        self._events = deque(maxlen=nb_events)
+        self._event_ids = itertools.count(1)
+        self._events_lock = threading.Lock()
+        events.subscribe(self._record)
+
+    def warm_up(self):
+        """Imports the modules processing a job and starts loading the classifier in the background"""
+        from . import audio_analysis, audio_segmentation, metadata, music_master  # noqa: F401
+        self.processor.warm_up()
+
+    def submit(self, records):
+        """
+        :param list records: manifest entries as dictionaries; relative file paths are resolved against the daemon's working directory
+        :return: the queued jobs, in the order of the records
+        :rtype: list of Job
+        :raises ManifestError: if any record is invalid; then no job gets queued
+        """
+        entries = [parse_entry(record, i + 1, os.getcwd()) for i, record in enumerate(records)]
+        jobs = []
+        with self._lock:
+            for entry in entries:
+                job = Job(str(next(self._ids)), entry)
+                self._jobs[job.id] = job
+                future = self._executor.submit(self._run, job)
+                self._futures.add(future)
+                future.add_done_callback(self._discard)
+                jobs.append(job)
+        logger.info("Queued jobs [{}]".format(', '.join(x.id for x in jobs)))
+        return jobs
+
+    def _run(self, job):
+        job.status, job.started = 'running', time.time()
+        job.result = self.processor.process(job.entry, job_id=job.id)
+        job.status = job.result.status
+        logger.info("Job '{}' {} in {:.1f}s".format(job.id, job.status, job.result.elapsed))
+        with self._lock:
+            self._finished.append(job.id)
+            while self.nb_finished_jobs < len(self._finished):
+                del self._jobs[self._finished.popleft()]
+
+    def _discard(self, future):
+        with self._lock:
+            self._futures.discard(future)
+
+    def job(self, job_id):
+        return self._jobs.get(job_id)
+
+    def _record(self, event):
+        with self._events_lock:
+            self._events.append(dict(event.to_dict(), id=next(self._event_ids)))
+
+    def events(self, since=0):
+        """The kept events (as dictionaries) with an id greater than 'since'; ids increase by one per event"""
+        with self._events_lock:
+            return [x for x in self._events if since < x['id']]
+
+    def jobs(self):
+        with self._lock:
+            return list(self._jobs.values())
+
+    def status(self):
+        counts = OrderedDict((x, 0) for x in ('queued', 'running', 'succeeded', 'failed'))
+        for job in self.jobs():
+            counts[job.status] += 1
+        classifier = self.processor.warm_up()
+        return {'pid': os.getpid(), 'uptime': round(time.time() - self.started, 3), 'workers': self.processor.nb_workers,
+                'classifier_loaded': classifier.done() and classifier.exception() is None, 'jobs': counts}
+
+    def close(self):
+        """Drops the jobs still queued and waits for the running ones to finish"""
+        events.unsubscribe(self._record)
+        with self._lock:
+            futures = list(self._futures)
+        for future in futures:
+            future.cancel()
+        self._executor.shutdown(wait=True)
+
+
+class _RequestHandler(BaseHTTPRequestHandler):
+    """
+    The daemon's json API:
+      GET /status, GET /jobs, GET /jobs/<id>, GET /events?since=<event id>, POST /jobs (a manifest entry or a list of them)
+      and POST /shutdown
+    POST requests have to be of Content-Type 'application/json', which a web page can not send without the browser asking
+    for permission first. Over http, every request has to carry the daemon's token as 'Authorization: Bearer <token>'.
+    """
+    _job_path = re.compile(r'^/jobs/([^/]+)$')
+    _events_path = re.compile(r'^/events(?:\?since=(\d+))?$')
+
+    def do_GET(self):
+        if not self._authorized():
+            return
+        daemon = self.server.album_daemon
+        match = self._job_path.match(self.path)
+        events_match = self._events_path.match(self.path)
+        if self.path == '/status':
+            self._reply(200, daemon.status())
+        elif events_match:
+            self._reply(200, daemon.events(since=int(events_match.group(1) or 0)))
+        elif self.path == '/jobs':
+            self._reply(200, [x.to_dict() for x in daemon.jobs()])
+        elif match and daemon.job(match.group(1)):
+            self._reply(200, daemon.job(match.group(1)).to_dict())
+        else:
+            self._reply(404, {'error': "No resource '{}'".format(self.path)})
+
+    def do_POST(self):
+        if not self._authorized():
+            return
+        if self.headers.get_content_type() != 'application/json':
+            self._reply(415, {'error': "Expected a request of Content-Type 'application/json'"})
+            return
+        if self.path == '/shutdown':
+            self._reply(202, {'status': 'stopping'})
+            threading.Thread(target=self.server.shutdown).start()
+        elif self.path == '/jobs':
+            try:
+                body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf-8'))
+                jobs = self.server.album_daemon.submit(body if isinstance(body, list) else [body])
+            except (ValueError, ManifestError) as e:
+                self._reply(400, {'error': str(e)})
+            else:
+                self._reply(202, [x.to_dict() for x in jobs])
+        else:
+            self._reply(404, {'error': "No resource '{}'".format(self.path)})
+
+    def _authorized(self):
+        token = self.server.token
+        if token is None:  # ie on the unix socket, which only the user can access
+            return True
+        expected = 'Bearer {}'.format(token).encode('utf-8')
+        if hmac.compare_digest(self.headers.get('Authorization', '').encode('utf-8'), expected):
+            return True
+        self._reply(401, {'error': "Missing or wrong token; see the daemon's token file"})
+        return False
+
+    def _reply(self, code, data):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+
+class _HTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def get_request(self):
+        request, _ = super(_UnixHTTPServer, self).get_request()
+        return request, ('local', 0)
+
+
+def make_server(album_daemon, socket_path=None, port=None, token_file=None):
+    """
+    Creates the server of the daemon's API; listening on 127.0.0.1 if a port is given, otherwise on a unix socket, only
+    accessible by the user. Since any local user (or process) can reach 127.0.0.1, serving http requires a token: a new one
+    gets written in a file only the user can read, for the clients to present.\n
+    :param AlbumDaemon album_daemon:
+    :param str socket_path: defaults to default_socket_path()
+    :param int port:
+    :param str token_file: where to write the token, when serving http; defaults to default_token_path()
+    :rtype: socketserver.BaseServer
+    """
+    token = None
+    if port is not None:
+        token_file = token_file or default_token_path()
+        token = _write_token(token_file)
+        server = _HTTPServer(('127.0.0.1', port), _RequestHandler)
+        server.token_file = token_file
+    else:
+        socket_path = socket_path or default_socket_path()
+        if os.path.exists(socket_path):
+            try:
+                DaemonClient(socket_path=socket_path).status()
+            except DaemonError:
+                os.remove(socket_path)  # left behind by a daemon that did not exit cleanly
+            else:
+                raise DaemonError("A daemon is already listening on '{}'".format(socket_path))
+        if not os.path.isdir(os.path.dirname(os.path.abspath(socket_path))):
+            os.makedirs(os.path.dirname(os.path.abspath(socket_path)))
+        umask = os.umask(0o177)
+        try:
+            server = _UnixHTTPServer(socket_path, _RequestHandler)
+        finally:
+            os.umask(umask)
+    server.album_daemon = album_daemon
+    server.token = token
+    return server
+
+
+def _write_token(token_file):
+    """Writes a new random token in a file readable and writable by the user only"""
+    token = binascii.hexlify(os.urandom(32)).decode('ascii')
+    if not os.path.isdir(os.path.dirname(os.path.abspath(token_file))):
+        os.makedirs(os.path.dirname(os.path.abspath(token_file)))
+    if os.path.lexists(token_file):
+        os.remove(token_file)
+    with os.fdopen(os.open(token_file, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600), 'w') as f:
+        f.write(token)
+    return token
+
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, socket_path, timeout=None):
+        super(_UnixHTTPConnection, self).__init__('localhost', timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+class DaemonClient(object):
+    """
+    Talks to a running daemon over its unix socket or, if a port is given, over http on 127.0.0.1.\n
+    :param str socket_path: defaults to default_socket_path()
+    :param int port:
+    :param float timeout: seconds to wait for each reply
+    :param str token_file: the file the daemon wrote its token in, when serving http; defaults to default_token_path()
+    """
+    def __init__(self, socket_path=None, port=None, timeout=30.0, token_file=None):
+        self.socket_path = socket_path or default_socket_path()
+        self.port = port
+        self.timeout = timeout
+        self.token_file = token_file or default_token_path()
+
+    def submit(self, records):
+        """Queues the given manifest entries (dictionaries) as jobs; returns the jobs as dictionaries"""
+        return self._request('POST', '/jobs', records)
+
+    def submit_manifest(self, file_path):
+        """Queues the entries of a manifest file; see music_album_creation.batch.load_manifest"""
+        return self.submit([attr.asdict(x) for x in load_manifest(file_path)])
+
+    def job(self, job_id):
+        return self._request('GET', '/jobs/{}'.format(job_id))
+
+    def jobs(self):
+        return self._request('GET', '/jobs')
+
+    def status(self):
+        return self._request('GET', '/status')
+
+    def events(self, since=0):
+        """The events the daemon kept (as dictionaries) with an id greater than 'since'"""
+        return self._request('GET', '/events?since={}'.format(since))
+
+    def shutdown(self):
+        return self._request('POST', '/shutdown')
+
+    def wait(self, job_ids, interval=0.5, timeout=None):
+        """
+        Polls the daemon until the given jobs are done.\n
+        :param list job_ids:
+        :param float interval: seconds between polls
+        :param float timeout: seconds to wait in total; None for no limit
+        :return: the finished jobs, in the order of the ids
+        :rtype: list
+        """
+        start, pending, finished = time.time(), list(job_ids), {}
+        while pending:
+            for job_id in list(pending):
+                job = self.job(job_id)
+                if job['status'] in ('succeeded', 'failed'):
+                    finished[job_id] = job
+                    pending.remove(job_id)
+            if pending:
+                if timeout is not None and timeout < time.time() - start:
+                    raise DaemonError("Jobs [{}] not done after {} seconds".format(', '.join(pending), timeout))
+                time.sleep(interval)
+        return [finished[x] for x in job_ids]
+
+    def _request(self, method, path, data=None):
+        headers = {'Content-Type': 'application/json'}
+        if self.port is not None:
+            headers['Authorization'] = 'Bearer {}'.format(self._token())
+            connection = http.client.HTTPConnection('127.0.0.1', self.port, timeout=self.timeout)
+        else:
+            connection = _UnixHTTPConnection(self.socket_path, timeout=self.timeout)
+        try:
+            body = json.dumps(data).encode('utf-8') if data is not None else None
+            connection.request(method, path, body=body, headers=headers)
+            response = connection.getresponse()
+            reply = json.loads(response.read().decode('utf-8'))
+        except (OSError, http.client.HTTPException, ValueError) as e:
+            raise DaemonError("Could not reach the daemon at '{}': {}".format(self._address(), e))
+        finally:
+            connection.close()
+        if 400 <= response.status:
+            raise DaemonError(reply.get('error', response.reason))
+        return reply
+
+    def _token(self):
+        try:
+            with open(self.token_file, 'r') as f:
+                return f.read().strip()
+        except (IOError, OSError) as e:
+            raise DaemonError("Could not read the daemon's token from '{}': {}".format(self.token_file, e))
+
+    def _address(self):
+        return 'http://127.0.0.1:{}'.format(self.port) if self.port is not None else self.socket_path
+
+
+class DaemonError(Exception): pass
+
+
+@click.group()
+@click.option('--socket', '-s', 'socket_path', type=click.Path(dir_okay=False), help="The daemon's unix socket.  [default: {}]".format(default_socket_path()))
+@click.option('--port', '-p', type=int, help="Serve (or connect to) http on 127.0.0.1 at this port, instead of a unix socket.")
+@click.option('--token-file', type=click.Path(dir_okay=False), help="Where the daemon writes (and clients read) the token required over http.  [default: {}]".format(default_token_path()))
+@click.pass_context
+def main(ctx, socket_path, port, token_file):
+    """Creates albums in a long-running daemon, which keeps the classifier and the library index loaded between jobs."""
+    ctx.obj = {'socket_path': socket_path, 'port': port, 'token_file': token_file}
+
+
+@main.command()
+@click.option('--library-dir', '-l', help="The music library directory relative destinations are resolved against.  [default: the MUSIC_LIB_ROOT environment variable]")
+@click.option('--workers', '-w', type=int, default=2, show_default=True, help="Number of albums to create concurrently.")
+@click.option('--replaygain/--no-replaygain', default=True, show_default=True, help="Whether to measure the loudness of the tracks and write the ReplayGain frames.")
+@click.option('--timeout', type=float, default=DEFAULT_TIMEOUT, show_default=True,
+              help="Seconds a download, or an ffmpeg invocation, may run for; 0 for no limit.")
+@click.option('--stall-timeout', type=float, default=DEFAULT_STALL_TIMEOUT, show_default=True,
+              help="Seconds a download, or an ffmpeg invocation, may make no progress for; 0 for no limit.")
+@click.option('--finished-jobs', type=int, default=1000, show_default=True, help="Number of latest finished jobs the daemon keeps.")
+@click.pass_obj
+def serve(obj, library_dir, workers, replaygain, timeout, stall_timeout, finished_jobs):
+    """Runs the daemon, until stopped or terminated."""
+    configure_logging()
+    library_dir = library_dir or os.getenv('MUSIC_LIB_ROOT', None)
+    if library_dir is None:
+        click.echo("Please give a library directory or set the environment variable MUSIC_LIB_ROOT to point to a directory that stores music.", err=True)
+        sys.exit(2)
+    from .library_index import LibraryIndex
+    with LibraryIndex() as index:
+        processor = BatchProcessor(library_dir, nb_workers=workers, replaygain=replaygain, index=index, timeout=timeout or None,
+                                   stall_timeout=stall_timeout or None)
+        album_daemon = AlbumDaemon(processor, nb_finished_jobs=finished_jobs)
+        album_daemon.warm_up()
+        try:
+            server = make_server(album_daemon, socket_path=obj['socket_path'], port=obj['port'], token_file=obj['token_file'])
+        except DaemonError as e:
+            click.echo(str(e), err=True)
+            sys.exit(1)
+        signal.signal(signal.SIGTERM, lambda *args: threading.Thread(target=server.shutdown).start())
+        address = 'http://127.0.0.1:{}'.format(obj['port']) if obj['port'] is not None else server.server_address
+        click.echo("Listening on {}".format(address))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            os.remove(server.server_address if obj['port'] is None else server.token_file)
+            album_daemon.close()
+
+
+@main.command()
+@click.argument('manifest', type=click.Path(exists=True, dir_okay=False))
+@click.option('--wait', is_flag=True, help="Wait for the jobs to finish; then exit with a non zero code if any of them failed.")
+@click.pass_obj
+def submit(obj, manifest, wait):
+    """Queues the albums listed in MANIFEST (a .json, .yaml or .csv file)."""
+    client = DaemonClient(socket_path=obj['socket_path'], port=obj['port'], token_file=obj['token_file'])
+    try:
+        jobs = client.submit_manifest(manifest)
+        for job in jobs:
+            click.echo("Job {} queued (entry '{}')".format(job['id'], job['entry']))
+        if wait:
+            jobs = client.wait([x['id'] for x in jobs])
+            for job in jobs:
+                click.echo("Job {} {}{}".format(job['id'], job['status'], ': {}'.format(job['result']['error']) if job['result']['error'] else ''))
+    except (ManifestError, DaemonError) as e:
+        click.echo(str(e), err=True)
+        sys.exit(2)
+    if wait and any(x['status'] == 'failed' for x in jobs):
+        sys.exit(1)
+
+
+@main.command()
+@click.argument('job_ids', nargs=-1)
+@click.pass_obj
+def status(obj, job_ids):
+    """Prints (as json) the daemon's status or, if JOB_IDS are given, the status and result of these jobs."""
+    client = DaemonClient(socket_path=obj['socket_path'], port=obj['port'], token_file=obj['token_file'])
+    try:
+        click.echo(json.dumps([client.job(x) for x in job_ids] if job_ids else client.status(), indent=2))
+    except DaemonError as e:
+        click.echo(str(e), err=True)
+        sys.exit(2)
+
+
+@main.command('events')
+@click.option('--follow', '-f', is_flag=True, help="Keep printing new events, until interrupted.")
+@click.option('--since', type=int, default=0, show_default=True, help="Only print the events with a greater id.")
+@click.pass_obj
+def print_events(obj, follow, since):
+    """Prints the daemon's progress events (stages, track cuts, tags written, errors), as json lines."""
+    client = DaemonClient(socket_path=obj['socket_path'], port=obj['port'], token_file=obj['token_file'])
+    try:
+        while True:
+            for event in client.events(since=since):
+                click.echo(json.dumps(event))
+                since = event['id']
+            if not follow:
+                break
+            time.sleep(0.5)
+    except DaemonError as e:
+        click.echo(str(e), err=True)
+        sys.exit(2)
+    except KeyboardInterrupt:
+        pass
+
+
+@main.command()
+@click.pass_obj
+def stop(obj):
+    """Stops the daemon, once the running jobs finish; queued jobs are dropped."""
+    try:
+        DaemonClient(socket_path=obj['socket_path'], port=obj['port'], token_file=obj['token_file']).shutdown()
+    except DaemonError as e:
+        click.echo(str(e), err=True)
+        sys.exit(2)
+
+
+if __name__ == '__main__':
+    main()
@@ -3,7 +3,10 @@ import re
 import subprocess
 import sys
 from abc import ABCMeta, abstractmethod
-from time import sleep
+from time import sleep, time
+
+from . import events
+from .process_watchdog import ProcessWatchdog
 
 logger = logging.getLogger(__name__)
 
@@ -61,13 +64,18 @@ class CMDYoutubeDownloader(AbstractYoutubeDL):
     _args = ['youtube-dl', '--extract-audio', '--audio-quality', '0', '--audio-format', 'mp3', '-o', '%(title)s.%(ext)s']
     __instance = None
 
+    # seconds allowed for a whole download and for a period without any progress (None means no limit); can be overridden
+    # per call with the 'timeout' and 'stall_timeout' keyword arguments
+    timeout = None
+    stall_timeout = None
+
     def __new__(cls, *args, **kwargs):
         if not cls.__instance:
             cls.__instance = super(CMDYoutubeDownloader, cls).__new__(cls)
         return cls.__instance
 
     def download(self, video_url, directory, suppress_certificate_validation=False, **kwargs):
-        self._download(video_url, directory, suppress_certificate_validation=suppress_certificate_validation)
+        self._download(video_url, directory, suppress_certificate_validation=suppress_certificate_validation, **kwargs)
 
     @classmethod
     def _download(cls, video_url, directory, **kwargs):
@@ -77,8 +85,11 @@ class CMDYoutubeDownloader(AbstractYoutubeDL):
         if kwargs.get('suppress_certificate_validation', False):
             args.insert(1, '--no-check-certificate')
         logger.info("Executing '{}'".format(' '.join(args)))
-        process = subprocess.Popen(args, stderr=subprocess.PIPE)  # stdout gets streamed in terminal
-        stdout, stderr = process.communicate()
+        watchdog = ProcessWatchdog(timeout=kwargs.get('timeout', cls.timeout), stall_timeout=kwargs.get('stall_timeout', cls.stall_timeout))
+        # stdout gets streamed in terminal; raises a SubprocessWatchdogError if the download times out or stalls
+        progress = _DownloadProgress() if events.bus.subscribed else None
+        process = watchdog.run(args, capture_stderr=True, echo_stdout=True, on_stdout=events.bind(progress.feed) if progress else None)
+        stderr = process.stderr
         if process.returncode != 0:
             if 2 < sys.version_info[0]:
                 stderr = str(stderr, encoding='utf-8')
@@ -99,6 +110,23 @@ class CMDYoutubeDownloader(AbstractYoutubeDL):
         self.download(video_url, directory, **kwargs)
 
 
+class _DownloadProgress(object):
+    """Parses youtube-dl's progress lines (ie '[download]  45.3% of 5.40MiB at 1.20MiB/s ETA 00:03') into StageProgress events"""
+    reg = re.compile(r'\[download\]\s+(\d+(?:\.\d+)?)%')
+
+    def __init__(self):
+        self._start = time()
+        self._buffer = ''
+
+    def feed(self, chunk):
+        lines = re.split(r'[\r\n]', self._buffer + chunk.decode('utf-8', 'replace'))
+        self._buffer = lines.pop()
+        for line in lines:
+            match = self.reg.search(line)
+            if match:
+                events.publish(events.StageProgress, stage='download', done=float(match.group(1)), total=100.0, unit='%', elapsed=time() - self._start)
+
+
 class YoutubeDownloaderErrorFactory(object):
     @staticmethod
     def create_with_message(msg):
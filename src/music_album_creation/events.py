@@ -0,0 +1,227 @@
+import logging
+import threading
+import time
+from collections import deque
+
+import attr
+
+logger = logging.getLogger(__name__)
+
+
+@attr.s(frozen=True)
+class Event(object):
+    """
+    Base of the events published while creating albums. Each event carries the id of the job (ie the manifest entry) it
+    belongs to, if any, and the time it happened at.\n
+    :param str job:
+    :param float timestamp: seconds since the epoch
+    """
+    job = attr.ib(kw_only=True, default=None)
+    timestamp = attr.ib(kw_only=True, default=attr.Factory(time.time))
+
+    def to_dict(self):
+        return dict(attr.asdict(self), type=type(self).__name__)
+
+
+@attr.s(frozen=True)
+class StageStarted(Event):
+    """A stage (ie 'download', 'segmentation', 'tagging') started; 'info' holds its details, ie the track of a 'cut'"""
+    stage = attr.ib(init=True)
+    info = attr.ib(init=True, default=attr.Factory(dict))
+
+
+@attr.s(frozen=True)
+class StageProgress(Event):
+    """
+    A running stage completed 'done' out of 'total' units (ie tracks, or percent of a download), 'elapsed' seconds after it
+    started.
+    """
+    stage = attr.ib(init=True)
+    done = attr.ib(init=True)
+    total = attr.ib(init=True)
+    unit = attr.ib(init=True)
+    elapsed = attr.ib(init=True)
+
+    @property
+    def rate(self):
+        """Units per second so far"""
+        return self.done / self.elapsed if 0 < self.elapsed else None
+
+    @property
+    def eta(self):
+        """Estimated seconds until the stage completes, at the rate so far"""
+        return (self.total - self.done) / self.rate if self.rate else None
+
+
+@attr.s(frozen=True)
+class StageFinished(Event):
+    """A stage finished, after 'elapsed' seconds; 'error' is the name of the exception it raised, if it failed"""
+    stage = attr.ib(init=True)
+    elapsed = attr.ib(init=True)
+    error = attr.ib(init=True, default=None)
+
+
+@attr.s(frozen=True)
+class TrackCut(Event):
+    """ffmpeg cut 'track' out of the album file, from 'start' to 'end' (None for the end of the album)"""
+    track = attr.ib(init=True)
+    start = attr.ib(init=True)
+    end = attr.ib(init=True)
+    size = attr.ib(init=True)
+    elapsed = attr.ib(init=True)
+
+
+@attr.s(frozen=True)
+class TagWritten(Event):
+    """Metadata got written to 'file'; 'changes' lists the frames changed by an incremental write (None for a full write)"""
+    file = attr.ib(init=True)
+    changes = attr.ib(init=True, default=None)
+
+
+@attr.s(frozen=True)
+class ErrorOccurred(Event):
+    """An error that did not abort the run; ie failing to tag a file, or a batch entry failing"""
+    stage = attr.ib(init=True)
+    error = attr.ib(init=True)
+    file = attr.ib(init=True, default=None)
+
+
+class EventBus(object):
+    """
+    Delivers events to subscribers, as callbacks (called in the publishing thread, so they should return quickly) or as
+    iterators (see 'events'). Publishing with no subscribers costs a single check; the event does not even get created.
+    """
+    def __init__(self):
+        self._subscribers = ()
+        self._lock = threading.Lock()
+
+    @property
+    def subscribed(self):
+        return bool(self._subscribers)
+
+    def subscribe(self, callback, types=(Event,)):
+        """
+        :param callable callback: called with each published Event
+        :param tuple types: the Event classes of interest
+        :return: the callback, to unsubscribe with
+        """
+        with self._lock:
+            self._subscribers = self._subscribers + ((callback, tuple(types)),)
+        return callback
+
+    def unsubscribe(self, callback):
+        with self._lock:
+            self._subscribers = tuple(x for x in self._subscribers if x[0] != callback)
+
+    def events(self, types=(Event,), max_size=10000):
+        """
+        Subscribes an iterator over the events published from now on, until it is closed; use it as a context manager.\n
+        :param tuple types: the Event classes of interest
+        :param int max_size: number of undelivered events kept; the oldest get dropped beyond it
+        :rtype: EventStream
+        """
+        return EventStream(self, types=types, max_size=max_size)
+
+    def publish(self, event_class, **fields):
+        """
+        Creates and delivers an event, unless nobody is subscribed. The event belongs to the job of the current thread (see
+        'job'), unless given.\n
+        :param type event_class: an Event subclass
+        :param fields: the event's fields
+        """
+        subscribers = self._subscribers
+        if not subscribers:
+            return
+        fields.setdefault('job', current_job())
+        event = event_class(**fields)
+        for callback, types in subscribers:
+            if isinstance(event, types):
+                try:
+                    callback(event)
+                except Exception as e:  # a faulty subscriber should not break the pipeline
+                    logger.error("Event subscriber {} failed on {}: {}".format(callback, event, e))
+
+
+class EventStream(object):
+    """An iterator over published events, fed by a subscription of its own; iteration ends once closed"""
+    _closed = object()
+
+    def __init__(self, bus, types=(Event,), max_size=10000):
+        self._bus = bus
+        self._queue = deque(maxlen=max_size)
+        self._condition = threading.Condition()
+        bus.subscribe(self._put, types=types)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __iter__(self):
+        while True:
+            event = self.get()
+            if event is self._closed:
+                return
+            yield event
+
+    def get(self, timeout=None):
+        """The next event; None if none got published within the timeout"""
+        with self._condition:
+            if not self._queue and not self._condition.wait_for(lambda: self._queue, timeout=timeout):
+                return None
+            event = self._queue[0]
+            if event is not self._closed:
+                self._queue.popleft()
+            return event
+
+    def close(self):
+        self._bus.unsubscribe(self._put)
+        self._put(self._closed)
+
+    def _put(self, event):
+        with self._condition:
+            self._queue.append(event)
+            self._condition.notify_all()
+
+
+_context = threading.local()
+
+
+def current_job():
+    """The id of the job the current thread works on; see 'job'"""
+    return getattr(_context, 'job', None)
+
+
+class job(object):
+    """Context manager, under which the events published by the current thread belong to the given job id"""
+    def __init__(self, job_id):
+        self.job_id = job_id
+
+    def __enter__(self):
+        self._previous = current_job()
+        _context.job = self.job_id
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        _context.job = self._previous
+
+
+def bind(function):
+    """Wraps a function so that, when called by another thread (ie of a pool), its events belong to the caller's job"""
+    job_id = current_job()
+    if job_id is None:
+        return function
+
+    def bound(*args, **kwargs):
+        with job(job_id):
+            return function(*args, **kwargs)
+    return bound
+
+
+# the bus the pipeline components publish to
+bus = EventBus()
+subscribe = bus.subscribe
+unsubscribe = bus.unsubscribe
+events = bus.events
+publish = bus.publish
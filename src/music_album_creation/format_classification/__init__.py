@@ -1,3 +1,4 @@
-from .tracks_format_classifier import FormatClassifier, dataset_handler
+from .tracks_format_classifier import (BatchPrediction, FormatClassifier,
+                                       dataset_handler)
 
-__all__ = ['FormatClassifier', 'dataset_handler']
+__all__ = ['FormatClassifier', 'BatchPrediction', 'dataset_handler']
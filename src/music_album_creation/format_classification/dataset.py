@@ -1,12 +1,15 @@
 import glob
+import json
 import os
 import re
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from random import shuffle
 from warnings import warn
 
-import mutagen
+import numpy as np
 from music_album_creation.tracks_parsing import StringParser
-from tqdm import tqdm
 
 sp = StringParser()
 
@@ -15,43 +18,55 @@ class DatasetHandler(object):
     __instance = None
     splits = ['train', 'dev', 'test']
     post_fix = '-split.txt'
-    reg = r'^(\w+)-split\.txt$'  # reg to search in a directory expecting dataet files with names ending with '-split.txt'
+    binary_post_fix = '-split.npy'  # a numpy structured array with a 'features' (vector) and a 'label' field per datapoint
+    reg = r'^(\w+)-split\.(?:txt|npy)$'  # reg to search in a directory expecting dataet files with names ending with '-split.txt' or '-split.npy'
 
     def __new__(cls, *args, **kwargs):
         if not cls.__instance:
             cls.__instance = super(cls, DatasetHandler).__new__(cls)
-        dir_requested = kwargs['datasets_root_dir']
         if 'datasets_root_dir' in kwargs and bool(kwargs['datasets_root_dir']):
-            c_globe = glob.glob('{}/*{}'.format(kwargs['datasets_root_dir'], cls.post_fix))
-            try:
-                cls.__instance._datasets = {re.match(cls.reg, os.path.basename(file)).group(1): file for file in c_globe}
-            except AttributeError:
-                raise RuntimeError("Unable to find datasets (txt files) in directory '{}'. Most probably one of [{}] did not match with regex '{}'.".format(dir_requested, ', '.join(str(_) for _ in c_globe), cls.reg))
             cls.__instance.datasets_root_dir = kwargs['datasets_root_dir']
         return cls.__instance
 
+    @property
+    def datasets(self):
+        """The dataset split files found in the datasets directory, by split name. The directory is scanned on every access."""
+        c_globe = sorted(glob.glob('{}/*{}'.format(self.datasets_root_dir, self.post_fix))) + sorted(glob.glob('{}/*{}'.format(self.datasets_root_dir, self.binary_post_fix)))
+        try:  # the binary files, listed last, take precedence
+            return {re.match(self.reg, os.path.basename(file)).group(1): file for file in c_globe}
+        except AttributeError:
+            raise RuntimeError("Unable to find datasets (txt or npy files) in directory '{}'. Most probably one of [{}] did not match with regex '{}'.".format(self.datasets_root_dir, ', '.join(str(_) for _ in c_globe), self.reg))
+
     @classmethod
     def get_instance(cls, datasets_root_dir=''):
         return DatasetHandler(datasets_root_dir=datasets_root_dir)
 
-    def create_split(self, split, album_dirs, progress_bar=False):
+    def create_split(self, split, album_dirs, progress_bar=False, nb_processes=None, cache=None, binary=True):
         if progress_bar:
-            gen = tqdm(new_gen(album_dirs), total=len(album_dirs) * 2, unit='datapoint')
+            from tqdm import tqdm
+            gen = tqdm(new_gen(album_dirs, nb_processes=nb_processes, cache=cache), total=len(album_dirs) * 2, unit='datapoint')
         else:
-            gen = new_gen(album_dirs)
-        with open(os.path.join(self.datasets_root_dir, '{}{}'.format(split, self.post_fix)), 'w') as f:
-            f.write('\n'.join('{} {}'.format(' '.join(str(el) for el in v), str(c)) for v, c in gen) + '\n')
+            gen = new_gen(album_dirs, nb_processes=nb_processes, cache=cache)
+        feature_vectors, labels = [], []
+        for v, c in gen:
+            feature_vectors.append(v)
+            labels.append(c)
+        self.save_dataset(self.split_path(split, binary=binary), feature_vectors, labels)
+
+    def split_path(self, split, binary=True):
+        return os.path.join(self.datasets_root_dir, '{}{}'.format(split, self.binary_post_fix if binary else self.post_fix))
 
     @staticmethod
     def feature_vector(hhmmss_list):
         return [StringParser.to_seconds(hhmmss_list[0])]
 
-    def set_dataset_split(self, split, feature_vectors, labels):
+    def set_dataset_split(self, split, feature_vectors, labels, binary=True):
         """
         Call this method to set a split {train, dev, test} with the input datapoints (feature vectors) and labels. Overwrites on disk if split found already.\n
         :param split:
         :param feature_vectors:
         :param labels:
+        :param bool binary: whether to store the split as a '.npy' file (or as a '.txt' file)
         :return:
         """
         if split not in self.splits:
@@ -59,14 +74,16 @@ class DatasetHandler(object):
         if not os.path.isdir(self.datasets_root_dir):
             raise RuntimeError("No dedicated datasets directory found. Currently the 'datasets_root_dir' attribute is set to '{}'. Either manually "
                                "create the directory or use as DatasetHandler.get_instance(datasets_root_dir=your_valid_datasets_directory)".format(self.datasets_root_dir))
-        self.save_dataset(os.path.join(self.datasets_root_dir, '{}{}'.format(split, self.post_fix)), feature_vectors, labels)
+        self.save_dataset(self.split_path(split, binary=binary), feature_vectors, labels)
 
     @staticmethod
-    def create_datapoints(album_dirs_list, nb_datapoints=None, progress_bar=False, class_ratio=0.5):
+    def create_datapoints(album_dirs_list, nb_datapoints=None, progress_bar=False, class_ratio=0.5, nb_processes=None, cache=None):
         """
         Creates datapoints with their corresponding features (currently single element vectors) and labels
         :param album_dirs_list:
         :param class_ratio:
+        :param int nb_processes: number of processes reading the durations of the audio files not found in the cache
+        :param DurationCache cache: the cache of audio file durations; defaults to the one in the user's cache directory
         :return:
         """
         feature_vectors = []
@@ -74,32 +91,42 @@ class DatasetHandler(object):
         i = 0
         if nb_datapoints and type(nb_datapoints) != int:
             raise RuntimeError("Wrong type of 'nb_datapoints' parameter. It should either be an integer (to indicate number of datapoints to pick) or evaluate to False (to indicate taking all available datapoints). Instead '{}' was given".format(nb_datapoints))
+        datapoints = new_gen(album_dirs_list, nb_processes=nb_processes, cache=cache)
         if progress_bar:
+            from tqdm import tqdm
             if not nb_datapoints:
-                gen = tqdm(new_gen(album_dirs_list), total=len(album_dirs_list) * 2, unit='datapoint')
+                gen = tqdm(datapoints, total=len(album_dirs_list) * 2, unit='datapoint')
             else:
-                gen = tqdm(new_gen(album_dirs_list), total=nb_datapoints, unit='datapoint')
+                gen = tqdm(datapoints, total=nb_datapoints, unit='datapoint')
         else:
-            gen = new_gen(album_dirs_list)
+            gen = datapoints
         for i, datapoint in enumerate(gen):
             feature_vectors.append(datapoint[0])  # feature vector
             class_labels.append(datapoint[1])  # class label
             if nb_datapoints is not None and i == nb_datapoints - 1:
                 break
+        datapoints.close()  # stops reading the durations of albums not needed
         if nb_datapoints and i < nb_datapoints - 1:
             warn("Requested {} datapoints but the {} albums available produced {}".format(nb_datapoints, len(album_dirs_list), len(feature_vectors)))
         return feature_vectors, class_labels
 
     def load_dataset_split(self, split):
-        return self.load_dataset(os.path.join(self.datasets_root_dir, '{}{}'.format(split, self.post_fix)))
+        """Loads a split, preferring its binary ('.npy') file over the text one"""
+        if os.path.isfile(self.split_path(split, binary=True)):
+            return self.load_dataset(self.split_path(split, binary=True))
+        return self.load_dataset(self.split_path(split, binary=False))
 
     @staticmethod
     def load_dataset(file_path):
         """
+        Loads a '.npy' file as memory mapped (read only) arrays, without copying or parsing any data; '.txt' files as lists.\n
         :param file_path:
-        :return: a list of feature vectors and a list of class labels. Assumes a single label per vector
-        :rtype: tuple
+        :return: the feature vectors and the class labels. Assumes a single label per vector
+        :rtype: list
         """
+        if file_path.endswith('.npy'):
+            data = np.load(file_path, mmap_mode='r')
+            return [data['features'], data['label']]
         with open(file_path, 'r') as f:
             rows = f.readlines()
         return [list(_) for _ in zip(*list([(_[:-1], _[-1]) for _ in [list(map(float, r.split(' '))) for r in rows]]))]
@@ -111,6 +138,13 @@ class DatasetHandler(object):
 
     @staticmethod
     def save_dataset(file_path, feature_vectors, class_labels):
+        if file_path.endswith('.npy'):
+            feature_vectors = np.asarray(feature_vectors, dtype=np.float64)
+            data = np.empty(len(class_labels), dtype=[('features', np.float64, (feature_vectors.shape[1] if feature_vectors.ndim == 2 else 0,)), ('label', np.float64)])
+            data['features'] = feature_vectors
+            data['label'] = class_labels
+            np.save(file_path, data)
+            return
         with open(file_path, 'w') as f:
             f.write('\n'.join('{} {}'.format(' '.join(str(el) for el in v), str(c)) for v, c in zip(feature_vectors, class_labels)) + '\n')
 
@@ -123,13 +157,9 @@ def scan_for_albums(music_library, random=False):
     :return: the album directory paths
     :rtype: list
     """
-    import os
-    albums = []
-    # traverse root directory, and list directories as dirs and files as files
-    for root, dirs, files in os.walk(music_library):
-        mp3s = glob.glob('{}/*.mp3'.format(root))
-        if 2 < len(mp3s):  # heuristic: A minimum of 2 audio files is sufficient to constitute a music album
-            albums.append(root)
+    from music_album_creation.library_layout import scan_albums
+    # heuristic: A minimum of 3 audio files is sufficient to constitute a music album
+    albums = list(scan_albums(music_library, min_tracks=3))
     if random:
         shuffle(albums)
     return albums
@@ -138,24 +168,127 @@ def scan_for_albums(music_library, random=False):
 def create_from_custom_albums(file_path):
     with open(file_path, 'r') as f:
         lines = f.readlines()
-    return [_ for _ in new_gen(lines)]
+    return [_ for _ in new_gen([_.strip() for _ in lines])]
+
+
+def album_to_datapoints(album_dir, cache=None):
+    return _datapoints(next(album_durations([album_dir], nb_processes=1, cache=cache)))
 
-def album_to_datapoints(album_dir):
-    durs = [mutagen.File(f).info.length for f in glob.glob("{}/*.mp3".format(album_dir))]
-    # durs = [get_duration(filename=f) for f in glob.glob("{}/*.mp3".format(album_dir))]
 
+def _datapoints(durs):
     # the sum of the durations and a is_album=1 flag (binary class) : an album
     d1 = [[durs[0]], 1]
+    # the first starting timestamp (always 0:00) and a is_album=0 flag (binary class): not an album
+    d2 = [[0], 0]
+    return [d1, d2]
 
-    timestamps = sp.convert_to_timestamps('\n'.join('x {}'.format(sp.hhmmss_format(seconds)) for seconds in durs))
 
-    # timestamps = sp.convert_to_timestamps('\n'.join('x {}'.format(_) for _ in hhmmss_durs))
+def new_gen(album_dirs, nb_processes=None, cache=None):
+    for durs in album_durations(album_dirs, nb_processes=nb_processes, cache=cache):
+        for dp in _datapoints(durs):
+            yield dp
 
-    # the sum of the durations and a is_album=0 flag (binary class): not an album
-    d2 = [[sp.to_seconds(timestamps[0])], 0]
-    return [d1, d2]
 
-def new_gen(album_dirs):
-    for al in album_dirs:
-        for dp in album_to_datapoints(al):
-            yield dp
+def album_durations(album_dirs, nb_processes=None, cache=None):
+    """
+    Generates the durations (in seconds) of each album's mp3 files, sorted by file name, album by album. Durations are
+    looked up in the cache first and the rest of the files are read by a pool of processes, a few albums ahead of the
+    album being yielded. Newly read durations are stored in the cache, when the generator finishes or gets closed.\n
+    :param list album_dirs:
+    :param int nb_processes: number of processes reading audio files; defaults to the number of CPUs
+    :param DurationCache cache: defaults to the one in the user's cache directory
+    :rtype: generator
+    """
+    from music_album_creation.library_layout import mp3_files
+    cache = DurationCache() if cache is None else cache
+    albums = iter(album_dirs)
+    window = 4 * (nb_processes or os.cpu_count() or 1)  # albums being read ahead
+    pending = deque()
+    executor = None
+    try:
+        while True:
+            while len(pending) < window:
+                album_dir = next(albums, None)
+                if album_dir is None:
+                    break
+                files = mp3_files(album_dir)
+                stats = [_stat_key(f) for f in files]
+                missing = [(i, f) for i, (f, key) in enumerate(zip(files, stats)) if cache.get(f, key) is None]
+                if missing and executor is None:
+                    executor = ProcessPoolExecutor(max_workers=nb_processes)
+                pending.append((files, stats, [(i, executor.submit(_read_duration, f)) for i, f in missing]))
+            if not pending:
+                break
+            files, stats, futures = pending.popleft()
+            durations = [cache.get(f, key) for f, key in zip(files, stats)]
+            for i, future in futures:
+                durations[i] = future.result()
+                cache.set(files[i], stats[i], durations[i])
+            yield durations
+    finally:
+        for _, _, futures in pending:
+            for _, future in futures:
+                future.cancel()
+        if executor is not None:
+            executor.shutdown(wait=True)
+        cache.save()
+
+
+def _stat_key(file_path):
+    stat = os.stat(file_path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def _read_duration(file_path):
+    import mutagen
+    return mutagen.File(file_path).info.length
+
+
+class DurationCache(object):
+    """
+    Persistent (json) cache of audio file durations, keyed by absolute file path. An entry is valid as long as the file's size
+    and modification time have not changed, so that rebuilding a dataset only reads new or changed files.\n
+    :param str file_path: where the cache is stored; defaults to 'durations.json' in the user's cache directory
+    """
+    def __init__(self, file_path=None):
+        self.file_path = file_path if file_path else self.default_file_path()
+        self._lock = threading.Lock()
+        self._modified = False
+        try:
+            with open(self.file_path, 'r') as f:
+                self._entries = json.load(f)
+        except (IOError, ValueError):  # no cache yet, or a corrupted one
+            self._entries = {}
+
+    @staticmethod
+    def default_file_path():
+        return os.path.join(os.getenv('XDG_CACHE_HOME', os.path.expanduser(os.path.join('~', '.cache'))), 'music_album_creation', 'durations.json')
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, file_path, stat_key):
+        """The cached duration of the file if its [size, mtime] 'stat_key' still matches; None otherwise"""
+        entry = self._entries.get(os.path.abspath(file_path))
+        if entry is not None and entry[:2] == stat_key:
+            return entry[2]
+        return None
+
+    def set(self, file_path, stat_key, duration):
+        with self._lock:
+            self._entries[os.path.abspath(file_path)] = list(stat_key) + [duration]
+            self._modified = True
+
+    def save(self):
+        """Stores the cache, if modified, atomically; so that a run interrupted while saving does not corrupt it"""
+        with self._lock:
+            if not self._modified:
+                return
+            directory = os.path.dirname(os.path.abspath(self.file_path))
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            temporary = '{}.{}.tmp'.format(self.file_path, os.getpid())
+            with open(temporary, 'w') as f:
+                json.dump(self._entries, f)
+            os.replace(temporary, self.file_path)
+            self._modified = False
@@ -0,0 +1,104 @@
+import json
+import os
+
+import attr
+import numpy as np
+
+
+@attr.s
+class LinearModel(object):
+    """
+    A trained linear (binary) classifier, as exported from a fitted sklearn estimator (ie LinearSVC), that predicts with plain
+    numpy. Stored as a small versioned JSON document holding the weights, the intercept, the class labels and the names of
+    the features (in the order the weights expect them).\n
+    :param list weights: a weight per feature
+    :param float intercept:
+    :param list classes: the negative and the positive class labels
+    :param list features: the feature names
+    """
+    format_version = 1
+
+    weights = attr.ib(init=True, converter=lambda x: np.asarray(x, dtype=np.float64).ravel())
+    intercept = attr.ib(init=True, converter=float)
+    classes = attr.ib(init=True, converter=list)
+    features = attr.ib(init=True, converter=list)
+
+    @classmethod
+    def from_estimator(cls, estimator, features):
+        """
+        :param estimator: a fitted sklearn binary linear classifier, ie having 'coef_', 'intercept_' and 'classes_' attributes
+        :param list features: the feature names
+        :rtype: LinearModel
+        """
+        intercept = np.ravel(estimator.intercept_) if np.ndim(estimator.intercept_) else [estimator.intercept_]
+        return LinearModel(estimator.coef_, intercept[0], [_label(x) for x in estimator.classes_], features)
+
+    def decision_function(self, X):
+        """Signed distances to the separating hyperplane; positive values predict the second (positive) class"""
+        return self._matrix(X).dot(self.weights) + self.intercept
+
+    def predict(self, X):
+        return np.asarray(self.classes)[(0 < self.decision_function(X)).astype(int)]
+
+    def partial_fit(self, X, y, C=0.1):
+        """
+        Updates the weights in place with a single pass over the given datapoints, in order, using the (online) Passive
+        Aggressive algorithm (PA-II) on the hinge loss. Each update is the smallest change of the weights that classifies the
+        datapoint with a margin, relaxed by the aggressiveness parameter, so it does not depend on the scale of the features.
+        The intercept is kept as is.\n
+        :param X: the feature vectors
+        :param y: the class labels; each one of the model's classes
+        :param float C: the aggressiveness; the bigger, the more each datapoint can change the weights
+        :return: the model itself
+        :rtype: LinearModel
+        """
+        X, y = self._matrix(X), np.asarray(y)
+        unknown = set(_label(x) for x in np.unique(y)) - set(self.classes)
+        if unknown:
+            raise WrongModelInputError("Expected labels in [{}]; got [{}]".format(', '.join(str(_) for _ in self.classes),
+                                                                                 ', '.join(str(_) for _ in sorted(unknown))))
+        for x, sign in zip(X, np.where(y == self.classes[1], 1.0, -1.0)):
+            loss = max(0.0, 1.0 - sign * (x.dot(self.weights) + self.intercept))
+            if loss:
+                self.weights = self.weights + sign * loss / (x.dot(x) + 1.0 / (2 * C)) * x
+        return self
+
+    def score(self, X, y, sample_weight=None):
+        """Mean accuracy on the given datapoints, optionally weighted"""
+        return float(np.average(self.predict(X) == np.asarray(y), weights=sample_weight))
+
+    def _matrix(self, X):
+        X = np.asarray(X, dtype=np.float64)
+        if X.ndim != 2 or X.shape[1] != len(self.weights):
+            raise WrongModelInputError("Expected datapoints of {} features [{}]; got an array of shape {}".format(
+                len(self.weights), ', '.join(self.features), X.shape))
+        return X
+
+    def save(self, file_path):
+        """Stores the model atomically, so that a model being replaced is never left half written"""
+        temporary = '{}.{}.tmp'.format(file_path, os.getpid())
+        with open(temporary, 'w') as f:
+            json.dump({'format': 'linear-model',
+                       'format_version': self.format_version,
+                       'features': self.features,
+                       'classes': self.classes,
+                       'weights': self.weights.tolist(),
+                       'intercept': self.intercept}, f, indent=2)
+        os.replace(temporary, file_path)
+
+    @classmethod
+    def load(cls, file_path):
+        with open(file_path, 'r') as f:
+            data = json.load(f)
+        if data.get('format') != 'linear-model' or cls.format_version < data.get('format_version', cls.format_version + 1):
+            raise WrongModelInputError("File '{}' does not hold a linear model of format version up to {}".format(file_path, cls.format_version))
+        return LinearModel(data['weights'], data['intercept'], data['classes'], data['features'])
+
+
+def _label(x):
+    """Converts numpy scalars to plain python (json serializable) ones, casting integral floats (ie 1.0) to int"""
+    x = x.item() if hasattr(x, 'item') else x
+    return int(x) if isinstance(x, float) and x.is_integer() else x
+
+
+class WrongModelInputError(Exception): pass
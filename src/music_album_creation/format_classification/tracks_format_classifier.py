@@ -1,10 +1,16 @@
+import logging
 import os
 import sys
+import threading
+from concurrent.futures import Future
 
 import attr
-from sklearn.svm import LinearSVC
+import numpy as np
+
+from music_album_creation.tracks_parsing import StringParser
 
 from .dataset import DatasetHandler, scan_for_albums
+from .linear_model import LinearModel, _label
 
 if 2 < sys.version_info[0]:
     import pickle
@@ -12,32 +18,40 @@ else:
     import cPickle as pickle
 
 
+logger = logging.getLogger(__name__)
+
 dataset_handler = DatasetHandler(datasets_root_dir=os.path.join(os.path.dirname(os.path.realpath(__file__)), "data"))
 this_dir = os.path.dirname(os.path.realpath(__file__))
 
 
 @attr.s
 class FormatClassifier(object):
+    """Predicts whether the hh:mm:ss values of a tracklist are durations (label 1) or timestamps (label 0). Trained with
+    sklearn, but the shipped model is a LinearModel (exported to json), so predicting does not need sklearn."""
     default_music_dir = os.path.expanduser('~/Music')
+    features = ['first_hhmmss_seconds']
+    model_file = os.path.join(this_dir, 'data', 'model.json')
     music_library_dir = attr.ib(init=True, default=attr.Factory(lambda self: self.default_music_dir, takes_self=True))
-    _estimator = attr.ib(init=False, default=LinearSVC(penalty='l2',
-                                                       loss='squared_hinge',  # 'hinge'
-                                                       dual=False,
-                                                       tol=1e-4,
-                                                       fit_intercept=False,  # False: data expected to be already centered
-                                                       verbose=0,
-                                                       max_iter=1000))
+    _estimator = attr.ib(init=True, default=attr.Factory(lambda: _new_estimator()))
 
     def fit(self, X, y, sample_weight=None):
         self._estimator.fit(X, y, sample_weight=sample_weight)
 
+    def partial_fit(self, X, y):
+        """Updates the (already fitted) model with the given datapoints, converting it to a LinearModel first if needed"""
+        if not isinstance(self._estimator, LinearModel):
+            self._estimator = LinearModel.from_estimator(self._estimator, self.features)
+        self._estimator.partial_fit(X, y)
+
     @classmethod
     def infer_new(cls, train_set='new-random', nb_datapoints=100, music_library_dir=''):
         """
-        :param str train_set: {'new-random', 'load'}
+        :param str train_set: {'new-random', 'load', 'incremental'}; 'incremental' delegates to 'infer_incremental'
         :param int nb_datapoints:
         :return:
         """
+        if train_set == 'incremental':
+            return cls.infer_incremental(music_library_dir=music_library_dir)
         fc = FormatClassifier(music_library_dir=music_library_dir)
         if train_set == 'new-random':
             fc.fit(*dataset_handler.create_datapoints(scan_for_albums((lambda x: x if x else cls.default_music_dir)(music_library_dir)), nb_datapoints=nb_datapoints))
@@ -46,11 +60,77 @@ class FormatClassifier(object):
         return fc
 
     @classmethod
-    def load_version(cls):
-        return cls.load(os.path.join(this_dir, 'data/{}'.format({
-            2: 'py27_model.pickle',
-            3: 'model.pickle'
-        }[sys.version_info[0]])))
+    def infer_incremental(cls, music_library_dir='', model_file=None, nb_processes=None, cache=None):
+        """
+        Call this method to keep a model current with a growing music library. Only the albums not used by previous calls
+        are read, their datapoints update the latest model (see LinearModel.partial_fit) and the updated model is stored.
+        The albums used are recorded in a text file next to the model (one directory path per line). The first call
+        starts from the model shipped with the package.\n
+        :param str music_library_dir: defaults to '~/Music'
+        :param str model_file: where the model is stored; defaults to the user's model (see user_model_file)
+        :param int nb_processes: number of processes reading the durations of the audio files not found in the cache
+        :param DurationCache cache: the cache of audio file durations; defaults to the one in the user's cache directory
+        :return: the updated classifier
+        :rtype: FormatClassifier
+        """
+        model_file = model_file if model_file else cls.user_model_file()
+        albums_file = trained_albums_file(model_file)
+        fc = FormatClassifier(music_library_dir=music_library_dir or cls.default_music_dir,
+                              estimator=LinearModel.load(model_file if os.path.isfile(model_file) else cls.model_file))
+        trained = trained_albums(albums_file)
+        albums = [x for x in (os.path.abspath(_) for _ in scan_for_albums(fc.music_library_dir)) if x not in trained]
+        logger.info("Training with {} new albums; {} already used".format(len(albums), len(trained)))
+        if not albums:
+            return fc
+        fc.partial_fit(*dataset_handler.create_datapoints(albums, nb_processes=nb_processes, cache=cache))
+        if not os.path.isdir(os.path.dirname(os.path.abspath(model_file))):
+            os.makedirs(os.path.dirname(os.path.abspath(model_file)))
+        fc.export(model_file)
+        with open(albums_file, 'a') as f:
+            f.write(''.join('{}\n'.format(x) for x in albums))
+        return fc
+
+    @staticmethod
+    def user_model_file():
+        """The model trained incrementally on the user's library; 'format-model.json' in the user's data directory"""
+        return os.path.join(os.getenv('XDG_DATA_HOME', os.path.expanduser(os.path.join('~', '.local', 'share'))), 'music_album_creation', 'format-model.json')
+
+    @classmethod
+    def load_version(cls, user_model=True):
+        """
+        Loads the model trained on the user's library (see infer_incremental), if there is one, or else the one shipped with
+        the package; plain json, so neither sklearn nor pickle is needed.\n
+        :param bool user_model: whether to prefer the user's model over the shipped one
+        :rtype: FormatClassifier
+        """
+        if user_model and os.path.isfile(cls.user_model_file()):
+            return FormatClassifier(estimator=LinearModel.load(cls.user_model_file()))
+        return FormatClassifier(estimator=LinearModel.load(cls.model_file))
+
+    def export(self, file_path):
+        """Stores the (fitted) estimator's weights as a LinearModel json file, loadable without sklearn"""
+        model = self._estimator if isinstance(self._estimator, LinearModel) else LinearModel.from_estimator(self._estimator, self.features)
+        model.save(file_path)
+
+    @classmethod
+    def warm_up(cls):
+        """
+        Starts loading the default model (see load_version) in a background daemon thread, so that importing sklearn and
+        unpickling the model overlap with other work; ie the user answering the first dialogs.\n
+        :return: a future resolving to the loaded FormatClassifier
+        :rtype: concurrent.futures.Future
+        """
+        future = Future()
+
+        def load():
+            try:
+                future.set_result(cls.load_version())
+            except Exception as e:  # surfaced when the result is requested
+                future.set_exception(e)
+        thread = threading.Thread(target=load)
+        thread.daemon = True
+        thread.start()
+        return future
 
     def save(self, file_path):
         with open(file_path, 'wb') as f:
@@ -59,11 +139,36 @@ class FormatClassifier(object):
     @classmethod
     def load(cls, file_path):
         with open(file_path, 'rb') as f:
-            r = pickle.load(f)
+            r = _Unpickler(f).load()
         return r
 
     def is_durations(self, lines):
-        return self.predict([dataset_handler.feature_vector(lines)])[0]
+        """
+        Predicts whether the input hh:mm:ss strings are durations (1) or timestamps (0). Clear cases are decided by rules,
+        without the model: values that do not strictly increase can only be durations, while strictly increasing values
+        starting from 0:00 are timestamps.\n
+        :param list lines: the hh:mm:ss strings of a tracklist
+        :rtype: int
+        """
+        return self.classify([lines]).labels[0]
+
+    def classify(self, tracklists):
+        """
+        Predicts, for many tracklists at once, whether their hh:mm:ss values are durations (1) or timestamps (0), along with
+        a confidence for each prediction. The tracklists not decided by rules (see is_durations) are stacked into a single
+        feature matrix and predicted with one call to the model.\n
+        :param list tracklists: TracksInformation objects or lists of hh:mm:ss strings
+        :rtype: BatchPrediction
+        """
+        hhmmss_lists = [getattr(x, 'hhmmss_list', x) for x in tracklists]
+        labels = [_rule_based_label(x) for x in hhmmss_lists]
+        confidences = [1.0] * len(labels)
+        undecided = [i for i, label in enumerate(labels) if label is None]
+        if undecided:
+            X = np.array([dataset_handler.feature_vector(hhmmss_lists[i]) for i in undecided], dtype=np.float64)
+            for i, label, confidence in zip(undecided, self.predict(X), _confidences(self._estimator.decision_function(X))):
+                labels[i], confidences[i] = _label(label), float(confidence)
+        return BatchPrediction(labels, confidences)
 
     # def save(self):
     def predict(self, X):
@@ -71,3 +176,73 @@ class FormatClassifier(object):
 
     def score(self, X, y, sample_weight=None):
         return self._estimator.score(X, y, sample_weight=sample_weight)
+
+
+@attr.s(frozen=True)
+class BatchPrediction(object):
+    """
+    The labels predicted for a batch of tracklists and a confidence, in [0.5, 1], per label. Labels decided by rules have a
+    confidence of 1. For the rest, the confidence is the logistic function of the (absolute) distance of the datapoint to the
+    model's separating hyperplane; it ranks the predictions, but it is not a calibrated probability.\n
+    :param list labels:
+    :param list confidences:
+    """
+    labels = attr.ib(init=True)
+    confidences = attr.ib(init=True)
+
+    def __len__(self):
+        return len(self.labels)
+
+    def uncertain(self, threshold=0.75):
+        """The indices of the tracklists predicted with a confidence below the threshold; ie to be reviewed manually"""
+        return [i for i, confidence in enumerate(self.confidences) if confidence < threshold]
+
+
+def _confidences(decision_values):
+    return 1.0 / (1.0 + np.exp(-np.abs(np.asarray(decision_values, dtype=np.float64))))
+
+
+def trained_albums_file(model_file):
+    return '{}.albums.txt'.format(os.path.splitext(model_file)[0])
+
+
+def trained_albums(albums_file):
+    """The album directories recorded as used for training a model"""
+    if not os.path.isfile(albums_file):
+        return set()
+    with open(albums_file, 'r') as f:
+        return set(line.rstrip('\n') for line in f if line.strip())
+
+
+def _rule_based_label(hhmmss_list):
+    try:
+        seconds = [StringParser.to_seconds(x) for x in hhmmss_list]
+    except ValueError:
+        return None
+    if any(b <= a for a, b in zip(seconds, seconds[1:])):
+        return 1
+    if seconds and seconds[0] == 0:
+        return 0
+    return None
+
+
+class _Unpickler(pickle.Unpickler):
+    """Unpickles models pickled with older sklearn versions, which defined the estimators in the (since removed) 'classes' modules"""
+    def __init__(self, file):
+        super(_Unpickler, self).__init__(file, encoding='latin1')
+
+    def find_class(self, module, name):
+        if module.startswith('sklearn.') and module.endswith('.classes'):
+            module = module[:-len('.classes')]
+        return super(_Unpickler, self).find_class(module, name)
+
+
+def _new_estimator():
+    from sklearn.svm import LinearSVC  # imported on first use; importing sklearn takes seconds
+    return LinearSVC(penalty='l2',
+                     loss='squared_hinge',  # 'hinge'
+                     dual=False,
+                     tol=1e-4,
+                     fit_intercept=False,  # False: data expected to be already centered
+                     verbose=0,
+                     max_iter=1000)
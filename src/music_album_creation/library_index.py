@@ -0,0 +1,303 @@
+import json
+import logging
+import os
+import sqlite3
+import sys
+import threading
+
+import attr
+import click
+
+from . import configure_logging
+from .library_layout import mp3_files, scan_albums
+
+logger = logging.getLogger(__name__)
+
+
+@attr.s(frozen=True)
+class IndexedTrack(object):
+    """A track (mp3 file) as recorded in the index; 'duration' in seconds (None if unreadable) and 'tags' the ID3 text frames by key (ie 'TPE1')"""
+    path = attr.ib(init=True)
+    size = attr.ib(init=True)
+    mtime_ns = attr.ib(init=True)
+    duration = attr.ib(init=True)
+    tags = attr.ib(init=True)
+
+
+@attr.s(frozen=True)
+class IndexedAlbum(object):
+    """An album directory as recorded in the index, with the id of the (youtube) video it was created from, if known"""
+    path = attr.ib(init=True)
+    video_id = attr.ib(init=True)
+    tracks = attr.ib(init=True)
+
+    @property
+    def durations(self):
+        return [x.duration for x in self.tracks]
+
+
+@attr.s(frozen=True)
+class IndexUpdate(object):
+    """How many tracks an update of the index read (new or modified files), removed or found unchanged"""
+    read = attr.ib(init=True, default=0)
+    removed = attr.ib(init=True, default=0)
+    unchanged = attr.ib(init=True, default=0)
+
+    def __add__(self, other):
+        return IndexUpdate(self.read + other.read, self.removed + other.removed, self.unchanged + other.unchanged)
+
+
+class LibraryIndex(object):
+    """
+    A local SQLite database of the albums and tracks of a music library: for every track its path, size, modification time,
+    duration and ID3 text frames; for every album the video it was created from, if known. Updating the index only reads the
+    audio files that are new or whose size or modification time changed, so that questions like "is this video already in
+    the library?" or "what are the durations of all albums?" are answered without touching the audio files.\n
+    :param str db_file: where the database is stored; defaults to 'library.sqlite3' in the user's cache directory
+    """
+    schema = """
+        CREATE TABLE IF NOT EXISTS albums (
+            id INTEGER PRIMARY KEY,
+            path TEXT NOT NULL UNIQUE,
+            video_id TEXT
+        );
+        CREATE INDEX IF NOT EXISTS albums_video_id ON albums (video_id);
+        CREATE TABLE IF NOT EXISTS tracks (
+            id INTEGER PRIMARY KEY,
+            album_id INTEGER NOT NULL REFERENCES albums (id) ON DELETE CASCADE,
+            path TEXT NOT NULL UNIQUE,
+            size INTEGER NOT NULL,
+            mtime_ns INTEGER NOT NULL,
+            duration REAL,
+            tags TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS tracks_album_id ON tracks (album_id);
+        CREATE TABLE IF NOT EXISTS fingerprints (
+            path TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            mtime_ns INTEGER NOT NULL,
+            frame_rate REAL NOT NULL,
+            hashes BLOB NOT NULL
+        );
+    """
+
+    def __init__(self, db_file=None):
+        self.db_file = db_file if db_file else self.default_file_path()
+        directory = os.path.dirname(os.path.abspath(self.db_file))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(self.db_file, check_same_thread=False)
+        self._connection.execute('PRAGMA foreign_keys = ON')
+        self._connection.executescript(self.schema)
+
+    @staticmethod
+    def default_file_path():
+        return os.path.join(os.getenv('XDG_CACHE_HOME', os.path.expanduser(os.path.join('~', '.cache'))), 'music_album_creation', 'library.sqlite3')
+
+    def close(self):
+        self._connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def update(self, library_root):
+        """
+        Call this method to bring the index up to date with the albums found under the library directory. Albums indexed
+        under the directory that no longer exist (or no longer hold mp3 files) are removed.\n
+        :param str library_root:
+        :rtype: IndexUpdate
+        """
+        library_root = os.path.abspath(library_root)
+        found = set()
+        total = IndexUpdate()
+        for album_directory in scan_albums(library_root):
+            found.add(os.path.abspath(album_directory))
+            total += self.add_album(album_directory)
+        with self._lock, self._connection:
+            stale = [(path,) for (path,) in self._connection.execute('SELECT path FROM albums')
+                     if path not in found and _is_under(path, library_root)]
+            # the stale albums go in a temporary table, so that their tracks get counted (and they get deleted) by single queries
+            self._connection.execute('CREATE TEMP TABLE IF NOT EXISTS stale_albums (path TEXT PRIMARY KEY)')
+            self._connection.execute('DELETE FROM stale_albums')
+            self._connection.executemany('INSERT OR IGNORE INTO stale_albums (path) VALUES (?)', stale)
+            removed = self._connection.execute('SELECT COUNT(*) FROM tracks JOIN albums ON albums.id = tracks.album_id '
+                                               'WHERE albums.path IN (SELECT path FROM stale_albums)').fetchone()[0]
+            self._connection.execute('DELETE FROM albums WHERE path IN (SELECT path FROM stale_albums)')
+            self._connection.execute('DELETE FROM fingerprints WHERE path NOT IN (SELECT path FROM tracks)')
+        return total + IndexUpdate(removed=removed)
+
+    def add_album(self, album_directory, video_id=None):
+        """
+        Call this method to index (or re-index) a single album directory; ie when an album gets stored in the library. Only
+        the mp3 files that are new or modified since last indexed are read.\n
+        :param str album_directory:
+        :param str video_id: the id of the video the album was created from; if not given any previously recorded is kept
+        :rtype: IndexUpdate
+        """
+        album_directory = os.path.abspath(album_directory)
+        files = mp3_files(album_directory) if os.path.isdir(album_directory) else []
+        with self._lock:
+            indexed = {row[0]: row[1:] for row in self._connection.execute(
+                'SELECT tracks.path, tracks.size, tracks.mtime_ns FROM tracks JOIN albums ON albums.id = tracks.album_id WHERE albums.path = ?', (album_directory,))}
+        rows, unchanged = [], 0
+        for file_path in files:
+            stat = os.stat(file_path)
+            if indexed.get(file_path) == (stat.st_size, stat.st_mtime_ns):
+                unchanged += 1
+                continue
+            duration, tags = _read_track(file_path)
+            rows.append((file_path, stat.st_size, stat.st_mtime_ns, duration, json.dumps(tags, sort_keys=True)))
+        removed = [(x,) for x in set(indexed) - set(files)]
+        with self._lock, self._connection:
+            # an upsert (ON CONFLICT) needs SQLite 3.24; both statements run in the same transaction
+            self._connection.execute('INSERT OR IGNORE INTO albums (path, video_id) VALUES (?, ?)', (album_directory, video_id))
+            self._connection.execute('UPDATE albums SET video_id = COALESCE(?, video_id) WHERE path = ?', (video_id, album_directory))
+            album_id = self._connection.execute('SELECT id FROM albums WHERE path = ?', (album_directory,)).fetchone()[0]
+            self._connection.executemany('DELETE FROM tracks WHERE path = ?', removed)
+            self._connection.executemany('INSERT OR REPLACE INTO tracks (album_id, path, size, mtime_ns, duration, tags) VALUES (?, ?, ?, ?, ?, ?)',
+                                         [(album_id,) + row for row in rows])
+        return IndexUpdate(read=len(rows), removed=len(removed), unchanged=unchanged)
+
+    def album(self, album_directory):
+        """The indexed album of the given directory or None if it is not indexed"""
+        albums = self._albums('WHERE albums.path = ?', (os.path.abspath(album_directory),))
+        return albums[0] if albums else None
+
+    def album_for_video(self, video_id):
+        """The (first) indexed album created from the given video or None if the video is not in the library"""
+        albums = self._albums('WHERE albums.video_id = ?', (video_id,))
+        return albums[0] if albums else None
+
+    def has_video(self, video_id):
+        return self.album_for_video(video_id) is not None
+
+    def albums(self):
+        """All indexed albums, sorted by path, along with their tracks (sorted by file path)"""
+        return self._albums('', ())
+
+    def album_durations(self):
+        """
+        The durations (in seconds) of each indexed album's tracks, sorted by file name, by album directory.\n
+        :rtype: dict
+        """
+        return {album.path: album.durations for album in self.albums()}
+
+    def set_fingerprint(self, track_path, fingerprint):
+        """
+        Stores the fingerprint of an (indexed) track file. It stays valid as long as the file's size and modification time do
+        not change; ie it has to be stored after any tagging.\n
+        :param str track_path:
+        :param music_album_creation.audio_analysis.Fingerprint fingerprint:
+        """
+        stat = os.stat(track_path)
+        with self._lock, self._connection:
+            self._connection.execute('INSERT OR REPLACE INTO fingerprints (path, size, mtime_ns, frame_rate, hashes) VALUES (?, ?, ?, ?, ?)',
+                                     (os.path.abspath(track_path), stat.st_size, stat.st_mtime_ns, fingerprint.frame_rate, fingerprint.to_bytes()))
+
+    def fingerprints(self, duration=None, tolerance=10.0, frame_rate=None):
+        """
+        The valid fingerprints of the indexed tracks, optionally only of the ones lasting 'duration' seconds, give or take
+        'tolerance' seconds.\n
+        :param float duration:
+        :param float tolerance:
+        :param float frame_rate: if given, fingerprints of another frame rate (ie computed with other parameters, so that they
+        can not be compared) are left out
+        :return: track paths and their fingerprints
+        :rtype: list of tuples
+        """
+        from .audio_analysis import Fingerprint
+        condition, parameters = _valid_fingerprint(frame_rate)
+        query = 'SELECT tracks.path, fingerprints.frame_rate, fingerprints.hashes FROM tracks JOIN fingerprints ON {}'.format(condition)
+        if duration is not None:
+            query += ' WHERE tracks.duration BETWEEN ? AND ?'
+            parameters += (duration - tolerance, duration + tolerance)
+        with self._lock:
+            rows = self._connection.execute(query + ' ORDER BY tracks.path', parameters).fetchall()
+        return [(path, Fingerprint.from_bytes(hashes, frame_rate)) for path, frame_rate, hashes in rows]
+
+    def unfingerprinted_tracks(self, album_directory=None, frame_rate=None):
+        """
+        The paths of the indexed tracks (of an album, if given) lacking a valid fingerprint.\n
+        :param str album_directory:
+        :param float frame_rate: if given, fingerprints of another frame rate count as missing, so that they get recomputed
+        :rtype: list
+        """
+        condition, parameters = _valid_fingerprint(frame_rate)
+        query = 'SELECT tracks.path FROM tracks JOIN albums ON albums.id = tracks.album_id LEFT JOIN fingerprints ON {} ' \
+                'WHERE fingerprints.path IS NULL'.format(condition)
+        if album_directory is not None:
+            query += ' AND albums.path = ?'
+            parameters += (os.path.abspath(album_directory),)
+        with self._lock:
+            return [row[0] for row in self._connection.execute(query + ' ORDER BY tracks.path', parameters)]
+
+    def _albums(self, where, parameters):
+        with self._lock:
+            rows = self._connection.execute(
+                'SELECT albums.path, albums.video_id, tracks.path, tracks.size, tracks.mtime_ns, tracks.duration, tracks.tags FROM albums '
+                'LEFT JOIN tracks ON albums.id = tracks.album_id {} ORDER BY albums.path, tracks.path'.format(where), parameters).fetchall()
+        albums = []
+        for row in rows:
+            if not albums or albums[-1].path != row[0]:
+                albums.append(IndexedAlbum(row[0], row[1], []))
+            if row[2] is not None:
+                albums[-1].tracks.append(IndexedTrack(row[2], row[3], row[4], row[5], json.loads(row[6])))
+        return albums
+
+
+def _valid_fingerprint(frame_rate=None):
+    """The condition joining a track with its valid fingerprint, of the given frame rate if any, and the condition's parameters"""
+    condition = 'tracks.path = fingerprints.path AND tracks.size = fingerprints.size AND tracks.mtime_ns = fingerprints.mtime_ns'
+    if frame_rate is None:
+        return condition, ()
+    return condition + ' AND ABS(fingerprints.frame_rate - ?) < 1e-6', (frame_rate,)
+
+
+def _is_under(path, directory):
+    return path == directory or path.startswith(directory.rstrip(os.sep) + os.sep)
+
+
+def _read_track(file_path):
+    """The duration (in seconds) and the ID3 text frames of an mp3 file; None and no frames if the file can not be read"""
+    import mutagen
+    try:
+        audio = mutagen.File(file_path)
+    except mutagen.MutagenError as e:
+        logger.warning("Could not read audio file '{}': {}".format(file_path, e))
+        return None, {}
+    if audio is None:
+        return None, {}
+    tags = {key: str(frame) for key, frame in (audio.tags or {}).items() if key.startswith('T')}
+    return getattr(audio.info, 'length', None), tags
+
+
+@click.command()
+@click.option('--library-dir', '-l', help="The music library directory to index.  [default: the MUSIC_LIB_ROOT environment variable]")
+@click.option('--db', type=click.Path(dir_okay=False), help="The index database file.  [default: {}]".format(LibraryIndex.default_file_path()))
+@click.option('--fingerprint', is_flag=True, help="Also fingerprint (decoding with ffmpeg) the tracks lacking a fingerprint, so that duplicates of them can be detected.")
+def main(library_dir, db, fingerprint):
+    configure_logging()
+    library_dir = library_dir or os.getenv('MUSIC_LIB_ROOT', None)
+    if library_dir is None or not os.path.isdir(library_dir):
+        click.echo("Please give a library directory or set the environment variable MUSIC_LIB_ROOT to point to a directory that stores music.", err=True)
+        sys.exit(1)
+    with LibraryIndex(db_file=db) as index:
+        update = index.update(library_dir)
+        click.echo("Indexed {} albums: read {} tracks, removed {}, {} unchanged".format(len(index.albums()), update.read, update.removed, update.unchanged))
+        if fingerprint:
+            from .audio_analysis import Fingerprinter, fingerprint_files
+            fingerprinter = Fingerprinter()
+            tracks = index.unfingerprinted_tracks(frame_rate=fingerprinter.frame_rate)
+            fingerprints = fingerprint_files(tracks, fingerprinter=fingerprinter)
+            for track, track_fingerprint in zip(tracks, fingerprints):
+                if track_fingerprint is not None:
+                    index.set_fingerprint(track, track_fingerprint)
+            click.echo("Fingerprinted {} of {} tracks".format(sum(1 for x in fingerprints if x is not None), len(tracks)))
+
+
+if __name__ == '__main__':
+    main()
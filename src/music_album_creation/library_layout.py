@@ -0,0 +1,70 @@
+import logging
+import os
+import re
+
+logger = logging.getLogger(__name__)
+
+
+def scan_albums(root, min_tracks=1):
+    """
+    Walks a directory tree (with os.scandir) and yields every directory that directly contains mp3 files; ie the album
+    directories of a music library. Symbolic links to directories are not followed.\n
+    :param str root: the library (or any) directory to walk
+    :param int min_tracks: the minimum number of mp3 files a directory should contain to be considered an album
+    :return: album directory paths, in sorted order
+    :rtype: generator
+    """
+    stack = [root]
+    while stack:
+        directory = stack.pop()
+        subdirectories, nb_tracks = [], 0
+        try:
+            entries = os.scandir(directory)
+            try:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirectories.append(entry.path)
+                    elif entry.name.lower().endswith('.mp3'):
+                        nb_tracks += 1
+            finally:  # the iterator is a context manager only as of Python 3.6
+                entries.close()
+        except OSError as e:
+            logger.warning("Could not scan directory '{}': {}".format(directory, e))
+            continue
+        if min_tracks <= nb_tracks:
+            yield directory
+        stack.extend(sorted(subdirectories, reverse=True))
+
+
+def mp3_files(album_directory):
+    """The paths of the mp3 files directly inside the directory, sorted"""
+    entries = os.scandir(album_directory)
+    try:
+        return sorted(entry.path for entry in entries if entry.name.lower().endswith('.mp3') and entry.is_file())
+    finally:
+        entries.close()
+
+
+_album_n_year = re.compile(r'^(.*\S)\s*\((\d{4})\)$')
+
+
+def infer_album_info(album_directory, library_root=None):
+    """
+    Infers album level information out of a directory layout such as '<artist>/<album (year)>', as suggested when storing an
+    album with 'create-album'. The parent directory is taken as the artist, unless it is the library root itself.\n
+    :param str album_directory:
+    :param str library_root:
+    :return: the inferred values as a dictionary having maximally keys: {'artist', 'album', 'year'}
+    :rtype: dict
+    """
+    album_directory = os.path.normpath(album_directory)
+    info = {}
+    match = _album_n_year.match(os.path.basename(album_directory))
+    if match:
+        info['album'], info['year'] = match.groups()
+    else:
+        info['album'] = os.path.basename(album_directory)
+    parent = os.path.dirname(album_directory)
+    if os.path.basename(parent) and (library_root is None or os.path.realpath(library_root) != os.path.realpath(parent)):
+        info['artist'] = os.path.basename(parent)
+    return info
@@ -2,11 +2,17 @@ import glob
 import logging
 import os
 import re
+import sys
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 
+import attr
 import click
+from music_album_creation import configure_logging, events, profiling
 from music_album_creation.tracks_parsing import StringParser
-from mutagen.id3 import ID3, TALB, TDRC, TIT2, TPE1, TPE2, TRCK
+from mutagen.id3 import (ID3, TALB, TDRC, TIT2, TPE1, TPE2, TRCK, TXXX,
+                         ID3NoHeaderError)
+from mutagen.mp3 import MP3
 
 # The main notable classes in mutagen are FileType, StreamInfo, Tags, Metadata and for error handling the MutagenError exception.
 
@@ -45,44 +51,252 @@ class MetadataDealer(MetadataDealerType):
     _auto_data = [('track_number', TRCK),  # 4.2.1   TRCK    [#TRCK Track number/Position in set]
                   ('track_name', TIT2)]   # 4.2.1   TIT2    [#TIT2 Title/songname/content description]
 
-    _all = dict(_d, **dict(_auto_data))
+    # user defined text frames (TXXX), by their description; ie the ReplayGain values computed by audio_analysis.loudness
+    _user_text = [('replaygain_track_gain', 'REPLAYGAIN_TRACK_GAIN'),
+                  ('replaygain_track_peak', 'REPLAYGAIN_TRACK_PEAK'),
+                  ('replaygain_album_gain', 'REPLAYGAIN_ALBUM_GAIN'),
+                  ('replaygain_album_peak', 'REPLAYGAIN_ALBUM_PEAK')]
+
+    _all = dict(_d, **dict(_auto_data, **{name: TXXX for name, _ in _user_text}))
+
+    # bytes of padding reserved after the ID3 tag whenever it does not fit in place, so that later edits avoid rewriting the file
+    id3_padding = 8192
+
+    # mutagen's saving is I/O bound; use more workers for storage with high latency (ie network mounted)
+    nb_workers = 8
+
+    @classmethod
+    def set_album_metadata(cls, album_directory, track_number=True, track_name=True, artist='', album_artist='', album='', year='', nb_workers=None,
+                           incremental=False, dry_run=False, files=None):
+        """
+        Call this method to write metadata to all the mp3 files of an album directory. The frames to write per file are planned
+        up front and then written by a pool of threads. In incremental mode only the frames that differ from the ones already in
+        a file get written and files already holding all requested values are not written at all.\n
+        :param str album_directory:
+        :param bool track_number: whether to extract the track numbers from the file names and write them
+        :param bool track_name: whether to extract the track names from the file names and write them
+        :param str artist:
+        :param str album_artist:
+        :param str album:
+        :param str year:
+        :param int nb_workers: number of threads writing files concurrently; defaults to the 'nb_workers' class attribute
+        :param bool incremental: whether to write only the frames that differ from the existing ones
+        :param bool dry_run: whether to only report the frames that differ, without writing anything; implies incremental
+        :param list files: the mp3 files of the album directory to write to; defaults to all of them. The track numbers and names
+         are still parsed out of the file names of the whole album
+        :return: the success or failure per file, along with the changes per file if incremental
+        :rtype: AlbumTaggingResult
+        """
+        return cls._write_metadata(album_directory, nb_workers=nb_workers, incremental=incremental or dry_run, dry_run=dry_run, files=files,
+                                   track_number=track_number, track_name=track_name, artist=artist, album_artist=album_artist,
+                                   album=album, year=str(year))
 
     @classmethod
-    def set_album_metadata(cls, album_directory, track_number=True, track_name=True, artist='', album_artist='', album='', year=''):
-        cls._write_metadata(album_directory, track_number=track_number, track_name=track_name, artist=artist, album_artist=album_artist, album=album, year=str(year))
+    def plan_album_metadata(cls, album_directory, **kwargs):
+        """
+        Computes the frames to write to each mp3 file of an album directory, without touching the files. Track numbers and names
+        are parsed out of the file names, if requested (ie track_number=True).\n
+        :param str album_directory:
+        :return: the (file, frames) pairs to write and a (failed) TaggingOutcome per file whose name could not be parsed
+        :rtype: tuple
+        """
+        files = sorted(glob.glob('{}/*.mp3'.format(album_directory)))
+        album_frames = {k: kwargs.get(k, '') for k in cls._d.keys()}
+        if not any(kwargs.get(name, False) for name, _ in cls._auto_data):
+            return [(file, dict(album_frames)) for file in files], []
+        parsing = StringParser.engine.parse_file_names(files)
+        plan = [(file, dict(cls._filter_auto_inferred(parsing.parsed[file], **kwargs), **album_frames)) for file in files if file in parsing.parsed]
+        return plan, [TaggingOutcome(failure.text, {}, error=failure.message) for failure in parsing.failures]
 
     @classmethod
-    def _write_metadata(cls, album_directory, **kwargs):
-        files = glob.glob('{}/*.mp3'.format(album_directory))
+    def _write_metadata(cls, album_directory, nb_workers=None, incremental=False, dry_run=False, files=None, **kwargs):
         logger.info("Album directory: {}".format(album_directory))
-        for file in files:
-            logger.info("File: {}".format(os.path.basename(file)))
-            cls.write_metadata(file, **dict(cls._filter_auto_inferred(StringParser.parse_track_number_n_name(file), **kwargs),
-                                            **{k: kwargs.get(k, '') for k in cls._d.keys()}))
+        plan, outcomes = cls.plan_album_metadata(album_directory, **kwargs)
+        if files is not None:
+            files = set(os.path.abspath(x) for x in files)
+            plan = [x for x in plan if os.path.abspath(x[0]) in files]
+            outcomes = [x for x in outcomes if os.path.abspath(x.file) in files]
+        outcomes.extend(cls.write_plan(plan, nb_workers=nb_workers, incremental=incremental, dry_run=dry_run))
+        return AlbumTaggingResult(album_directory, sorted(outcomes, key=lambda x: x.file))
+
+    @classmethod
+    def write_plan(cls, plan, nb_workers=None, incremental=False, dry_run=False):
+        """
+        Writes the given frames to each file, by a pool of threads; see set_album_metadata.\n
+        :param list plan: (file, frames) pairs, where frames is a dictionary of values by metadata name (ie 'artist')
+        :return: the success or failure per file, in the order of the plan
+        :rtype: list of TaggingOutcome
+        """
+        if not plan:
+            return []
+        with ThreadPoolExecutor(max_workers=min(nb_workers or cls.nb_workers, len(plan))) as executor:
+            return list(executor.map(events.bind(lambda x: cls._write_planned(*x, incremental=incremental, dry_run=dry_run)), plan))
+
+    @classmethod
+    def _write_planned(cls, file, frames, incremental=False, dry_run=False):
+        logger.info("File: {}".format(os.path.basename(file)))
+        changes = None
+        try:
+            with profiling.stage('tag', python=True, track=os.path.basename(file)):
+                if incremental:
+                    changes = cls.sync_metadata(file, dry_run=dry_run, **frames)
+                else:
+                    cls.write_metadata(file, **frames)
+        except Exception as e:  # reported per file, so that one bad file does not abort tagging the rest of the album
+            logger.error("Failed to write metadata to '{}': {}".format(file, e))
+            events.publish(events.ErrorOccurred, stage='tag', error='{}: {}'.format(type(e).__name__, e), file=file)
+            return TaggingOutcome(file, frames, error='{}: {}'.format(type(e).__name__, e))
+        if not dry_run:
+            events.publish(events.TagWritten, file=file, changes=[str(x) for x in changes] if changes is not None else None)
+        return TaggingOutcome(file, frames, changes=changes)
 
     @classmethod
     def write_metadata(cls, file, **kwargs):
-        if not all(map(lambda x: x[0] in cls._all.keys(), kwargs.items())):
-            raise RuntimeError("Some of the input keys [{}] used to request the addition of metadata, do not correspond"
-                               " to a tag/frame of the supported [{}]".format(', '.join(kwargs.keys()), ' '.join(cls._d)))
-        audio = ID3(file)
+        cls._check_keys(kwargs)
+        audio = cls._load_tag(file)
         for metadata_name, v in kwargs.items():
             if bool(v):
-                audio.add(cls._all[metadata_name](encoding=3, text=u'{}'.format(cls._filters[metadata_name](v))))
-                logger.info(" {}: {}={}".format(metadata_name, cls._all[metadata_name].__name__, cls._filters[metadata_name](v)))
+                frame = cls._new_frame(metadata_name, u'{}'.format(cls._filters[metadata_name](v)))
+                audio.add(frame)
+                logger.info(" {}: {}={}".format(metadata_name, frame.HashKey, frame))
             else:
                 logger.warning("Skipping metadata '{}::'{}' because bool({}) == False".format(metadata_name, cls._all[metadata_name].__name__, v))
-        audio.save()
+        audio.save(file, padding=cls._padding_strategy(cls.id3_padding))
+
+    @classmethod
+    def sync_metadata(cls, file, dry_run=False, **kwargs):
+        """
+        Call this method to write to an audio file only the frames whose existing values differ from the requested ones. The
+        file is not written at all, if all of them already hold the requested values.\n
+        :param str file:
+        :param bool dry_run: if True, only report the frames that differ without writing anything
+        :return: the frames changed (or to be changed, on a dry run)
+        :rtype: list of FrameChange
+        """
+        cls._check_keys(kwargs)
+        audio = cls._load_tag(file)
+        changes = []
+        for metadata_name, v in kwargs.items():
+            if not bool(v):
+                continue
+            value = u'{}'.format(cls._filters[metadata_name](v))
+            frame = cls._new_frame(metadata_name, value)
+            existing = audio.get(frame.HashKey)
+            if existing is None or str(existing) != value:
+                changes.append(FrameChange(metadata_name, frame.HashKey, None if existing is None else str(existing), value))
+                audio.add(frame)
+        if changes and not dry_run:
+            audio.save(file, padding=cls._padding_strategy(cls.id3_padding))
+            logger.info(" {}".format(', '.join(str(x) for x in changes)))
+        return changes
+
+    @classmethod
+    def _new_frame(cls, metadata_name, value):
+        descriptions = dict(cls._user_text)
+        if metadata_name in descriptions:
+            return TXXX(encoding=3, desc=descriptions[metadata_name], text=value)
+        return cls._all[metadata_name](encoding=3, text=value)
+
+    @classmethod
+    def _check_keys(cls, kwargs):
+        if not all(map(lambda x: x[0] in cls._all.keys(), kwargs.items())):
+            raise RuntimeError("Some of the input keys [{}] used to request the addition of metadata, do not correspond"
+                               " to a tag/frame of the supported [{}]".format(', '.join(kwargs.keys()), ' '.join(cls._d)))
+
+    @classmethod
+    def reserve_padding(cls, file, padding=None):
+        """
+        Call this method to make sure an audio file's ID3 tag is followed by at least 'padding' bytes of padding, so that
+        subsequent tag edits fit in place. A file with less padding (or without a tag at all) gets rewritten once.\n
+        :param str file:
+        :param int padding: the amount of bytes to reserve; defaults to the 'id3_padding' class attribute
+        """
+        padding = cls.id3_padding if padding is None else padding
+        cls._load_tag(file).save(file, padding=cls._padding_strategy(padding, minimum=padding))
+
+    @staticmethod
+    def _load_tag(file):
+        """
+        Loads a file's ID3 tag; a new, empty one if the file is MPEG audio without a tag (ie a freshly segmented track).
+        Raises a mutagen HeaderNotFoundError for files that are not MPEG audio, so that no tag gets written into them.\n
+        :param str file:
+        :rtype: mutagen.id3.ID3
+        """
+        try:
+            return ID3(file)
+        except ID3NoHeaderError:
+            MP3(file)
+            return ID3()
+
+    @staticmethod
+    def _padding_strategy(reserve, minimum=0):
+        """
+        Creates a mutagen padding callback that keeps the existing padding if the tag still fits in it (so that only the tag
+        region gets written) and otherwise reserves 'reserve' bytes, since the whole file has to be rewritten anyway.\n
+        :param int reserve: the padding (in bytes) to leave after the tag, when it does not fit in the existing one
+        :param int minimum: the least padding (in bytes) to accept as existing padding
+        """
+        def strategy(info):
+            if minimum <= info.padding:
+                return info.padding
+            return reserve
+        return strategy
 
     @classmethod
     def _filter_auto_inferred(cls, d, **kwargs):
         """Given a dictionary (like the one outputted by _infer_track_number_n_name), deletes entries unless it finds them declared in kwargs as key_name=True"""
-        for k in cls._auto_data:
+        for k, _ in cls._auto_data:
             if not kwargs.get(k, False) and k in d:
                 del d[k]
         return d
 
 
+@attr.s(frozen=True)
+class FrameChange(object):
+    """A frame whose existing value ('old'; None if missing) differs from the requested one ('new')"""
+    name = attr.ib(init=True)
+    frame = attr.ib(init=True)
+    old = attr.ib(init=True)
+    new = attr.ib(init=True)
+
+    def __str__(self):
+        return "{}: '{}' -> '{}'".format(self.frame, '' if self.old is None else self.old, self.new)
+
+
+@attr.s(frozen=True)
+class TaggingOutcome(object):
+    """The frames requested to be written to a file, the error message if writing them failed and, in incremental mode, the
+    frames that differed (None otherwise)"""
+    file = attr.ib(init=True)
+    frames = attr.ib(init=True)
+    error = attr.ib(init=True, default=None)
+    changes = attr.ib(init=True, default=None)
+
+    @property
+    def succeeded(self):
+        return self.error is None
+
+
+@attr.s(frozen=True)
+class AlbumTaggingResult(object):
+    """The outcome of tagging every file of an album directory, sorted by file path"""
+    album_directory = attr.ib(init=True)
+    outcomes = attr.ib(init=True)
+
+    @property
+    def succeeded(self):
+        return [x for x in self.outcomes if x.succeeded]
+
+    @property
+    def failed(self):
+        return [x for x in self.outcomes if not x.succeeded]
+
+    @property
+    def changed(self):
+        """The (successful) outcomes of the files that had frames differing from the requested ones; incremental mode only"""
+        return [x for x in self.succeeded if x.changes]
+
+
 class InvalidInputYearError(Exception): pass
 
 
@@ -95,10 +309,29 @@ class InvalidInputYearError(Exception): pass
 @click.option('--artist', '-a', help="If given, then value shall be used as the TPE1 tag: 'Lead performer(s)/Soloist(s)'.  In the music player 'clementine' it corresponds to the 'Artist' column.")
 @click.option('--album_artist', '-aa', help="If given, then value shall be used as the TPE2 tag: 'Band/orchestra/accompaniment'.  In the music player 'clementine' it corresponds to the 'Album artist' column.")
 @click.option('--album', '-al', help="If given, then value shall be used as the TALB tag: 'Album/Movie/Show title'.  In the music player 'clementine' it corresponds to the 'Album' column.")
-@click.option('--year', 'y', help="If given, then value shall be used as the TDRC tag: 'Recoring time'.  In the music player 'clementine' it corresponds to the 'Year' column.")
-def main(album_dir, track_name, track_number, artist, album_artist, album, year):
+@click.option('--year', '-y', help="If given, then value shall be used as the TDRC tag: 'Recoring time'.  In the music player 'clementine' it corresponds to the 'Year' column.")
+@click.option('--workers', '-w', type=int, help="Number of files to write concurrently. Increase it for network mounted storage.  [default: {}]".format(MetadataDealer.nb_workers))
+@click.option('--incremental', '-i', is_flag=True, help="Write only the frames that differ from the ones already in the files and report them.")
+@click.option('--dry-run', '-n', is_flag=True, help="Only report the frames that differ from the ones already in the files, without writing anything.")
+@click.option('--replaygain', is_flag=True, help="Also measure the loudness of the tracks (decoding them with ffmpeg) and write the ReplayGain track and album gain and peak frames.")
+def main(album_dir, track_name, track_number, artist, album_artist, album, year, workers, incremental, dry_run, replaygain):
+    configure_logging()
     md = MetadataDealer()
-    md.set_album_metadata(album_dir, track_number=track_number, track_name=track_name, artist=artist, album_artist=album_artist, album=album, year=year)
+    result = md.set_album_metadata(album_dir, track_number=track_number, track_name=track_name, artist=artist, album_artist=album_artist, album=album, year=year or '', nb_workers=workers,
+                                   incremental=incremental, dry_run=dry_run)
+    if incremental or dry_run:
+        for outcome in result.changed:
+            click.echo("{} '{}'\n{}".format('Would change' if dry_run else 'Changed', os.path.basename(outcome.file),
+                                            '\n'.join('  {}'.format(x) for x in outcome.changes)))
+        click.echo("{} of {} files {}".format(len(result.changed), len(result.outcomes), 'would change' if dry_run else 'changed'))
+    failed = result.failed
+    if replaygain and not dry_run:
+        from music_album_creation.audio_analysis import analyze_album, write_replaygain
+        failed += write_replaygain(analyze_album(sorted(glob.glob('{}/*.mp3'.format(album_dir)))), nb_workers=workers).failed
+    for outcome in failed:
+        click.echo("Failed to tag '{}': {}".format(outcome.file, outcome.error), err=True)
+    if failed:
+        sys.exit(1)
 
 
 if __name__ == '__main__':
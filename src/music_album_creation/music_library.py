@@ -0,0 +1,140 @@
+import hashlib
+import json
+import logging
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import click
+from tqdm import tqdm
+
+from . import configure_logging
+from .library_layout import infer_album_info, scan_albums
+from .metadata import MetadataDealer
+
+logger = logging.getLogger(__name__)
+
+
+class LibraryRetagger(object):
+    """
+    Writes metadata to the albums of a music library, inferring the artist, album and year from the directory layout and the
+    track numbers and names from the file names. Albums are tagged concurrently by a pool of threads. Every album tagged
+    without failures is appended to a checkpoint file, so that an interrupted run can resume where it stopped.\n
+    :param str checkpoint_file: where to record the tagged albums (one directory path per line); None to disable checkpoints
+    :param int nb_workers: number of albums to tag concurrently
+    :param dict tagging: keyword arguments for MetadataDealer.set_album_metadata (ie track_name, incremental, dry_run)
+    """
+    def __init__(self, checkpoint_file=None, nb_workers=8, **tagging):
+        self.checkpoint_file = checkpoint_file
+        self.nb_workers = nb_workers
+        self.tagging = tagging
+
+    def completed_albums(self):
+        """The album directories recorded in the checkpoint file"""
+        if not self.checkpoint_file or not os.path.isfile(self.checkpoint_file):
+            return set()
+        with open(self.checkpoint_file, 'r') as f:
+            return set(line.rstrip('\n') for line in f if line.strip())
+
+    def retag(self, album_directories, library_root=None, progress=True):
+        """
+        Call this method to tag the given albums, skipping the ones recorded in the checkpoint file. When all albums are
+        tagged without failures the checkpoint file is removed, so that a next run starts over.\n
+        :param list album_directories:
+        :param str library_root: the library directory; used so that it does not get inferred as an artist
+        :param bool progress: whether to render a progress bar
+        :return: the result of tagging each album not skipped, in the order they completed
+        :rtype: list of AlbumTaggingResult
+        """
+        completed = self.completed_albums()
+        albums = [os.path.abspath(x) for x in album_directories if os.path.abspath(x) not in completed]
+        if completed:
+            logger.info("Resuming: skipping {} albums already tagged".format(len(album_directories) - len(albums)))
+        results = []
+        checkpoint = open(self.checkpoint_file, 'a') if self.checkpoint_file and not self.tagging.get('dry_run') else None
+        executor = ThreadPoolExecutor(max_workers=self.nb_workers)
+        futures = [executor.submit(self._retag_album, album, library_root) for album in albums]
+        try:
+            for future in tqdm(as_completed(futures), total=len(futures), unit='album', disable=not progress):
+                result = future.result()
+                results.append(result)
+                if checkpoint is not None and not result.failed:
+                    checkpoint.write(result.album_directory + '\n')
+                    checkpoint.flush()
+        finally:  # on interruption, only wait for the albums being tagged at the moment
+            for future in futures:
+                future.cancel()
+            executor.shutdown(wait=True)
+            if checkpoint is not None:
+                checkpoint.close()
+        if checkpoint is not None and not any(x.failed for x in results):
+            os.remove(self.checkpoint_file)
+        return results
+
+    def _retag_album(self, album_directory, library_root):
+        info = infer_album_info(album_directory, library_root=library_root)
+        return MetadataDealer.set_album_metadata(album_directory, nb_workers=1, **dict(self.tagging, **info))
+
+
+def default_checkpoint_file(targets, **tagging):
+    """
+    The checkpoint file of a run tagging the given targets with the given options. The file name holds a hash of both, so that a
+    run never resumes (and skips the albums of) a different run interrupted before.\n
+    :param list targets: the library root, or the album directories, being tagged
+    :param dict tagging: the keyword arguments of the LibraryRetagger
+    :rtype: str
+    """
+    key = json.dumps([[os.path.realpath(x) for x in targets], tagging], sort_keys=True)
+    return os.path.join(_checkpoints_directory(), 'retag-{}.txt'.format(hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]))
+
+
+def _checkpoints_directory():
+    return os.path.join(os.path.expanduser('~'), '.cache', 'music_album_creation')
+
+
+@click.command()
+@click.option('--album-dir', '-d', 'album_dirs', multiple=True, help="An album directory to tag; can be given multiple times. "
+                                                                     "If not given, all albums found under MUSIC_LIB_ROOT are tagged.")
+@click.option('--track_name/--no-track_name', default=True, show_default=True, help='Whether to extract the track names from the mp3 files and write them as metadata correspondingly.')
+@click.option('--track_number/--no-track_number', default=True, show_default=True, help='Whether to extract the track numbers from the mp3 files and write them as metadata correspondingly.')
+@click.option('--incremental/--full', default=True, show_default=True, help="Whether to write only the frames that differ from the ones already in the files.")
+@click.option('--dry-run', '-n', is_flag=True, help="Only report the frames that differ from the ones already in the files, without writing anything.")
+@click.option('--workers', '-w', type=int, default=8, show_default=True, help="Number of albums to tag concurrently.")
+@click.option('--checkpoint', type=click.Path(dir_okay=False),
+              help="File recording the albums tagged, so that an interrupted run can resume.  "
+                   "[default: a file under {} specific to the albums and the options]".format(_checkpoints_directory()))
+@click.option('--restart', is_flag=True, help="Ignore the albums recorded in the checkpoint file and tag all of them.")
+def main(album_dirs, track_name, track_number, incremental, dry_run, workers, checkpoint, restart):
+    configure_logging()
+    library_root = os.getenv('MUSIC_LIB_ROOT', None)
+    if not album_dirs:
+        if library_root is None or not os.path.isdir(library_root):
+            click.echo("Please give album directories or set the environment variable MUSIC_LIB_ROOT to point to a directory that stores music.", err=True)
+            sys.exit(1)
+    tagging = dict(track_number=track_number, track_name=track_name, incremental=incremental, dry_run=dry_run)
+    checkpoint = checkpoint or default_checkpoint_file(album_dirs or [library_root], **tagging)
+    if not album_dirs:
+        album_dirs = list(scan_albums(library_root))
+    if restart and os.path.isfile(checkpoint):
+        os.remove(checkpoint)
+    if not os.path.isdir(os.path.dirname(os.path.abspath(checkpoint))):
+        os.makedirs(os.path.dirname(os.path.abspath(checkpoint)))
+    retagger = LibraryRetagger(checkpoint_file=checkpoint, nb_workers=workers, **tagging)
+    try:
+        results = retagger.retag(album_dirs, library_root=library_root)
+    except KeyboardInterrupt:
+        click.echo("\nInterrupted. Run the same command again to resume.", err=True)
+        sys.exit(130)
+    for result in results:
+        for outcome in result.changed if (incremental or dry_run) else []:
+            click.echo("{} '{}': {}".format('Would change' if dry_run else 'Changed', outcome.file, ', '.join(str(x) for x in outcome.changes)))
+        for outcome in result.failed:
+            click.echo("Failed to tag '{}': {}".format(outcome.file, outcome.error), err=True)
+    failed = [x for x in results if x.failed]
+    click.echo("Tagged {} albums; {} with failures".format(len(results) - len(failed), len(failed)))
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -5,6 +5,7 @@ from glob import glob
 
 import attr
 
+from . import profiling
 from .audio_segmentation import AudioSegmenter
 from .downloading import CMDYoutubeDownloader
 from .tracks_parsing import StringParser
@@ -13,11 +14,20 @@ from .web_parsing import video_title
 
 @attr.s
 class MusicMaster(object):
+    """
+    :param str music_library_path:
+    :param str download_dir: where to download audio; emptied on construction, so concurrent instances need distinct ones
+    :param float timeout: seconds allowed for a download, or an ffmpeg invocation; None for no limit
+    :param float stall_timeout: seconds allowed for a download, or an ffmpeg invocation, to make no progress; None for no limit
+    """
     music_library_path = attr.ib(init=True, repr=True)
-    segmenter = attr.ib(init=False, factory=AudioSegmenter)
+    download_dir = attr.ib(init=True, default=os.path.join(tempfile.gettempdir(), 'gav'))
+    timeout = attr.ib(init=True, default=None)
+    stall_timeout = attr.ib(init=True, default=None)
+    segmenter = attr.ib(init=False, default=attr.Factory(
+        lambda self: AudioSegmenter(timeout=self.timeout, stall_timeout=self.stall_timeout), takes_self=True))
     youtube = attr.ib(init=False, factory=CMDYoutubeDownloader)
-    download_dir = attr.ib(init=False, default=os.path.join(tempfile.gettempdir(), 'gav'))
-    _mp3s = attr.ib(init=False, default={})
+    _mp3s = attr.ib(init=False, factory=dict)
 
     def __attrs_post_init__(self):
         if os.path.isdir(self.download_dir):
@@ -33,10 +43,15 @@ class MusicMaster(object):
         return self._mp3s[url]
 
     def _download(self, url, suppress_certificate_validation=False):
-        self.youtube.download(url, self.download_dir, suppress_certificate_validation=suppress_certificate_validation)
-        latest_mp3 = max(glob("{}/*.mp3".format(self.download_dir)), key=os.path.getctime)
+        with profiling.stage('download'):
+            self.youtube.download(url, self.download_dir, suppress_certificate_validation=suppress_certificate_validation,
+                                  timeout=self.timeout, stall_timeout=self.stall_timeout)
+            latest_mp3 = max(glob("{}/*.mp3".format(self.download_dir)), key=os.path.getctime)
+            profiling.count('bytes_downloaded', os.path.getsize(latest_mp3))
         if os.path.basename(latest_mp3) == '_.mp3':
-            self.guessed_info = StringParser.parse_album_info(video_title(url)[0])
+            with profiling.stage('title_fetch'):
+                title = video_title(url)[0]
+            self.guessed_info = StringParser.parse_album_info(title)
             try:
                 new_file = os.path.join(self.download_dir, self.guessed_info['artist'])
                 os.rename(latest_mp3, new_file)
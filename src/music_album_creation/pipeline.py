@@ -0,0 +1,129 @@
+import logging
+import os
+import shutil
+
+import attr
+
+from . import profiling
+
+logger = logging.getLogger(__name__)
+
+
+class AlbumPipeline(object):
+    """
+    The steps of creating an album that need no interaction, shared by 'create-album' and 'create-album-batch', out of the
+    tracks segmented from an album file: analysing the tracks (fingerprints and loudness), finding the ones already in the
+    music library, storing them in an album directory, tagging and indexing them. Each step is a method, so that the
+    interactive command can ask the user in between. Only the tracks stored by this pipeline get tagged and indexed; files
+    already in the album directory are left untouched.\n
+    :param str album_file: the album the tracks got segmented out of
+    :param list tracks: the paths of the segmented tracks
+    :param SegmentationInformation segmentation_info: the spans the tracks got segmented by, in the order of the tracks
+    :param music_album_creation.library_index.LibraryIndex index: where duplicates are looked for and the album gets recorded
+    """
+    def __init__(self, album_file, tracks, segmentation_info, index):
+        self.album_file = album_file
+        self.tracks = tracks
+        self.segmentation_info = segmentation_info
+        self.index = index
+        self.fingerprints = {}
+        self.loudness = None
+        self.duplicates = []
+        self.album_directory = None
+        self.stored = []  # the paths of the tracks copied into the album directory
+        self.warnings = []
+        self._sources = {}  # the segmented track of each stored one
+
+    def analyze(self, replaygain=True, workspace=None):
+        """
+        Decodes the tracks, as slices of the album, once for both fingerprinting and measuring their loudness.\n
+        :param bool replaygain: whether to measure the loudness of the tracks
+        :param str workspace: the directory to decode in; defaults to a new temporary directory
+        :return: the warnings of this step (ie failing to measure the loudness)
+        :rtype: list
+        """
+        from .audio_analysis import (DecodingError, PcmCache, analyze_album,
+                                     fingerprint_files)
+        warnings = []
+        with profiling.stage('analysis', python=True), PcmCache(workspace=workspace) as pcm_cache:
+            for track, span in zip(self.tracks, self.segmentation_info):
+                pcm_cache.add_segment(track, self.album_file, span[1], span[2] if len(span) == 3 else None)
+            self.fingerprints = {t: f for t, f in zip(self.tracks, fingerprint_files(self.tracks, cache=pcm_cache)) if f is not None}
+            if replaygain:
+                try:
+                    self.loudness = analyze_album(self.tracks, cache=pcm_cache)
+                except DecodingError as e:
+                    warnings.append('Could not measure the loudness of the tracks: {}'.format(e))
+        self.warnings.extend(warnings)
+        return warnings
+
+    def find_duplicates(self):
+        """
+        Call this method after 'analyze' to find the tracks already in the library.\n
+        :return: the tracks found in the library, along with the indexed track they match
+        :rtype: list of music_album_creation.audio_analysis.Duplicate
+        """
+        from .audio_analysis import find_duplicates
+        with profiling.stage('duplicates', python=True):
+            self.duplicates = find_duplicates(self.index, self.fingerprints)
+        return self.duplicates
+
+    def store(self, album_directory, skip_duplicates=False):
+        """
+        Copies the tracks into the album directory, creating it if needed. A track whose file name already exists there does not
+        get copied, and neither do the duplicates (as found by 'find_duplicates') if 'skip_duplicates'.\n
+        :param str album_directory:
+        :param bool skip_duplicates: whether to leave out the tracks already in the library
+        :return: the warnings of this step (ie the tracks not copied)
+        :rtype: list
+        """
+        self.album_directory = album_directory
+        self.stored, self._sources = [], {}
+        if not os.path.isdir(album_directory):
+            os.makedirs(album_directory)
+        duplicates = set(x.track for x in self.duplicates) if skip_duplicates else set()
+        warnings = []
+        for track in self.tracks:
+            destination = os.path.join(album_directory, os.path.basename(track))
+            if track in duplicates:
+                warnings.append("Track '{}' is already in the library; skipped".format(os.path.basename(track)))
+            elif os.path.isfile(destination):
+                warnings.append("File '{}' already exists; skipped".format(destination))
+            else:
+                with profiling.stage('copy', track=os.path.basename(track)):
+                    shutil.copyfile(track, destination)
+                profiling.count('bytes_copied', os.path.getsize(destination))
+                self.stored.append(destination)
+                self._sources[destination] = track
+        self.warnings.extend(warnings)
+        return warnings
+
+    def tag(self, track_number=True, track_name=True, artist='', album_artist='', album='', year=''):
+        """
+        Writes the metadata, and the ReplayGain frames if the loudness got measured, to the stored tracks.\n
+        :return: the failure of each file that could not be tagged
+        :rtype: list of music_album_creation.metadata.TaggingOutcome
+        """
+        from .audio_analysis import AlbumLoudness, write_replaygain
+        from .metadata import MetadataDealer
+        with profiling.stage('tagging'):
+            tagging = MetadataDealer.set_album_metadata(self.album_directory, track_number=track_number, track_name=track_name, artist=artist,
+                                                        album_artist=album_artist, album=album, year=year, files=self.stored)
+        failed = list(tagging.failed)
+        if self.loudness is not None:  # measured on the segmented tracks; the same audio as the stored ones
+            sources = set(self._sources.values())
+            stored = [attr.evolve(x, file=os.path.join(self.album_directory, os.path.basename(x.file))) for x in self.loudness.tracks if x.file in sources]
+            with profiling.stage('replaygain'):
+                failed.extend(write_replaygain(AlbumLoudness(stored)).failed)
+        return failed
+
+    def index_album(self, video_id=None):
+        """
+        Records the album directory, and the fingerprints of the stored tracks, in the library index.\n
+        :param str video_id: the youtube video the album got downloaded from, if any
+        """
+        with profiling.stage('indexing', python=True):
+            self.index.add_album(self.album_directory, video_id=video_id)
+            for track in self.stored:
+                if self._sources[track] in self.fingerprints:
+                    self.index.set_fingerprint(track, self.fingerprints[self._sources[track]])
@@ -0,0 +1,274 @@
+import logging
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+
+import attr
+
+from . import profiling
+
+logger = logging.getLogger(__name__)
+
+
+@attr.s
+class WatchdogStatistics(object):
+    """Timing information gathered while supervising a subprocess. A 'stall' is a period with no progress (no output and no
+    growth of the watched files) lasting at least 'stall_threshold' seconds."""
+    elapsed = attr.ib(init=True, default=0.0)
+    nb_stalls = attr.ib(init=True, default=0)
+    longest_stall = attr.ib(init=True, default=0.0)
+    total_stalled = attr.ib(init=True, default=0.0)
+    bytes_read = attr.ib(init=True, default=0)
+
+    def __str__(self):
+        return "elapsed {:.1f}s, {} stall(s), longest stall {:.1f}s, stalled for {:.1f}s in total".format(
+            self.elapsed, self.nb_stalls, self.longest_stall, self.total_stalled)
+
+
+@attr.s
+class CompletedCommand(object):
+    args = attr.ib(init=True)
+    returncode = attr.ib(init=True)
+    stdout = attr.ib(init=True)
+    stderr = attr.ib(init=True)
+    statistics = attr.ib(init=True)
+
+
+class ProcessWatchdog(object):
+    """
+    Runs a command as a subprocess (in its own process group) and kills the whole group if the command runs for longer than
+    'timeout' seconds, or if it makes no progress for 'stall_timeout' seconds. Progress is any output on the captured
+    streams or growth in size of any of the 'watch_paths' given to 'run'. Both limits are optional; None disables them.
+    Once the command exits, its captured streams are read until they close; if a process it started (and left running) keeps
+    them open for longer than 'drain_timeout' seconds, the whole group gets killed.\n
+    :param float timeout: maximum seconds allowed for the whole command
+    :param float stall_timeout: maximum seconds allowed without any progress
+    :param float stall_threshold: minimum seconds without progress to be accounted as a stall in the statistics
+    :param float poll_interval: seconds between consecutive checks
+    :param float drain_timeout: maximum seconds to wait for the captured streams to close, once the command exits or gets killed
+    """
+    def __init__(self, timeout=None, stall_timeout=None, stall_threshold=1.0, poll_interval=0.1, drain_timeout=5.0):
+        self.timeout = timeout
+        self.stall_timeout = stall_timeout
+        self.stall_threshold = stall_threshold
+        self.poll_interval = poll_interval
+        self.drain_timeout = drain_timeout
+        self._cancelled = threading.Event()
+
+    def cancel(self):
+        """Kills the supervised command (within 'poll_interval' seconds), from any thread; 'run' raises a CommandCancelledError"""
+        self._cancelled.set()
+
+    def run(self, args, capture_stdout=False, capture_stderr=False, echo_stdout=False, watch_paths=(), on_stdout=None):
+        """
+        Call this method to execute a command under supervision.\n
+        :param list args: the command line arguments
+        :param bool capture_stdout: whether to pipe and store the standard output
+        :param bool capture_stderr: whether to pipe and store the standard error
+        :param bool echo_stdout: whether to also forward the (piped) standard output to the terminal
+        :param list watch_paths: files whose growth in size counts as progress of the command
+        :param callable on_stdout: if given, the standard output gets piped and each chunk (bytes) read gets passed to it
+        :return: the return code, the captured streams (bytes or None) and the gathered statistics
+        :rtype: CompletedCommand
+        """
+        popen_kwargs = {}
+        if os.name == 'posix':
+            popen_kwargs['start_new_session'] = True  # so that the whole process group can be killed
+        pipe_stdout = capture_stdout or echo_stdout or on_stdout is not None
+        process = subprocess.Popen(args, stdout=subprocess.PIPE if pipe_stdout else None,
+                                   stderr=subprocess.PIPE if capture_stderr else None, **popen_kwargs)
+        profiling.count_subprocess(args)
+        monitor = _ProgressMonitor(self.stall_threshold)
+        readers = []
+        if pipe_stdout:
+            readers.append(_StreamReader(process.stdout, monitor, store=capture_stdout, echo=echo_stdout, callback=on_stdout))
+        if capture_stderr:
+            readers.append(_StreamReader(process.stderr, monitor, store=True))
+        sizes = {path: -1 for path in watch_paths}
+        try:
+            while process.poll() is None:
+                self._check_files(sizes, monitor)
+                now = monitor.clock()
+                if self._cancelled.is_set():
+                    self._kill(process, readers)
+                    raise CommandCancelledError(args, None, monitor.statistics())
+                if self.timeout is not None and self.timeout < now - monitor.started:
+                    self._kill(process, readers)
+                    raise CommandTimeoutError(args, self.timeout, monitor.statistics())
+                if self.stall_timeout is not None and self.stall_timeout < now - monitor.last_progress:
+                    self._kill(process, readers)
+                    raise CommandStalledError(args, self.stall_timeout, monitor.statistics())
+                time.sleep(self.poll_interval)
+        except KeyboardInterrupt:  # the subprocess lives in its own session, so it would not receive the signal
+            self._kill(process, readers)
+            raise
+        self._drain(process, readers)
+        statistics = monitor.statistics()
+        if statistics.nb_stalls:
+            logger.info("Command '{}' stalled: {}".format(' '.join(args), statistics))
+        return CompletedCommand(args, process.returncode, readers[0].data if capture_stdout else None,
+                                readers[-1].data if capture_stderr else None, statistics)
+
+    @staticmethod
+    def _check_files(sizes, monitor):
+        for path, previous_size in sizes.items():
+            try:
+                size = os.path.getsize(path)
+            except OSError:
+                continue
+            if previous_size < size:
+                sizes[path] = size
+                monitor.progress(0)
+
+    def _kill(self, process, readers):
+        self._kill_group(process)
+        process.wait()
+        self._join(readers)
+
+    def _drain(self, process, readers):
+        """Waits for the streams of the exited command to close; kills its process group if any of them stays open"""
+        if self._join(readers):
+            return
+        logger.warning("Command '{}' exited, but its output stays open after {} seconds; killing its process group".format(
+            ' '.join(process.args), self.drain_timeout))
+        self._kill_group(process)
+        if not self._join(readers):
+            logger.warning("The output of command '{}' stays open; no longer reading it".format(' '.join(process.args)))
+
+    def _join(self, readers):
+        """Waits, for up to 'drain_timeout' seconds in total, for the readers to finish; returns whether they all did"""
+        deadline = time.monotonic() + self.drain_timeout
+        for reader in readers:
+            reader.join(max(0, deadline - time.monotonic()))
+        return not any(reader.is_alive() for reader in readers)
+
+    @staticmethod
+    def _kill_group(process):
+        try:
+            if os.name == 'posix':
+                os.killpg(process.pid, signal.SIGKILL)
+            else:
+                process.kill()
+        except OSError:  # already exited
+            pass
+
+
+class _ProgressMonitor(object):
+    clock = staticmethod(time.monotonic)
+
+    def __init__(self, stall_threshold):
+        self._threshold = stall_threshold
+        self._lock = threading.Lock()
+        self.started = self.clock()
+        self.last_progress = self.started
+        self.nb_stalls = 0
+        self.longest_stall = 0.0
+        self.total_stalled = 0.0
+        self.bytes_read = 0
+
+    def progress(self, nb_bytes):
+        with self._lock:
+            now = self.clock()
+            self._account(now - self.last_progress)
+            self.last_progress = now
+            self.bytes_read += nb_bytes
+
+    def _account(self, gap):
+        if self._threshold <= gap:
+            self.nb_stalls += 1
+            self.longest_stall = max(self.longest_stall, gap)
+            self.total_stalled += gap
+
+    def statistics(self):
+        with self._lock:
+            now = self.clock()
+            statistics = WatchdogStatistics(elapsed=now - self.started, nb_stalls=self.nb_stalls, longest_stall=self.longest_stall,
+                                            total_stalled=self.total_stalled, bytes_read=self.bytes_read)
+        gap = now - self.last_progress  # the trailing period without progress, up until now
+        if self._threshold <= gap:
+            statistics.nb_stalls += 1
+            statistics.longest_stall = max(statistics.longest_stall, gap)
+            statistics.total_stalled += gap
+        return statistics
+
+
+class _StreamReader(object):
+    """Drains a subprocess pipe in a daemon thread, reporting every chunk read as progress"""
+    chunk_size = 4096
+
+    def __init__(self, stream, monitor, store=True, echo=False, callback=None):
+        self._stream = stream
+        self._monitor = monitor
+        self._store = store
+        self._echo = echo
+        self._callback = callback
+        self._chunks = []
+        self._thread = threading.Thread(target=self._read)
+        self._thread.daemon = True
+        self._thread.start()
+
+    @property
+    def data(self):
+        return b''.join(self._chunks)
+
+    def _read(self):
+        fd = self._stream.fileno()
+        while True:
+            try:
+                chunk = os.read(fd, self.chunk_size)
+            except OSError:
+                break
+            if not chunk:
+                break
+            self._monitor.progress(len(chunk))
+            if self._store:
+                self._chunks.append(chunk)
+            if self._echo:
+                _echo(chunk)
+            if self._callback is not None:
+                self._callback(chunk)
+        self._stream.close()
+
+    def join(self, timeout=None):
+        self._thread.join(timeout)
+
+    def is_alive(self):
+        return self._thread.is_alive()
+
+
+def _echo(chunk):
+    out = getattr(sys.stdout, 'buffer', None)
+    if out is None:
+        sys.stdout.write(chunk.decode('utf-8', 'replace'))
+    else:
+        out.write(chunk)
+    sys.stdout.flush()
+
+
+class SubprocessWatchdogError(Exception):
+    """Raised when a supervised subprocess gets killed; carries the command arguments and the gathered statistics"""
+    def __init__(self, args, limit, statistics, msg):
+        super(SubprocessWatchdogError, self).__init__(msg)
+        self.command = args
+        self.limit = limit
+        self.statistics = statistics
+
+
+class CommandTimeoutError(SubprocessWatchdogError):
+    def __init__(self, args, limit, statistics):
+        super(CommandTimeoutError, self).__init__(args, limit, statistics, "Command '{}' killed after running for more than {} seconds ({})".format(
+            ' '.join(args), limit, statistics))
+
+
+class CommandStalledError(SubprocessWatchdogError):
+    def __init__(self, args, limit, statistics):
+        super(CommandStalledError, self).__init__(args, limit, statistics, "Command '{}' killed after making no progress for {} seconds ({})".format(
+            ' '.join(args), limit, statistics))
+
+
+class CommandCancelledError(SubprocessWatchdogError):
+    def __init__(self, args, limit, statistics):
+        super(CommandCancelledError, self).__init__(args, limit, statistics, "Command '{}' killed on cancellation ({})".format(' '.join(args), statistics))
@@ -0,0 +1,198 @@
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+from contextlib import ExitStack, contextmanager
+
+from . import events
+
+logger = logging.getLogger(__name__)
+
+# the profilers recording; the module level hooks below cost a list check when there are none (ie always, unless profiling)
+_active = []
+
+
+@contextmanager
+def stage(name, python=False, **info):
+    """
+    Times the enclosed block as a stage of the active profiler, if any (see Profiler.stage), and publishes its StageStarted
+    and StageFinished events, if anybody subscribed to them (see music_album_creation.events).\n
+    :param str name: ie 'download', 'cut', 'tagging'
+    :param bool python: whether the stage runs Python code (as opposed to waiting on subprocesses or I/O), so that it is
+    worth profiling with cProfile
+    :param info: json serializable details to record with the stage's timing; ie track='01 - Intro.mp3'
+    """
+    if not _active and not events.bus.subscribed:
+        yield
+        return
+    events.publish(events.StageStarted, stage=name, info=info)
+    start, error = time.perf_counter(), None
+    try:
+        with ExitStack() as stack:
+            if _active:
+                stack.enter_context(_active[-1].stage(name, python=python, **info))
+            yield
+    except BaseException as e:
+        error = type(e).__name__
+        raise
+    finally:
+        events.publish(events.StageFinished, stage=name, elapsed=time.perf_counter() - start, error=error)
+
+
+def count(name, amount=1):
+    """Adds to a counter of the active profiler, if any; ie count('bytes_copied', 1024)"""
+    if _active:
+        _active[-1].count(name, amount=amount)
+
+
+def count_subprocess(args):
+    """Counts a spawned subprocess, in total and per program; ie 'subprocesses' and 'subprocesses.ffmpeg'"""
+    if _active:
+        _active[-1].count('subprocesses')
+        _active[-1].count('subprocesses.{}'.format(os.path.basename(args[0])))
+
+
+class Profiler(object):
+    """
+    Records where the wall time of a run goes: the timing of every stage (and every track, for the per track stages),
+    counters of bytes moved and subprocesses spawned, and the peak resident memory of the process and of its subprocesses.
+    Pipeline components report to the active profiler through the module level 'stage' and 'count' functions, which do
+    nothing while no profiler is active; a profiler is active from 'start' (or entering it as a context manager) to 'stop'.
+
+    Optionally, the Python-side stages are profiled with cProfile (one profile per stage name, dumped as '<stage>.prof') and
+    memory allocations are traced with tracemalloc (the top allocating lines dumped to 'tracemalloc.txt'). cProfile only
+    sees the thread that entered the stage and only one stage is profiled at a time.\n
+    :param str report_file: where to write the json report on 'stop'; None to only get it from 'report'
+    :param bool python_profiling: whether to profile the Python-side stages with cProfile and trace allocations
+    :param str dump_directory: where to dump the cProfile and tracemalloc outputs; defaults to the report's directory
+    """
+    def __init__(self, report_file=None, python_profiling=False, dump_directory=None):
+        self.report_file = report_file
+        self.python_profiling = python_profiling
+        self.dump_directory = dump_directory or os.path.dirname(os.path.abspath(report_file or 'profile.json'))
+        self.started = None
+        self.elapsed = None
+        self._stages = []
+        self._counters = OrderedDict()
+        self._profiles = OrderedDict()
+        self._profiling = False
+        self._snapshot = None
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def start(self):
+        self.started = time.time()
+        if self.python_profiling:
+            import tracemalloc
+            tracemalloc.start()
+        _active.append(self)
+        return self
+
+    def stop(self):
+        _active.remove(self)
+        self.elapsed = time.time() - self.started
+        if self.python_profiling:
+            import tracemalloc
+            self._snapshot = tracemalloc.take_snapshot()
+            self._counters['traced_memory_peak'] = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            self.dump(self.dump_directory)
+        if self.report_file:
+            self.save(self.report_file)
+            logger.info("Profiling report written to '{}'".format(self.report_file))
+
+    @contextmanager
+    def stage(self, name, python=False, **info):
+        record = OrderedDict([('stage', name), ('start', round(time.time() - self.started, 6))])
+        record.update(info)
+        profile = self._start_profile(name) if self.python_profiling and python else None
+        start = time.perf_counter()
+        try:
+            yield
+        except BaseException as e:
+            record['error'] = type(e).__name__
+            raise
+        finally:
+            record['elapsed'] = round(time.perf_counter() - start, 6)
+            if profile is not None:
+                profile.disable()
+                self._profiling = False
+            with self._lock:
+                self._stages.append(record)
+
+    def _start_profile(self, name):
+        with self._lock:
+            if self._profiling:  # a profile per thread is not possible; the stages running concurrently go unprofiled
+                return None
+            self._profiling = True
+        if name not in self._profiles:
+            import cProfile
+            self._profiles[name] = cProfile.Profile()
+        try:
+            self._profiles[name].enable()
+        except ValueError as e:  # another profiling tool is active
+            logger.warning("Could not profile stage '{}': {}".format(name, e))
+            self._profiling = False
+            return None
+        return self._profiles[name]
+
+    def count(self, name, amount=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + amount
+
+    def report(self):
+        """
+        :return: the stages in the order they finished, per stage name totals, the counters and the peak memory usage
+        :rtype: dict
+        """
+        with self._lock:
+            stages, counters = list(self._stages), OrderedDict(self._counters)
+        totals = OrderedDict()
+        for record in stages:
+            total = totals.setdefault(record['stage'], OrderedDict([('count', 0), ('elapsed', 0.0)]))
+            total['count'] += 1
+            total['elapsed'] = round(total['elapsed'] + record['elapsed'], 6)
+        return OrderedDict([('started', self.started),
+                            ('elapsed', round(self.elapsed if self.elapsed is not None else time.time() - self.started, 6)),
+                            ('totals', totals),
+                            ('counters', counters),
+                            ('peak_rss', peak_rss()),
+                            ('stages', stages)])
+
+    def save(self, file_path):
+        with open(file_path, 'w') as f:
+            json.dump(self.report(), f, indent=2)
+
+    def dump(self, directory):
+        """Writes the cProfile statistics of each profiled stage and the top allocating lines traced by tracemalloc"""
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        for name, profile in self._profiles.items():
+            profile.dump_stats(os.path.join(directory, '{}.prof'.format(name)))
+        if self._snapshot is not None:
+            with open(os.path.join(directory, 'tracemalloc.txt'), 'w') as f:
+                for statistic in self._snapshot.statistics('lineno')[:50]:
+                    f.write('{}\n'.format(statistic))
+
+
+def peak_rss():
+    """
+    :return: the peak resident memory, in bytes, of this process and of its largest (waited for) subprocess; None where not
+    supported (ie on Windows)
+    :rtype: dict
+    """
+    try:
+        import resource
+    except ImportError:
+        return {'process': None, 'subprocesses': None}
+    unit = 1 if sys.platform == 'darwin' else 1024  # ru_maxrss is in bytes on macOS and kilobytes on Linux
+    return OrderedDict([('process', resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * unit),
+                        ('subprocesses', resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * unit)])
@@ -2,7 +2,12 @@
 
 import os
 import re
-import time
+from functools import lru_cache
+from itertools import accumulate
+
+import attr
+
+from .tracks_tokenizer import tokenize_track_line
 
 
 class StringToDictParser(object):
@@ -14,16 +19,34 @@ class StringToDictParser(object):
             raise RuntimeError
         self.entities = {k: AlbumInfoEntity(k, v) for k, v in entities.items()}
         self.separators = separators
+        self._designs = {}
 
     def __call__(self, *args, **kwargs):
+        """Tries the designs in the given order (of priority) and returns the dict with the most fields extracted; on ties, the
+        one of the earliest design. Stops as soon as none of the remaining designs can extract more fields."""
         title = args[0]
-        design = kwargs['design']
-        if not all(0 <= len(x) <= len(self.entities) + len(self.separators) and all(type(y) == str for y in x) for x in design):
-            raise RuntimeError
-        if not all(all(StringToDictParser.check.match(y) for y in x if y.startswith('s')) for x in design):
-            raise RuntimeError
-        rregs = [RegexSequence([_ for _ in self._yield_reg_comp(d)]) for d in design]
-        return max([r.search_n_dict(title) for r in rregs], key=lambda x: len(x))
+        sequences, max_fields = self._compile(kwargs['design'])
+        best = {}
+        for sequence, remaining_max_fields in zip(sequences, max_fields):
+            if remaining_max_fields <= len(best):
+                break
+            result = sequence.search_n_dict(title)
+            if len(best) < len(result):
+                best = result
+        return best
+
+    def _compile(self, design):
+        """Validates and compiles a design once; returns its RegexSequences along with the most fields each suffix of them can extract"""
+        key = tuple(tuple(x) for x in design)
+        if key not in self._designs:
+            if not all(0 <= len(x) <= len(self.entities) + len(self.separators) and all(type(y) == str for y in x) for x in design):
+                raise RuntimeError
+            if not all(all(StringToDictParser.check.match(y) for y in x if y.startswith('s')) for x in design):
+                raise RuntimeError
+            sequences = [RegexSequence([_ for _ in self._yield_reg_comp(d)]) for d in design]
+            max_fields = [max(len(r.keys) for r in sequences[i:]) for i in range(len(sequences))]
+            self._designs[key] = (sequences, max_fields)
+        return self._designs[key]
 
     def _yield_reg_comp(self, kati):
         for k in kati:
@@ -44,10 +67,14 @@ class AlbumInfoEntity(object):
 class RegexSequence(object):
     def __init__(self, data):
         self._keys = [d.name for d in data if hasattr(d, 'name')]
-        self._regex = r'{}'.format(''.join(str(d) for d in data))
+        self._regex = re.compile(r'{}'.format(''.join(str(d) for d in data)))
+
+    @property
+    def keys(self):
+        return list(self._keys)
 
     def search_n_dict(self, string):
-        return dict(_ for _ in zip(self._keys, list(getattr(re.search(self._regex, string), 'groups', lambda: len(self._keys)*[''])())) if _[1])
+        return dict(_ for _ in zip(self._keys, list(getattr(self._regex.search(string), 'groups', lambda: len(self._keys)*[''])())) if _[1])
 
 
 class StringParser(object):
@@ -59,6 +86,7 @@ class StringParser(object):
                'sep2': r'(?: [\t\ ]* [\-.]+ [\t\ ]* | [\t\ ]+ )',
                'extension': r'\.mp3',
                'hhmmss': r'(?:\d?\d:)*\d?\d'}
+    regexes['track_name'] = r'{track_word}(?:{track_sep}{track_word})*'.format(**regexes)
 
     ## to parse from youtube video title string
     sep1 = r'[\t ]*[\-\.][\t ]*'
@@ -68,11 +96,14 @@ class StringParser(object):
     alb = r'([\w ]*\w)'
 
     album_info_parser = StringToDictParser({'artist': art, 'album': alb, 'year': year}, [sep1, sep2])
+    album_info_design = [['artist', 's1', 'album', 's2', 'year'],
+                         ['artist', 's1', 'album'],
+                         ['album', 's2', 'year'],
+                         ['album']]
 
     def __new__(cls, *args, **kwargs):
         if not cls.__instance:
             cls.__instance = super(cls, StringParser).__new__(cls)
-            cls.regexes['track_name'] = r'{track_word}(?:{track_sep}{track_word})*'.format(**cls.regexes)
         return cls.__instance
 
     ## STRING TO DICT
@@ -88,18 +119,12 @@ class StringParser(object):
         :return: the exracted values as a dictionary having maximally keys: {'artist', 'album', 'year'}
         :rtype: dict
         """
-        return cls.album_info_parser(video_title, design=[['artist', 's1', 'album', 's2', 'year'],
-                                                          ['artist', 's1', 'album'],
-                                                          ['album', 's2', 'year'],
-                                                          ['album']])
+        return dict(_parse_album_info(video_title))
     # PARSE filenames
     @classmethod
     def parse_track_number_n_name(cls, file_name):
         """Call this method to get a dict like {'track_number': 'number', 'track_name': 'name'} from input file name with format like '1. - Loyal to the Pack.mp3'; number must be included!"""
-        return dict(zip(['track_number', 'track_name'], list(
-            re.compile(r"(?: ({track_number}) {sep1})? ( {track_name} ) {extension}$".format(**cls.regexes), re.X).search(
-                os.path.basename(file_name)).groups())))
-        # return dict(zip(['track_number', 'track_name'], list(re.compile(r'({}){}({}){}$'.format(cls.track_number, cls.sep2, cls.track_name, cls.extension)).search(file_name).groups())))
+        return cls.engine.parse_file_name(file_name)
 
     # PARSE tracks info multiline
     @classmethod
@@ -116,13 +141,12 @@ class StringParser(object):
         :param str tracks: a '\n' separable string of lines coresponding to the tracks information
         :return:
         """
-        # regex = re.compile('(?:\d{1,2}[ \t]*[\.\-,][ \t]*|[\t ]+)?([\w\'\(\) ]*[\w)])' + cls.sep + '((?:\d?\d:)*\d?\d)$')
         for i, line in enumerate(_.strip() for _ in tracks.split('\n')):
             if line == '':
                 continue
             try:
-                yield cls._parse_track_line(line)
-            except AttributeError as e:
+                yield cls.engine.parse_track_line(line)
+            except TrackParsingError as e:
                 print("Couldn't parse line {}: '{}'. Please use a format as 'trackname - 3:45'".format(i + 1, line))
                 raise e
 
@@ -134,13 +158,7 @@ class StringParser(object):
         :return: the parsed items
         :rtype: list
         """
-        # regex = re.compile(r"""^(?:\d{1,2}(?:[\ \t]*[\.\-,][\ \t]*|[\t\ ]+))?  # potential track number (eg 01) included is ignored
-        #                             ([\w\'\(\) \-’]*[\w)])                       # track name
-        #                             (?:[\t ]+|[\t ]*[\-\.]+[\t ]*)            # separator between name and time
-        #                             ((?:\d?\d:)*\d?\d)$                       # time in hh:mm:ss format""", re.X)
-        # regex = re.compile(r"^(?:{}{})?({}){}({})$".format(cls.track_number, cls.number_name_sep, cls.track_name, cls.sep, cls.hhmmss))
-        regex = re.compile(r"(?: {track_number} {sep1})? ( {track_name} ) {sep2} ({hhmmss})".format(**cls.regexes), re.X)
-        return list(regex.search(track_line.strip()).groups())
+        return cls.engine.parse_track_line(track_line)
 
     # CONVERT durations to timestamps tuples (segmentation start-end pair)
     @classmethod
@@ -151,13 +169,8 @@ class StringParser(object):
         :return: the list of each track's timestamp
         :rtype: list
         """
-        lines = cls.parse_hhmmss_string(tracks_row_strings)  # list of lists
-        i = 1
-        timestamps = ['0:00']
-        while i < len(lines):
-            timestamps.append(cls.add(timestamps[i-1], lines[i-1][-1]))
-            i += 1
-        return timestamps
+        durations = [cls.to_seconds(x[-1]) for x in cls.parse_hhmmss_string(tracks_row_strings)[:-1]]
+        return ['0:00'] + [cls.hhmmss_format(x) for x in accumulate(durations)]
 
     @classmethod
     def add(cls, timestamp1, duration):
@@ -177,5 +190,106 @@ class StringParser(object):
 
     @staticmethod
     def hhmmss_format(seconds):
-        """Call this method to transform an integer representing time duration in seconds to its equivalent hh:mm:ss formatted string representeation"""
-        return time.strftime('%H:%M:%S', time.gmtime(seconds))
+        """Call this method to transform an integer representing time duration in seconds to its equivalent hh:mm:ss formatted string representeation.
+        Hours do not wrap around at 24 (ie 90000 seconds give '25:00:00'), so that mixes longer than a day are supported."""
+        minutes, seconds = divmod(int(seconds), 60)
+        hours, minutes = divmod(minutes, 60)
+        return '{:02d}:{:02d}:{:02d}'.format(hours, minutes, seconds)
+
+
+@lru_cache(maxsize=1024)
+def _parse_album_info(video_title):
+    """Bounded memo of the album information parsed per title; callers get a copy of the (shared) cached dict"""
+    return StringParser.album_info_parser(video_title, design=StringParser.album_info_design)
+
+
+class TrackParser(object):
+    """
+    Parses track lines (ie 'NN. track name - hh:mm:ss') and track file names (ie 'NN - track name.mp3'). Track lines are
+    split by the linear time tokenizer (see tracks_tokenizer) and file names are matched with a grammar compiled once, at
+    construction. Instances are immutable, so a single one can be shared between threads.
+    """
+    __slots__ = ('_track_file',)
+
+    def __init__(self):
+        object.__setattr__(self, '_track_file', re.compile(
+            r"(?: ({track_number}) {sep1})? ( {track_name} ) {extension}$".format(**StringParser.regexes), re.X))
+
+    def __setattr__(self, key, value):
+        raise AttributeError("'{}' objects are immutable".format(type(self).__name__))
+
+    def parse_track_line(self, track_line):
+        """
+        Parses a string line such as '01. Doteru 3:45' into ['Doteru', '3:45']\n
+        :param str track_line:
+        :return: the track name and the hh:mm:ss string
+        :rtype: list
+        """
+        tokens = tokenize_track_line(track_line)
+        if tokens is None:
+            raise TrackParsingError("Could not parse track line '{}'. Please use a format as 'trackname - 3:45'".format(track_line))
+        return list(tokens)
+
+    def parse_file_name(self, file_name):
+        """
+        Parses a file name (or path) such as '01 - Loyal to the Pack.mp3' into {'track_number': '01', 'track_name': 'Loyal to the Pack'}\n
+        :param str file_name:
+        :rtype: dict
+        """
+        match = self._track_file.search(os.path.basename(file_name))
+        if not match:
+            raise TrackParsingError("Could not parse track number and name out of file '{}'".format(file_name))
+        return dict(zip(['track_number', 'track_name'], match.groups()))
+
+    def parse_tracklist(self, tracks):
+        """
+        Parses all lines of a '\n' separable string (eg copy-pasted from a video description) without stopping at the first
+        line that fails to parse. Empty lines are ignored.\n
+        :param str tracks:
+        :return: the [track_name, hhmmss] pairs of the parsed lines and a ParsingFailure per line that failed (line numbers are 1-based)
+        :rtype: BatchParsingResult
+        """
+        parsed, failures = [], []
+        for i, line in enumerate(_.strip() for _ in tracks.split('\n')):
+            if line == '':
+                continue
+            try:
+                parsed.append(self.parse_track_line(line))
+            except TrackParsingError as e:
+                failures.append(ParsingFailure(i + 1, line, str(e)))
+        return BatchParsingResult(parsed, failures)
+
+    def parse_file_names(self, file_names):
+        """
+        Parses many file names (or paths) in one call, without stopping at the first one that fails to parse.\n
+        :param iterable file_names:
+        :return: a dict mapping each parsed file name to its {'track_number', 'track_name'} dict and a ParsingFailure per file
+         name that failed (positions are 0-based indices in the input)
+        :rtype: BatchParsingResult
+        """
+        parsed, failures = {}, []
+        for i, file_name in enumerate(file_names):
+            try:
+                parsed[file_name] = self.parse_file_name(file_name)
+            except TrackParsingError as e:
+                failures.append(ParsingFailure(i, file_name, str(e)))
+        return BatchParsingResult(parsed, failures)
+
+
+@attr.s(frozen=True)
+class ParsingFailure(object):
+    position = attr.ib(init=True)
+    text = attr.ib(init=True)
+    message = attr.ib(init=True)
+
+
+@attr.s(frozen=True)
+class BatchParsingResult(object):
+    parsed = attr.ib(init=True)
+    failures = attr.ib(init=True)
+
+
+class TrackParsingError(Exception): pass
+
+
+StringParser.engine = TrackParser()
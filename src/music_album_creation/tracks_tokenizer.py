@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+"""
+A tokenizer for track lines, such as '01. Track name - 3:45', that runs in time linear to the length of the line.
+
+It accepts exactly the language of the StringParser.regexes track line grammar:
+
+    (?: {track_number} {sep1})? ( {track_name} ) {sep2} ({hhmmss})
+
+and extracts the same (track_name, hhmmss) pair a (leftmost, greedy) 're' search would. The 'track_name' regex,
+{track_word}(?:{track_sep}{track_word})*, gets backtracked over every position its last word can end at, for every
+starting position of the search, which becomes quadratic on long lines lacking a timestamp. Instead, the tokenizer
+evaluates, per word run, the furthest position a track name can end at (and still be followed by a separator and a
+hh:mm:ss string) once, and shares it between all searches reaching that word run.
+"""
+
+import re
+
+_SEP1_MARKS = frozenset('.-)')
+_SEP2_MARKS = frozenset('-.')
+_SPACES = frozenset(' \t')
+
+# the two character classes of the 'track_word' regex
+_WORD_START = u"[\\wα-ωΑ-Ω'\\x86-\\xce\\u0384-\\u03CE]"
+_WORD_CHAR = u"[\\w\\-’':!\\xc3\\xa8α-ωΑ\\-Ω\\x86-\\xce\\u0384-\\u03CE]"
+
+# single character class runs; none of them requires backtracking to be matched
+_digit = re.compile(r'\d')
+_word_start = re.compile(_WORD_START)
+_words = re.compile(u'{}+'.format(_WORD_CHAR))
+_spaces = re.compile(r'[\t ]*')
+_sep1_marks = re.compile(r'[.\-)]*')
+_sep2_marks = re.compile(r'[\-.]*')
+_track_seps = re.compile(r'[\t ,]*')
+
+
+class _TrackLine(object):
+    """Memoized lookups over a track line; every character run gets scanned a bounded number of times"""
+
+    def __init__(self, line):
+        self.line = line
+        self.n = len(line)
+        self.digits = [False] * (self.n + 1)
+        for m in _digit.finditer(line):
+            self.digits[m.start()] = True
+        self.word_end = list(range(self.n + 1))
+        self.word_run_start = {}
+        for m in _words.finditer(line):
+            a, b = m.span()
+            self.word_end[a:b] = [b] * (b - a)
+            self.word_run_start[b] = a
+        self._tail_reach = {}
+        self._inner_reach = {}
+
+    def _skip(self, run, p):
+        return run.match(self.line, p).end()
+
+    def time_start(self, p):
+        """Matches the 'sep2' regex at position p and returns the position where the hh:mm:ss string starts; -1 if there is none"""
+        line, n = self.line, self.n
+        if p < n and line[p] in _SPACES:
+            a = self._skip(_spaces, p)
+            if a < n and line[a] in _SEP2_MARKS:
+                q = self._skip(_spaces, self._skip(_sep2_marks, a))
+            else:
+                q = a
+        elif p < n and line[p] in _SEP2_MARKS:
+            q = self._skip(_spaces, self._skip(_sep2_marks, p))
+        else:
+            return -1
+        return q if self.digits[q] else -1
+
+    def track_number_end(self, s, length):
+        """Matches {track_number}{sep1} at position s, with a number of 'length' digits, and returns where the track name starts"""
+        if self.n < s + length or not all(self.digits[s:s + length]):
+            return -1
+        a = self._skip(_spaces, s + length)
+        if a < self.n and self.line[a] in _SEP1_MARKS:
+            return self._skip(_spaces, self._skip(_sep1_marks, a))
+        return a
+
+    def name_reach(self, i):
+        """Furthest position a track name starting at position i can end at; -1 if no track name can start at i"""
+        if i < self.n and self.line[i] == '(':
+            i += 1
+        if not _word_start.match(self.line, i):
+            return -1
+        e = self.word_end[i]
+        furthest = self.tail_reach(e)
+        if furthest == -1:
+            furthest = self.inner_reach(e)
+        return furthest if i < furthest else -1
+
+    def _closing(self, e):
+        """Position after the word run ending at e, including its (optional) closing parenthesis"""
+        return e + 1 if e < self.n and self.line[e] == ')' else e
+
+    def _next_word(self, e):
+        """Position where the body of the word following the word run ending at e starts; -1 if the track name can not continue"""
+        w = self._closing(e)
+        i = self._skip(_track_seps, w)
+        if i == w:
+            return -1
+        if i < self.n and self.line[i] == '(':
+            i += 1
+        return i if _word_start.match(self.line, i) else -1
+
+    def tail_reach(self, e):
+        """Furthest position a track name can end at, past the word run ending at e; -1 if it can only end inside the word run"""
+        chain, e0 = [], e
+        furthest = -1
+        while True:  # follow the chain of words iteratively, so that long lines do not hit the recursion limit
+            if e in self._tail_reach:
+                furthest = self._tail_reach[e] if self._tail_reach[e] != -1 else self.inner_reach(e)
+                break
+            chain.append(e)
+            i = self._next_word(e)
+            if i == -1:
+                break
+            e = self.word_end[i]
+        for e in reversed(chain):
+            w = self._closing(e)
+            if furthest == -1 and w != e and self.time_start(w) != -1:
+                furthest = w
+            self._tail_reach[e] = furthest
+            if furthest == -1:  # reached as a continuation, the track name can also end inside this word run
+                furthest = self.inner_reach(e)
+        return self._tail_reach[e0]
+
+    def inner_reach(self, e):
+        """Furthest position, after the first character of the word run ending at e, a track name can end at; -1 if there is none"""
+        if e not in self._inner_reach:
+            a = self.word_run_start[e]
+            furthest = e if self.time_start(e) != -1 else -1
+            # inside a word run only a '-' can start a 'sep2'; it has to be followed by a digit, after the run of '-' it belongs to
+            past_dashes, p = e, e - 1
+            if furthest == -1 and a < p and self.line[p] == '-' and self.time_start(p) != -1:
+                furthest = p  # the '-' run reaches the end of the word run, where 'sep2' may continue
+            while furthest == -1 and a < p:
+                if self.line[p] != '-':
+                    past_dashes = p
+                elif past_dashes < e and self.digits[past_dashes]:
+                    furthest = p
+                p -= 1
+            self._inner_reach[e] = furthest
+        return self._inner_reach[e]
+
+    def hhmmss(self, q):
+        """Matches the (greedy) 'hhmmss' regex at position q; expects a digit there"""
+        digits, line = self.digits, self.line
+        pos = previous = q
+        while digits[pos]:
+            if digits[pos + 1] and pos + 2 < self.n and line[pos + 2] == ':':
+                previous, pos = pos, pos + 3
+            elif pos + 1 < self.n and line[pos + 1] == ':':
+                previous, pos = pos, pos + 2
+            else:
+                break
+        if not digits[pos]:  # the last 'dd:' group is given back for the final digits
+            pos = previous
+        return line[q:pos + 2] if digits[pos + 1] else line[q:pos + 1]
+
+
+def tokenize_track_line(track_line):
+    """
+    Splits a string line such as '01. Doteru - 3:45' into its track name and its hh:mm:ss time, in time linear to the length
+    of the line.\n
+    :param str track_line:
+    :return: the track name and the hh:mm:ss string or None if the line does not contain a track
+    :rtype: tuple
+    """
+    line = track_line.strip()
+    if not _digit.search(line):
+        return None
+    t = _TrackLine(line)
+    for s in range(t.n):
+        for start in (t.track_number_end(s, 2), t.track_number_end(s, 1), s):
+            if start == -1:
+                continue
+            end = t.name_reach(start)
+            if end != -1:
+                return line[start:end], t.hhmmss(t.time_start(end))
+    return None
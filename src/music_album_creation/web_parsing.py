@@ -1,14 +1,38 @@
+import re
 import sys
 
-from lxml import etree
-
 if sys.version_info.major == 2:
     from urllib import urlopen
+    from urlparse import parse_qs, urlparse
 else:
+    from urllib.parse import parse_qs, urlparse
     from urllib.request import urlopen
 
+_video_id = re.compile(r'^[\w-]{11}$')
+
 
 def video_title(youtube_url):
+    from lxml import etree  # imported on first use, since only downloading needs it
     c = urlopen(youtube_url).read()
     root_node = etree.HTML(c)
     return root_node.xpath("//span[@id='eow-title']/@title")
+
+
+def video_id(youtube_url):
+    """
+    Extracts the (11 characters long) id of a youtube video out of its url, as in 'https://www.youtube.com/watch?v=<id>',
+    'https://youtu.be/<id>', or '.../embed/<id>' and '.../shorts/<id>'.\n
+    :param str youtube_url:
+    :return: the video id or None if the url does not point to a youtube video
+    :rtype: str
+    """
+    url = urlparse(youtube_url if '//' in youtube_url else '//' + youtube_url)
+    host = (url.hostname or '').lower()
+    if host == 'youtu.be' or host.endswith('.youtu.be'):
+        candidates = url.path.split('/')[1:2]
+    elif host == 'youtube.com' or host.endswith('.youtube.com'):
+        parts = url.path.split('/')
+        candidates = parse_qs(url.query).get('v', []) + (parts[2:3] if parts[1:2] in (['embed'], ['shorts'], ['v']) else [])
+    else:
+        return None
+    return next((x for x in candidates if _video_id.match(x)), None)
@@ -0,0 +1,165 @@
+import os
+import shutil
+from glob import glob
+
+import attr
+import numpy as np
+import pytest
+from music_album_creation.audio_analysis import (AlbumLoudness,
+                                                 DecodingError, Fingerprint,
+                                                 Fingerprinter, LoudnessMeter,
+                                                 PcmCache, decode,
+                                                 find_duplicates, pcm_cache,
+                                                 write_replaygain)
+from music_album_creation.library_index import LibraryIndex
+from mutagen.id3 import ID3
+
+this_dir = os.path.dirname(os.path.realpath(__file__))
+
+
+def song(seed, seconds=30, sample_rate=12000, nb_tones=30):
+    """Synthetic 'music': a chord of random tones changing every quarter of a second"""
+    rng = np.random.RandomState(seed)
+    t = np.arange(seconds * sample_rate) / float(sample_rate)
+    frequencies, amplitudes = rng.uniform(250, 2100, size=(seconds * 4, nb_tones)), rng.uniform(0, 1, size=(seconds * 4, nb_tones))
+    note = (t * 4).astype(int)
+    return (sum(amplitudes[note, i] * np.sin(2 * np.pi * frequencies[note, i] * t) for i in range(nb_tones)) / nb_tones).astype(np.float32)
+
+
+@pytest.fixture(scope='module')
+def fingerprinter():
+    return Fingerprinter()
+
+
+def test_streaming_fingerprint(fingerprinter):
+    samples = song(1)
+    fingerprint = fingerprinter.fingerprint_chunks([samples])
+    assert len(fingerprint.hashes) == 1 + (len(samples) - 2400) // 1200
+    assert np.array_equal(fingerprinter.fingerprint_chunks(np.array_split(samples, 37)).hashes, fingerprint.hashes)
+    assert np.array_equal(Fingerprint.from_bytes(fingerprint.to_bytes(), fingerprint.frame_rate).hashes, fingerprint.hashes)
+
+
+def test_fingerprint_matching(fingerprinter):
+    samples = song(1)
+    original = fingerprinter.fingerprint_chunks([samples])
+    # another upload: quieter, noisy and cut 2 seconds earlier
+    upload = 0.5 * np.concatenate([np.zeros(int(2.03 * 12000), dtype=np.float32), samples])
+    upload += np.random.RandomState(0).normal(0, 0.01, len(upload)).astype(np.float32)
+    assert original.matches(fingerprinter.fingerprint_chunks([upload]))
+    assert not original.matches(fingerprinter.fingerprint_chunks([song(2)]))
+
+
+def test_duplicates_found_through_the_index(fingerprinter, tmpdir):
+    album_dir = str(tmpdir.mkdir('library').mkdir('album'))
+    for file_path in glob(os.path.join(this_dir, 'data', 'album_0', '*.mp3')):
+        shutil.copy(file_path, album_dir)
+    with LibraryIndex(db_file=str(tmpdir.join('library.sqlite3'))) as index:
+        index.add_album(album_dir)
+        tracks = index.unfingerprinted_tracks(album_dir)
+        assert len(tracks) == 3
+        index.set_fingerprint(tracks[0], fingerprinter.fingerprint_chunks([song(1, seconds=15)]))  # a 15.39 seconds long track
+        assert index.unfingerprinted_tracks(album_dir) == tracks[1:]
+
+        new = {'new-1.mp3': fingerprinter.fingerprint_chunks([song(1, seconds=16)]), 'new-2.mp3': fingerprinter.fingerprint_chunks([song(2, seconds=16)])}
+        duplicates = find_duplicates(index, new)
+        assert [(x.track, x.original) for x in duplicates] == [('new-1.mp3', tracks[0])]
+
+        # fingerprints computed with other parameters (ie an older version's) can not be compared, so they count as missing
+        index.set_fingerprint(tracks[1], Fingerprint(np.zeros(100, dtype=np.uint32), 11025 / 1024.0))
+        assert index.unfingerprinted_tracks(album_dir) == tracks[2:]
+        assert index.unfingerprinted_tracks(album_dir, frame_rate=fingerprinter.frame_rate) == tracks[1:]
+        assert [x[0] for x in index.fingerprints(frame_rate=fingerprinter.frame_rate)] == tracks[:1]
+
+
+def test_loudness_of_a_full_scale_sine():
+    t = np.arange(48000 * 5) / 48000.0
+    samples = np.zeros((len(t), 2), dtype=np.float32)
+    samples[:, 0] = np.sin(2 * np.pi * 997 * t)  # on the left channel only; -3.01 LUFS as per ITU-R BS.1770-4
+    measurement = LoudnessMeter().measure_chunks(np.array_split(samples, 13))
+    assert abs(measurement.loudness + 3.01) < 0.02 and measurement.peak == pytest.approx(1.0, abs=1e-4)
+    assert abs(measurement.gain + 14.99) < 0.02
+    silence = LoudnessMeter().measure_chunks([np.zeros((48000, 2))])
+    assert silence.gain is None and AlbumLoudness([measurement, silence]).loudness == pytest.approx(measurement.loudness, abs=0.01)
+
+
+def test_replaygain_frames(tmpdir):
+    album_dir = str(tmpdir.mkdir('album'))
+    for file_path in glob(os.path.join(this_dir, 'data', 'album_0', '*.mp3')):
+        shutil.copy(file_path, album_dir)
+    files = sorted(glob(os.path.join(album_dir, '*.mp3')))
+    t = np.arange(48000 * 2) / 48000.0
+    meter = LoudnessMeter()
+    tracks = [attr.evolve(meter.measure_chunks([np.stack([amplitude * np.sin(2 * np.pi * 997 * t)] * 2, axis=1)]), file=file)
+              for file, amplitude in zip(files, (0.5, 0.25, 0))]
+    result = write_replaygain(AlbumLoudness(tracks))
+    assert not result.failed and [len(x.changes) for x in result.outcomes] == [4, 4, 3]
+    tag = ID3(files[0])
+    assert str(tag['TXXX:REPLAYGAIN_TRACK_GAIN']) == '-11.99 dB' and str(tag['TXXX:REPLAYGAIN_ALBUM_PEAK']) == '0.500000'
+    assert 'TXXX:REPLAYGAIN_TRACK_GAIN' not in ID3(files[2])
+    assert [x.changes for x in write_replaygain(AlbumLoudness(tracks)).outcomes] == [[], [], []]
+
+
+@pytest.fixture
+def fake_ffmpeg(monkeypatch):
+    """Decodes any file into the same 20 seconds of synthetic stereo 'music', at the requested sample rate"""
+    calls = []
+
+    def decode_raw(audio_file, sample_rate=None, channels=1, chunk_frames=65536):
+        calls.append(audio_file)
+        samples = np.stack([song(1, seconds=20, sample_rate=sample_rate)] * channels, axis=1)
+        for start in range(0, len(samples), chunk_frames):
+            yield (samples[start:start + chunk_frames] * 32767).astype('<i2').tobytes()
+    monkeypatch.setattr(pcm_cache, 'decode_raw', decode_raw)
+    return calls
+
+
+def test_analysis_stages_share_one_decode(fake_ffmpeg, fingerprinter, tmpdir):
+    audio_file = str(tmpdir.join('track.mp3'))
+    with open(audio_file, 'wb') as f:
+        f.write(b'audio')
+    with PcmCache(workspace=str(tmpdir.join('job'))) as cache:
+        fingerprint = fingerprinter.fingerprint_file(audio_file, cache=cache)
+        loudness = LoudnessMeter().measure_file(audio_file, cache=cache)
+        decoded = cache.get(audio_file)
+        assert fake_ffmpeg == [audio_file] and cache.nb_decodes == 1
+        assert isinstance(decoded.samples, np.memmap)
+        assert decoded.samples.shape == (20 * 48000, 2) and loudness.file == audio_file
+    assert os.listdir(str(tmpdir.join('job'))) == []
+    # read at 48 kHz from the cache, the fingerprint matches the one of audio decoded at the fingerprinter's 12 kHz
+    assert fingerprint.matches(fingerprinter.fingerprint_chunks([song(1, seconds=20)]), max_shift=0.5)
+
+
+def test_tracks_get_sliced_out_of_the_album(fake_ffmpeg, fingerprinter, tmpdir):
+    album_file = str(tmpdir.join('album.mp3'))
+    with open(album_file, 'wb') as f:
+        f.write(b'album')
+    tracks = [str(tmpdir.join('{:02d} - track.mp3'.format(i))) for i in (1, 2)]
+    with PcmCache(sample_rate=12000, channels=1) as cache:
+        cache.add_segment(tracks[0], album_file, 0, 12.5)
+        cache.add_segment(tracks[1], album_file, '12.5')
+        assert [len(cache.get(x).samples) for x in tracks] == [150000, 90000]
+        fingerprints = [fingerprinter.fingerprint_file(x, cache=cache) for x in tracks]
+        assert fake_ffmpeg == [album_file] and cache.nb_decodes == 1  # the tracks themselves never got decoded
+    album = fingerprinter.fingerprint_chunks([song(1, seconds=20)])
+    assert fingerprints[0].matches(Fingerprint(album.hashes[:125], album.frame_rate), max_shift=0.5)
+    assert fingerprints[1].matches(Fingerprint(album.hashes[125:], album.frame_rate), max_shift=0.5)
+
+
+def test_least_recently_used_audio_gets_evicted(fake_ffmpeg, tmpdir):
+    files = [str(tmpdir.join('{}.mp3'.format(i))) for i in range(3)]
+    for i, audio_file in enumerate(files):
+        with open(audio_file, 'wb') as f:
+            f.write(str(i).encode())
+    cache = PcmCache(max_bytes=2 * 20 * 12000 * 2, sample_rate=12000, channels=1)  # room for two tracks
+    cache.get(files[0]), cache.get(files[1]), cache.get(files[0]), cache.get(files[2])
+    assert len(os.listdir(cache.workspace)) == 2
+    cache.get(files[0])
+    cache.get(files[1])
+    assert cache.nb_decodes == 4  # only the evicted track got decoded again
+    cache.close()
+    assert not os.path.exists(cache.workspace)
+
+
+def test_decoding_error(tmpdir):
+    with pytest.raises(DecodingError):
+        list(decode(str(tmpdir.join('missing.mp3'))))
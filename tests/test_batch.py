@@ -0,0 +1,138 @@
+import json
+import os
+import shutil
+from glob import glob
+
+import pytest
+from music_album_creation.audio_analysis import Duplicate
+from music_album_creation.audio_segmentation import AudioSegmenter
+from music_album_creation.batch import (BatchProcessor, ManifestError,
+                                        load_manifest)
+from music_album_creation.library_index import LibraryIndex
+from music_album_creation.pipeline import AlbumPipeline
+from mutagen.id3 import ID3
+
+this_dir = os.path.dirname(os.path.realpath(__file__))
+
+tracklist = '1. Intro 0:00\n2. Monuments Burn Into Moments 0:15\n3. Yeah 0:36\n'
+
+
+@pytest.fixture
+def manifest_dir(tmpdir):
+    directory = tmpdir.mkdir('manifests')
+    directory.join('album.mp3').write(b'audio')
+    directory.join('tracks.txt').write(tracklist)
+    return directory
+
+
+def test_json_manifest(manifest_dir):
+    manifest_dir.join('m.json').write(json.dumps({'albums': [
+        {'url': 'https://www.youtube.com/watch?v=abc', 'tracklist': tracklist, 'artist': 'Kyuss', 'album': 'Blues for the Red Sun', 'year': 1992},
+        {'id': 'local', 'file': 'album.mp3', 'tracklist_file': 'tracks.txt', 'hhmmss_type': 'timestamps', 'destination': 'Various/Yeah', 'track_name': False}]}))
+    first, second = load_manifest(str(manifest_dir.join('m.json')))
+    assert (first.id, first.hhmmss_type, first.year) == ('1', 'auto', '1992')
+    assert first.destination_directory('/lib') == os.path.join('/lib', 'Kyuss', 'Blues for the Red Sun (1992)')
+    assert second.id == 'local' and second.file == str(manifest_dir.join('album.mp3'))
+    assert second.read_tracklist() == tracklist and second.track_name is False
+    assert second.destination_directory('/lib') == os.path.join('/lib', 'Various', 'Yeah')
+
+
+def test_csv_and_yaml_manifests(manifest_dir):
+    manifest_dir.join('m.csv').write('file,tracklist_file,album,track_number\nalbum.mp3,tracks.txt,Yeah,no\n')
+    entry, = load_manifest(str(manifest_dir.join('m.csv')))
+    assert (entry.album, entry.artist, entry.track_number, entry.url) == ('Yeah', '', False, None)
+    pytest.importorskip('yaml')
+    manifest_dir.join('m.yaml').write('- file: album.mp3\n  tracklist: |\n    1. Intro 0:00\n    2. Yeah 0:15\n  album: Yeah\n')
+    entry, = load_manifest(str(manifest_dir.join('m.yaml')))
+    assert entry.read_tracklist() == '1. Intro 0:00\n2. Yeah 0:15\n'
+
+
+@pytest.mark.parametrize('record', [
+    {'tracklist': tracklist, 'album': 'a'},
+    {'url': 'u', 'file': 'f', 'tracklist': tracklist, 'album': 'a'},
+    {'url': 'u', 'album': 'a'},
+    {'url': 'u', 'tracklist': tracklist},
+    {'url': 'u', 'tracklist': tracklist, 'album': 'a', 'hhmmss_type': 'seconds'},
+    {'url': 'u', 'tracklist': tracklist, 'album': 'a', 'genre': 'rock'},
+])
+def test_invalid_entries(manifest_dir, record):
+    manifest_dir.join('m.json').write(json.dumps([record]))
+    with pytest.raises(ManifestError):
+        load_manifest(str(manifest_dir.join('m.json')))
+
+
+def test_unsupported_manifest(manifest_dir):
+    manifest_dir.join('m.txt').write('')
+    with pytest.raises(ManifestError):
+        load_manifest(str(manifest_dir.join('m.txt')))
+
+
+@pytest.fixture
+def fake_segmentation(monkeypatch):
+    """Segments any album into copies of the test album's tracks, instead of running ffmpeg"""
+    def segment(self, album_file, data, **kwargs):
+        if not os.path.getsize(album_file):
+            raise RuntimeError('Corrupt album')
+        tracks = []
+        for source in sorted(glob(os.path.join(this_dir, 'data', 'album_0', '*.mp3'))):
+            tracks.append(os.path.join(self.target_directory, os.path.basename(source)))
+            shutil.copyfile(source, tracks[-1])
+        return tracks
+    monkeypatch.setattr(AudioSegmenter, 'segment', segment)
+
+
+def test_batch_processing(manifest_dir, fake_segmentation, tmpdir):
+    manifest_dir.join('empty.mp3').write(b'')
+    manifest_dir.join('m.json').write(json.dumps([
+        {'id': 'good', 'file': 'album.mp3', 'tracklist_file': 'tracks.txt', 'hhmmss_type': 'timestamps', 'artist': 'Kyuss', 'album': 'Blues'},
+        {'id': 'bad', 'file': 'empty.mp3', 'tracklist': tracklist, 'hhmmss_type': 'timestamps', 'album': 'Other'}]))
+    library, results_dir = str(tmpdir.mkdir('library')), str(tmpdir.join('results'))
+    with LibraryIndex(db_file=str(tmpdir.join('library.sqlite3'))) as index:
+        processor = BatchProcessor(library, nb_workers=2, replaygain=False, work_directory=str(tmpdir), index=index)
+        good, bad = processor.run(load_manifest(str(manifest_dir.join('m.json'))), results_directory=results_dir)
+        album_dir = os.path.join(library, 'Kyuss', 'Blues')
+        assert good.succeeded and good.album_directory == album_dir and len(good.tracks) == 3
+        assert index.album(album_dir) is not None
+    assert not bad.succeeded and 'Corrupt album' in bad.error
+    assert ID3(os.path.join(album_dir, '14 Yeah.mp3'))['TALB'].text == ['Blues']
+    with open(os.path.join(results_dir, 'good.json')) as f:
+        assert json.load(f)['status'] == 'succeeded'
+    with open(os.path.join(results_dir, 'bad.json')) as f:
+        assert json.load(f)['status'] == 'failed'
+    assert [x for x in os.listdir(str(tmpdir)) if x.startswith('create-album-batch-')] == []
+
+
+def test_batch_processing_limits_the_subprocesses(manifest_dir, fake_segmentation, tmpdir, monkeypatch):
+    limits, segment = [], AudioSegmenter.segment
+
+    def limited_segment(self, album_file, data, **kwargs):
+        limits.append((self.timeout, self.stall_timeout))
+        return segment(self, album_file, data, **kwargs)
+    monkeypatch.setattr(AudioSegmenter, 'segment', limited_segment)
+    manifest_dir.join('m.json').write(json.dumps([
+        {'file': 'album.mp3', 'tracklist_file': 'tracks.txt', 'hhmmss_type': 'timestamps', 'album': 'Blues'}]))
+    with LibraryIndex(db_file=str(tmpdir.join('library.sqlite3'))) as index:
+        assert BatchProcessor(str(tmpdir), index=index).timeout is not None
+        processor = BatchProcessor(str(tmpdir.mkdir('library')), replaygain=False, work_directory=str(tmpdir), index=index, timeout=60,
+                                   stall_timeout=10)
+        result, = processor.run(load_manifest(str(manifest_dir.join('m.json'))))
+    assert result.succeeded and limits == [(60, 10)]
+
+
+def test_batch_processing_leaves_existing_files_and_duplicates_alone(manifest_dir, fake_segmentation, tmpdir, monkeypatch):
+    def find_duplicates(self):
+        self.duplicates = [Duplicate(x, '/lib/Intro.mp3', 0.1) for x in self.tracks if os.path.basename(x) == '01 (Intro).mp3']
+        return self.duplicates
+    monkeypatch.setattr(AlbumPipeline, 'find_duplicates', find_duplicates)
+    album_dir = tmpdir.mkdir('library').mkdir('Kyuss').mkdir('Blues')
+    shutil.copyfile(os.path.join(this_dir, 'data', 'album_0', '14 Yeah.mp3'), str(album_dir.join('14 Yeah.mp3')))
+    existing = ID3(str(album_dir.join('14 Yeah.mp3'))).get('TALB')
+    manifest_dir.join('m.json').write(json.dumps([{'file': 'album.mp3', 'tracklist_file': 'tracks.txt', 'hhmmss_type': 'timestamps',
+                                                   'artist': 'Kyuss', 'album': 'Blues', 'skip_duplicates': True}]))
+    with LibraryIndex(db_file=str(tmpdir.join('library.sqlite3'))) as index:
+        processor = BatchProcessor(str(tmpdir.join('library')), replaygain=False, work_directory=str(tmpdir), index=index)
+        result, = processor.run(load_manifest(str(manifest_dir.join('m.json'))))
+    assert result.succeeded and [os.path.basename(x) for x in result.tracks] == ['03 - Monuments Burn Into Moments.mp3']
+    assert len(result.warnings) == 2 and not album_dir.join('01 (Intro).mp3').check()
+    assert ID3(str(album_dir.join('14 Yeah.mp3'))).get('TALB') == existing
+    assert ID3(str(album_dir.join('03 - Monuments Burn Into Moments.mp3')))['TALB'].text == ['Blues']
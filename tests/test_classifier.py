@@ -1,13 +1,25 @@
+import os
+import shutil
+import subprocess
+import sys
+from glob import glob
+
 import pytest
+from music_album_creation.audio_segmentation import TracksInformation
 from music_album_creation.format_classification import (FormatClassifier,
+                                                        dataset,
                                                         dataset_handler)
+from music_album_creation.format_classification.dataset import (
+    DatasetHandler, DurationCache, scan_for_albums)
+from music_album_creation.format_classification.linear_model import (
+    LinearModel, WrongModelInputError)
 
 # model = "src/music_album_creation/format_classification/data/model.pickle"
 
 
 @pytest.fixture(scope='module')
 def format_classifier():
-    return FormatClassifier.load_version()
+    return FormatClassifier.load_version(user_model=False)
 
 
 class TestClassifier:
@@ -15,3 +27,97 @@ class TestClassifier:
     def test_evaluation_on_blind_set(self, format_classifier):
         feature_vectors, labels = dataset_handler.load_dataset_split('test')
         assert 0.98 < format_classifier.score(feature_vectors, labels)
+
+    @pytest.mark.parametrize("hhmmss_list, label", [
+        (['0:00', '3:12', '7:40'], 0),
+        (['3:12', '4:28', '2:40'], 1),
+        (['3:12', '4:28', '9:40'], 1),
+        (['0:00', '3:12', '3:12'], 1),
+    ])
+    def test_prediction(self, format_classifier, hhmmss_list, label):
+        assert format_classifier.is_durations(hhmmss_list) == label
+
+    def test_batch_prediction(self, format_classifier):
+        tracklists = [TracksInformation([['a', '0:00'], ['b', '3:12']]), ['3:12', '4:28', '2:40'], ['3:12', '4:28', '9:40'], ['0:05', '4:28']]
+        prediction = format_classifier.classify(tracklists)
+        assert prediction.labels == [0, 1, 1, 1] and len(prediction) == 4
+        assert prediction.confidences[:2] == [1.0, 1.0] and 0.5 <= prediction.confidences[3] < prediction.confidences[2] < 1
+        assert prediction.uncertain(threshold=prediction.confidences[2]) == [3]
+        assert [format_classifier.is_durations(x) for x in tracklists[1:]] == prediction.labels[1:]
+
+    def test_exported_model_round_trip(self, format_classifier, tmpdir):
+        model_file = str(tmpdir.join('model.json'))
+        format_classifier.export(model_file)
+        model = LinearModel.load(model_file)
+        feature_vectors, labels = dataset_handler.load_dataset_split('dev')
+        assert model.features == FormatClassifier.features
+        assert list(model.predict(feature_vectors)) == list(format_classifier.predict(feature_vectors))
+
+
+def test_binary_dataset_splits(tmpdir):
+    assert all(x.endswith('.npy') for x in dataset_handler.datasets.values())
+    for split in dataset_handler.datasets:
+        text_vectors, text_labels = dataset_handler.load_dataset(dataset_handler.split_path(split, binary=False))
+        feature_vectors, labels = dataset_handler.load_dataset_split(split)
+        assert feature_vectors.tolist() == text_vectors and labels.tolist() == text_labels
+
+    # the handler is a singleton, bound to the package's datasets directory; the files get written and read directly
+    file_path = str(tmpdir.join('dev-split.npy'))
+    DatasetHandler.save_dataset(file_path, [[12.0], [0.0]], [1, 0])
+    feature_vectors, labels = DatasetHandler.load_dataset(file_path)
+    assert feature_vectors.shape == (2, 1) and feature_vectors.base is not None  # a view of the memory mapped file
+    assert feature_vectors.tolist() == [[12.0], [0.0]] and labels.tolist() == [1.0, 0.0]
+
+
+def test_prediction_does_not_need_sklearn(tmpdir):
+    code = "import sys; from music_album_creation.format_classification import FormatClassifier; " \
+           "FormatClassifier.load_version().is_durations(['2:00', '3:00']); print('sklearn' in sys.modules)"
+    assert subprocess.check_output([sys.executable, '-c', code], cwd=str(tmpdir)).decode().strip() == 'False'
+
+
+@pytest.fixture
+def music_library(tmpdir):
+    album_dir = tmpdir.mkdir('library').mkdir('artist').mkdir('album')
+    for file_path in glob(os.path.join(os.path.dirname(os.path.realpath(__file__)), 'data', 'album_0', '*.mp3')):
+        shutil.copy(file_path, str(album_dir))
+    return str(tmpdir.join('library'))
+
+
+def test_datapoints_use_the_duration_cache(music_library, tmpdir, monkeypatch):
+    cache = DurationCache(str(tmpdir.join('durations.json')))
+    albums = scan_for_albums(music_library)
+    assert DatasetHandler.create_datapoints(albums, nb_processes=2, cache=cache) == ([[15.3925], [0]], [1, 0])
+    assert len(DurationCache(cache.file_path)) == 3
+
+    monkeypatch.setattr(dataset, 'ProcessPoolExecutor', None)  # all durations should come from the cache
+    assert DatasetHandler.create_datapoints(albums, cache=DurationCache(cache.file_path)) == ([[15.3925], [0]], [1, 0])
+
+
+def test_online_update_of_linear_model():
+    model = LinearModel([0.01], 0, [0, 1], ['first_hhmmss_seconds'])
+    model.partial_fit([[15.0], [0.0], [40.0]], [1, 0, 1])
+    assert list(model.predict([[15.0], [40.0]])) == [1, 1]
+    with pytest.raises(WrongModelInputError):
+        model.partial_fit([[15.0]], [2])
+
+
+def test_incremental_training(music_library, tmpdir, monkeypatch):
+    monkeypatch.setenv('XDG_DATA_HOME', str(tmpdir.join('data')))
+    cache = DurationCache(str(tmpdir.join('durations.json')))
+    fc = FormatClassifier.infer_incremental(music_library_dir=music_library, cache=cache)
+    model_file = FormatClassifier.user_model_file()
+    assert LinearModel.load(model_file).weights[0] != LinearModel.load(FormatClassifier.model_file).weights[0]
+    assert fc.predict([[15.3925]])[0] == 1
+    with open(str(tmpdir.join('data', 'music_album_creation', 'format-model.albums.txt'))) as f:
+        assert f.read() == os.path.join(music_library, 'artist', 'album') + '\n'
+    assert FormatClassifier.load_version()._estimator.weights.tolist() == LinearModel.load(model_file).weights.tolist()
+
+    os.mkdir(os.path.join(music_library, 'artist', 'album 2'))
+    for file_path in glob(os.path.join(music_library, 'artist', 'album', '*.mp3')):
+        shutil.copy(file_path, os.path.join(music_library, 'artist', 'album 2'))
+    monkeypatch.setattr(DatasetHandler, 'create_datapoints', staticmethod(lambda albums, **kwargs: ([[15.3925], [0]] * len(albums), [1, 0] * len(albums))))
+    calls = []
+    monkeypatch.setattr(FormatClassifier, 'partial_fit', lambda self, X, y: calls.append(len(X)))
+    FormatClassifier.infer_incremental(music_library_dir=music_library, cache=cache)
+    FormatClassifier.infer_incremental(music_library_dir=music_library, cache=cache)
+    assert calls == [2]  # only the new album, only once
@@ -0,0 +1,103 @@
+import http.client
+import os
+import stat
+import threading
+
+import pytest
+from music_album_creation.batch import BatchProcessor, EntryResult
+from music_album_creation.daemon import (AlbumDaemon, DaemonClient,
+                                         DaemonError, make_server)
+from music_album_creation.library_index import LibraryIndex
+
+from .test_batch import fake_segmentation, tracklist  # noqa: F401
+
+
+@pytest.fixture(params=['unix', 'http'])
+def client(request, tmpdir):
+    with LibraryIndex(db_file=str(tmpdir.join('library.sqlite3'))) as index:
+        album_daemon = AlbumDaemon(BatchProcessor(str(tmpdir.mkdir('library')), replaygain=False, work_directory=str(tmpdir), index=index))
+        if request.param == 'unix':
+            server = make_server(album_daemon, socket_path=str(tmpdir.join('daemon.sock')))
+            client = DaemonClient(socket_path=server.server_address, timeout=5)
+        else:
+            server = make_server(album_daemon, port=0, token_file=str(tmpdir.join('daemon.token')))
+            client = DaemonClient(port=server.server_address[1], timeout=5, token_file=server.token_file)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        yield client
+        client.shutdown()
+        thread.join()
+        server.server_close()
+        album_daemon.close()
+
+
+def test_jobs(client, fake_segmentation, tmpdir):  # noqa: F811
+    album_file = tmpdir.join('album.mp3')
+    album_file.write(b'audio')
+    tmpdir.join('empty.mp3').write(b'')
+    jobs = client.submit([{'file': str(album_file), 'tracklist': tracklist, 'hhmmss_type': 'timestamps', 'album': 'Blues'},
+                          {'file': str(tmpdir.join('empty.mp3')), 'tracklist': tracklist, 'hhmmss_type': 'timestamps', 'album': 'Other'}])
+    assert [x['id'] for x in jobs] == ['1', '2'] and {x['status'] for x in jobs} <= {'queued', 'running', 'succeeded', 'failed'}
+    good, bad = client.wait(['1', '2'], interval=0.05, timeout=30)
+    assert good['status'] == 'succeeded' and len(good['result']['tracks']) == 3
+    assert os.path.isdir(good['result']['album_directory'])
+    assert bad['status'] == 'failed' and 'Corrupt album' in bad['result']['error']
+    assert client.status()['jobs'] == {'queued': 0, 'running': 0, 'succeeded': 1, 'failed': 1}
+    assert [x['id'] for x in client.jobs()] == ['1', '2']
+    events = client.events()
+    assert {x['job'] for x in events if x['type'] == 'TagWritten'} == {'1'} and [x['id'] for x in events] == list(range(1, len(events) + 1))
+    assert client.events(since=len(events)) == []
+
+
+class _Processor(object):
+    nb_workers = 1
+
+    def process(self, entry, job_id=None):
+        result = EntryResult(entry.id)
+        result.status = 'succeeded'
+        return result
+
+
+def test_only_the_latest_finished_jobs_are_kept(tmpdir):
+    album_daemon = AlbumDaemon(_Processor(), nb_finished_jobs=2)
+    try:
+        jobs = album_daemon.submit([{'file': str(tmpdir.join('{}.mp3'.format(x))), 'tracklist': tracklist, 'album': 'a'} for x in range(5)])
+        album_daemon._executor.shutdown(wait=True)
+        assert [x.id for x in album_daemon.jobs()] == [x.id for x in jobs[-2:]]
+        assert album_daemon.job(jobs[0].id) is None and not album_daemon._futures
+    finally:
+        album_daemon.close()
+
+
+def test_invalid_requests(client):
+    with pytest.raises(DaemonError, match='exactly one'):
+        client.submit({'tracklist': tracklist, 'album': 'a'})
+    with pytest.raises(DaemonError, match='No resource'):
+        client.job('13')
+    assert client.jobs() == []
+
+
+def request(client, method, path, headers):
+    connection = http.client.HTTPConnection('127.0.0.1', client.port, timeout=5)
+    try:
+        connection.request(method, path, body=b'{}', headers=headers)
+        return connection.getresponse().status
+    finally:
+        connection.close()
+
+
+@pytest.mark.parametrize('client', ['http'], indirect=True)
+def test_http_requires_the_token_and_json(client):
+    assert stat.S_IMODE(os.stat(client.token_file).st_mode) == 0o600
+    authorization = 'Bearer {}'.format(client._token())
+    assert request(client, 'GET', '/status', {}) == 401
+    assert request(client, 'POST', '/shutdown', {'Content-Type': 'application/json', 'Authorization': 'Bearer wrong'}) == 401
+    assert request(client, 'POST', '/jobs', {'Content-Type': 'text/plain', 'Authorization': authorization}) == 415
+    assert request(client, 'GET', '/status', {'Authorization': authorization}) == 200
+    with pytest.raises(DaemonError, match='token'):
+        DaemonClient(port=client.port, token_file=client.token_file + '.missing').status()
+
+
+def test_unreachable_daemon(tmpdir):
+    with pytest.raises(DaemonError, match='Could not reach'):
+        DaemonClient(socket_path=str(tmpdir.join('missing.sock'))).status()
@@ -0,0 +1,120 @@
+import io
+import json
+import os
+import threading
+
+import pytest
+from music_album_creation import events, profiling
+from music_album_creation.audio_segmentation import (AudioSegmenter,
+                                                     SegmentationInformation)
+from music_album_creation.batch import BatchProcessor, load_manifest
+from music_album_creation.create_album import _ConsoleProgress
+from music_album_creation.downloading import _DownloadProgress
+from music_album_creation.events import (ErrorOccurred, EventBus, StageFinished,
+                                         StageProgress, StageStarted,
+                                         TagWritten, TrackCut)
+from music_album_creation.library_index import LibraryIndex
+
+from .test_batch import fake_segmentation, manifest_dir  # noqa: F401
+
+
+@pytest.fixture
+def published():
+    received = []
+    events.subscribe(received.append)
+    yield received
+    events.unsubscribe(received.append)
+
+
+def test_callbacks_and_types():
+    bus, stages, errors = EventBus(), [], []
+    bus.publish(StageStarted, unknown_field=1)  # nobody subscribed: the event does not even get created
+    bus.subscribe(stages.append, types=(StageStarted, StageFinished))
+    bus.subscribe(errors.append, types=(ErrorOccurred,))
+    bus.publish(StageStarted, stage='download')
+    bus.publish(ErrorOccurred, stage='tag', error='IOError', file='a.mp3')
+    bus.unsubscribe(stages.append)
+    bus.publish(StageFinished, stage='download', elapsed=1.0)
+    assert [(type(x), x.stage, x.job) for x in stages] == [(StageStarted, 'download', None)]
+    assert errors[0].to_dict() == {'type': 'ErrorOccurred', 'stage': 'tag', 'error': 'IOError', 'file': 'a.mp3', 'job': None, 'timestamp': errors[0].timestamp}
+
+
+def test_iterator():
+    bus = EventBus()
+    with bus.events(types=(StageProgress,)) as stream:
+        bus.publish(StageStarted, stage='segmentation')
+        for i in range(1, 4):
+            bus.publish(StageProgress, stage='segmentation', done=i, total=4, unit='track', elapsed=2.0 * i)
+        assert stream.get(timeout=0.1).done == 1
+        stream.close()
+        progress = list(stream)
+    assert [x.done for x in progress] == [2, 3]
+    assert (progress[-1].rate, progress[-1].eta) == (0.5, 2.0)
+    assert not bus.subscribed and stream.get(timeout=0.01) is not None  # a closed stream stays closed
+
+
+def test_jobs_across_threads():
+    bus, received = EventBus(), []
+    bus.subscribe(received.append)
+    with events.job('7'):
+        thread = threading.Thread(target=events.bind(lambda: bus.publish(StageStarted, stage='tag')))
+        thread.start()
+        thread.join()
+        bus.publish(StageStarted, stage='copy', job='other')
+    bus.publish(StageStarted, stage='indexing')
+    assert [x.job for x in received] == ['7', 'other', None]
+
+
+def test_stage_events(published):
+    with pytest.raises(KeyError):
+        with profiling.stage('cut', track='01.mp3'):
+            raise KeyError
+    started, finished = published
+    assert (started.stage, started.info) == ('cut', {'track': '01.mp3'})
+    assert (finished.stage, finished.error) == ('cut', 'KeyError') and 0 <= finished.elapsed
+
+
+def test_download_progress(published):
+    progress = _DownloadProgress()
+    progress.feed(b'[youtube] abc: Downloading webpage\n[download]   0.0% of 5.40MiB at 1.00MiB/s ETA 00:05\r[download]  45')
+    progress.feed(b'.3% of 5.40MiB at 1.20MiB/s ETA 00:03\r')
+    assert [(x.stage, x.done, x.total, x.unit) for x in published] == [('download', 0.0, 100.0, '%'), ('download', 45.3, 100.0, '%')]
+
+
+def test_segmentation_progress(published, monkeypatch, tmpdir):
+    monkeypatch.setattr(AudioSegmenter, '_segment', lambda self, *args, **kwargs: 0)
+    segmenter = AudioSegmenter(target_directory=str(tmpdir))
+    segmenter.segment('album.mp3', SegmentationInformation.from_multiline('1. a 0:00\n2. b 1:00\n3. c 2:00', 'timestamps'))
+    assert [(x.done, x.total, x.unit) for x in published if isinstance(x, StageProgress)] == [(1, 3, 'track'), (2, 3, 'track'), (3, 3, 'track')]
+
+
+def test_batch_events(published, manifest_dir, fake_segmentation, tmpdir):  # noqa: F811
+    manifest_dir.join('empty.mp3').write(b'')
+    manifest_dir.join('m.json').write(json.dumps([
+        {'id': 'good', 'file': 'album.mp3', 'tracklist_file': 'tracks.txt', 'hhmmss_type': 'timestamps', 'album': 'Blues'},
+        {'id': 'bad', 'file': 'empty.mp3', 'tracklist_file': 'tracks.txt', 'hhmmss_type': 'timestamps', 'album': 'Other'}]))
+    with LibraryIndex(db_file=str(tmpdir.join('library.sqlite3'))) as index:
+        BatchProcessor(str(tmpdir.mkdir('library')), replaygain=False, index=index).run(load_manifest(str(manifest_dir.join('m.json'))))
+    tags = [x for x in published if isinstance(x, TagWritten)]
+    assert len(tags) == 3 and {x.job for x in tags} == {'good'}
+    assert sorted(os.path.basename(x.file) for x in tags) == ['01 (Intro).mp3', '03 - Monuments Burn Into Moments.mp3', '14 Yeah.mp3']
+    error, = [x for x in published if isinstance(x, ErrorOccurred)]
+    assert (error.job, error.stage) == ('bad', 'album') and 'Corrupt album' in error.error
+    assert ('bad', 'segmentation', 'RuntimeError') in [(x.job, x.stage, x.error) for x in published if isinstance(x, StageFinished)]
+
+
+def test_console_progress():
+    stream = io.StringIO()
+    printer = _ConsoleProgress(stream=stream)
+    printer(StageProgress('download', done=50.0, total=100.0, unit='%', elapsed=1.0))  # rendered by youtube-dl itself
+    with printer.holding():
+        printer(TrackCut('/tmp/01 - a.mp3', start='0', end='72.5', size=10, elapsed=0.1))
+        printer(StageProgress('segmentation', done=1, total=2, unit='track', elapsed=1.0))
+        assert stream.getvalue() == ''
+    printer(ErrorOccurred('tag', error='MutagenError: bad', file='/tmp/02 - b.mp3'))
+    printer(StageProgress('segmentation', done=2, total=2, unit='track', elapsed=2.0))
+    assert stream.getvalue().split('\n') == [
+        " Cut track '01 - a.mp3' (00:00:00 - 00:01:12)",
+        '\r Segmentation: 1/2 tracks, 1s left\r' + ' ' * 34 + "\r Failed to tag '/tmp/02 - b.mp3': MutagenError: bad",
+        ' Segmentation: 1/2 tracks, 1s left\r Segmentation: 2/2 tracks         ',
+        '']
@@ -0,0 +1,81 @@
+import os
+import shutil
+from glob import glob
+
+import pytest
+from music_album_creation.library_index import IndexUpdate, LibraryIndex
+from music_album_creation.web_parsing import video_id
+from mutagen.id3 import ID3, TPE1
+
+this_dir = os.path.dirname(os.path.realpath(__file__))
+
+
+@pytest.fixture
+def library(tmpdir):
+    root = tmpdir.mkdir('library')
+    for album in ('Kyuss/Blues for the Red Sun', 'Various'):
+        album_dir = os.path.join(str(root), album)
+        os.makedirs(album_dir)
+        for file_path in glob(os.path.join(this_dir, 'data', 'album_0', '*.mp3')):
+            shutil.copy(file_path, album_dir)
+    return str(root)
+
+
+@pytest.fixture
+def index(tmpdir):
+    with LibraryIndex(db_file=str(tmpdir.join('index', 'library.sqlite3'))) as index:
+        yield index
+
+
+def test_incremental_indexing(library, index):
+    assert index.update(library) == IndexUpdate(read=6)
+    assert index.update(library) == IndexUpdate(unchanged=6)
+    album_dir = os.path.join(library, 'Kyuss', 'Blues for the Red Sun')
+    assert [round(x, 2) for x in index.album_durations()[album_dir]] == [15.39, 20.95, 4.31]
+
+    track = sorted(glob(os.path.join(album_dir, '*.mp3')))[0]
+    tag = ID3(track)
+    tag.add(TPE1(encoding=3, text=u'Kyuss'))
+    tag.save()
+    os.remove(os.path.join(library, 'Various', '14 Yeah.mp3'))
+    assert index.update(library) == IndexUpdate(read=1, removed=1, unchanged=4)
+    assert index.album(album_dir).tracks[0].tags['TPE1'] == 'Kyuss'
+
+    shutil.rmtree(os.path.join(library, 'Various'))
+    assert index.update(library) == IndexUpdate(removed=2, unchanged=3)
+    assert [x.path for x in index.albums()] == [album_dir]
+
+
+def test_stale_albums_get_removed_with_a_constant_number_of_queries(library, index):
+    for i in range(20):
+        shutil.copytree(os.path.join(library, 'Various'), os.path.join(library, 'Various {}'.format(i)))
+    assert index.update(library) == IndexUpdate(read=66)
+    for i in range(20):
+        shutil.rmtree(os.path.join(library, 'Various {}'.format(i)))
+    statements = []
+    index._connection.set_trace_callback(statements.append)
+    assert index.update(library) == IndexUpdate(removed=60, unchanged=6)
+    assert len([x for x in statements if x.startswith('SELECT COUNT')]) == 1
+
+
+def test_video_lookup(library, index):
+    album_dir = os.path.join(library, 'Various')
+    index.add_album(album_dir, video_id='dQw4w9WgXcQ')
+    index.update(library)  # keeps the recorded video id
+    assert index.has_video('dQw4w9WgXcQ') and index.album_for_video('dQw4w9WgXcQ').path == album_dir
+    assert not index.has_video('aaaaaaaaaaa')
+    index.add_album(album_dir, video_id='aaaaaaaaaaa')
+    assert index.has_video('aaaaaaaaaaa') and not index.has_video('dQw4w9WgXcQ') and len(index.albums()) == 2
+
+
+@pytest.mark.parametrize("url, expected", [
+    ('https://www.youtube.com/watch?v=dQw4w9WgXcQ&t=42s', 'dQw4w9WgXcQ'),
+    ('youtube.com/watch?feature=share&v=dQw4w9WgXcQ', 'dQw4w9WgXcQ'),
+    ('https://youtu.be/dQw4w9WgXcQ?t=1', 'dQw4w9WgXcQ'),
+    ('https://m.youtube.com/embed/dQw4w9WgXcQ', 'dQw4w9WgXcQ'),
+    ('https://www.youtube.com/shorts/dQw4w9WgXcQ', 'dQw4w9WgXcQ'),
+    ('https://www.youtube.com/results?search_query=kyuss', None),
+    ('https://example.com/watch?v=dQw4w9WgXcQ', None),
+])
+def test_video_id(url, expected):
+    assert video_id(url) == expected
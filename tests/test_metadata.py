@@ -1,5 +1,6 @@
 """This module tests writting metadata to audio files . It tests both valid and invalid values for the 'year' (TDRC) field"""
 import os
+import shutil
 from glob import glob
 
 import pytest
@@ -50,3 +51,58 @@ def test_writting_album_metadata(test_album_dir, album_info, tags_from_file_name
 
 def test_metadata_dealer_object(metadata):
     assert hasattr(metadata, '_filters')
+
+
+@pytest.fixture
+def album_copy(tmpdir, test_album_dir):
+    album_dir = tmpdir.mkdir('album')
+    for file_path in glob(test_album_dir + '/*.mp3'):
+        shutil.copy(file_path, str(album_dir))
+    album_dir.join('02 - Not An Mp3.mp3').write('not audio')
+    return str(album_dir)
+
+
+def test_batch_writing_reports_per_file_outcomes(album_copy):
+    result = MD.set_album_metadata(album_copy, track_number=True, track_name=False, artist='ratm', album='renegades', nb_workers=2)
+    assert [os.path.basename(x.file) for x in result.failed] == ['02 - Not An Mp3.mp3']
+    assert len(result.succeeded) == 3
+    assert open(os.path.join(album_copy, '02 - Not An Mp3.mp3')).read() == 'not audio'
+    for outcome in result.succeeded:
+        audio = ID3(outcome.file)
+        assert str(audio.get('TALB')) == 'renegades' and 'track_name' not in outcome.frames
+        assert str(audio.get('TRCK')) == str(int(StringParser.parse_track_number_n_name(outcome.file)['track_number']))
+
+
+def test_tag_edits_stay_within_reserved_padding(album_copy):
+    track = os.path.join(album_copy, '14 Yeah.mp3')
+    ID3(track).delete()
+    MD.write_metadata(track, album='renegades')
+    assert MD.id3_padding < ID3(track).size
+    size = os.path.getsize(track)
+    MD.write_metadata(track, artist='rage against the machine', album_artist='ratm', track_name='Yeah')
+    assert os.path.getsize(track) == size
+    assert str(ID3(track).get('TALB')) == 'renegades'
+
+
+def test_reserve_padding(album_copy):
+    track = os.path.join(album_copy, '01 (Intro).mp3')
+    MD.reserve_padding(track, padding=20000)
+    assert 20000 < ID3(track).size
+    size = os.path.getsize(track)
+    MD.reserve_padding(track, padding=100)
+    assert os.path.getsize(track) == size
+
+
+def test_incremental_tagging_writes_only_differing_frames(album_copy):
+    result = MD.set_album_metadata(album_copy, artist='ratm', album='renegades', year='2000')
+    mtimes = {x.file: os.path.getmtime(x.file) for x in result.succeeded}
+    result = MD.set_album_metadata(album_copy, artist='ratm', album='renegades', year='2000', incremental=True)
+    assert result.changed == [] and len(result.succeeded) == 3
+    assert mtimes == {f: os.path.getmtime(f) for f in mtimes}
+
+    result = MD.set_album_metadata(album_copy, artist='ratm', album='Renegades', year='2000', dry_run=True)
+    assert [(x.frame, x.old, x.new) for outcome in result.changed for x in outcome.changes] == 3 * [('TALB', 'renegades', 'Renegades')]
+    assert all(str(ID3(f).get('TALB')) == 'renegades' for f in mtimes)
+
+    result = MD.set_album_metadata(album_copy, artist='ratm', album='Renegades', year='2000', incremental=True)
+    assert len(result.changed) == 3 and all(str(ID3(f).get('TALB')) == 'Renegades' for f in mtimes)
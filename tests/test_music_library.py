@@ -0,0 +1,63 @@
+import os
+import shutil
+from glob import glob
+
+import pytest
+from music_album_creation.library_layout import infer_album_info, scan_albums
+from music_album_creation.music_library import (LibraryRetagger,
+                                                default_checkpoint_file)
+from mutagen.id3 import ID3
+
+this_dir = os.path.dirname(os.path.realpath(__file__))
+
+
+@pytest.fixture
+def library(tmpdir):
+    root = tmpdir.mkdir('library')
+    for album in ('Rage Against The Machine/Renegades (2000)', 'Kyuss/Blues for the Red Sun', 'Various'):
+        album_dir = os.path.join(str(root), album)
+        os.makedirs(album_dir)
+        for file_path in glob(os.path.join(this_dir, 'data', 'album_0', '*.mp3')):
+            shutil.copy(file_path, album_dir)
+    os.makedirs(os.path.join(str(root), 'Kyuss', 'artwork'))
+    return str(root)
+
+
+@pytest.mark.parametrize("album_dir, expected", [
+    ('Rage Against The Machine/Renegades (2000)', {'artist': 'Rage Against The Machine', 'album': 'Renegades', 'year': '2000'}),
+    ('Kyuss/Blues for the Red Sun', {'artist': 'Kyuss', 'album': 'Blues for the Red Sun'}),
+    ('Various', {'album': 'Various'}),
+])
+def test_album_info_inference(library, album_dir, expected):
+    assert infer_album_info(os.path.join(library, album_dir), library_root=library) == expected
+
+
+def test_album_info_inference_with_differently_spelled_root(library, tmpdir):
+    link = str(tmpdir.join('link'))
+    os.symlink(library, link)
+    assert infer_album_info(os.path.join(library, 'Various'), library_root=link + os.sep) == {'album': 'Various'}
+    assert infer_album_info(os.path.relpath(os.path.join(link, 'Various')), library_root=library) == {'album': 'Various'}
+
+
+def test_scanning(library):
+    assert [os.path.relpath(x, library) for x in scan_albums(library)] == [
+        os.path.join('Kyuss', 'Blues for the Red Sun'), os.path.join('Rage Against The Machine', 'Renegades (2000)'), 'Various']
+
+
+def test_retagging_resumes_from_checkpoint(library, tmpdir):
+    checkpoint = str(tmpdir.join('checkpoint.txt'))
+    albums = list(scan_albums(library))
+    with open(checkpoint, 'w') as f:
+        f.write(albums[0] + '\n')
+    results = LibraryRetagger(checkpoint_file=checkpoint, nb_workers=2, incremental=True).retag(albums, library_root=library, progress=False)
+    assert sorted(x.album_directory for x in results) == albums[1:]
+    assert not os.path.exists(checkpoint)
+    track = os.path.join(library, 'Rage Against The Machine', 'Renegades (2000)', '14 Yeah.mp3')
+    assert [str(ID3(track).get(x)) for x in ('TPE1', 'TALB', 'TDRC', 'TRCK', 'TIT2')] == ['Rage Against The Machine', 'Renegades', '2000', '14', 'Yeah']
+
+
+def test_checkpoint_files_are_specific_to_the_albums_and_options(library):
+    checkpoint = default_checkpoint_file([library], incremental=True)
+    assert checkpoint == default_checkpoint_file([library + os.sep], incremental=True)
+    assert checkpoint != default_checkpoint_file([library], incremental=False)
+    assert checkpoint != default_checkpoint_file([os.path.join(library, 'Various')], incremental=True)
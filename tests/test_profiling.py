@@ -0,0 +1,60 @@
+import json
+import os
+import sys
+
+import pytest
+from music_album_creation import profiling
+from music_album_creation.batch import BatchProcessor, load_manifest
+from music_album_creation.library_index import LibraryIndex
+from music_album_creation.process_watchdog import ProcessWatchdog
+from music_album_creation.profiling import Profiler
+
+from .test_batch import fake_segmentation, manifest_dir  # noqa: F401
+
+
+def test_hooks_without_profiler():
+    with profiling.stage('download', track='a.mp3'):
+        profiling.count('bytes_copied', 10)
+    assert profiling._active == []
+
+
+def test_report(tmpdir):
+    report_file = str(tmpdir.join('profile.json'))
+    with Profiler(report_file=report_file) as profiler:
+        for track in ('01.mp3', '02.mp3'):
+            with profiling.stage('cut', track=track):
+                profiling.count('bytes_written', 100)
+        with pytest.raises(KeyError):
+            with profiling.stage('tagging'):
+                raise KeyError
+        ProcessWatchdog().run([sys.executable, '-c', 'pass'])
+    with open(report_file) as f:
+        report = json.load(f)
+    assert report == json.loads(json.dumps(profiler.report()))
+    assert [(x['stage'], x.get('track'), x.get('error')) for x in report['stages']] == [('cut', '01.mp3', None), ('cut', '02.mp3', None), ('tagging', None, 'KeyError')]
+    assert report['totals']['cut']['count'] == 2 and report['totals']['tagging']['count'] == 1
+    assert report['counters'] == {'bytes_written': 200, 'subprocesses': 1, 'subprocesses.{}'.format(os.path.basename(sys.executable)): 1}
+    assert 0 < report['peak_rss']['process'] and 0 <= report['elapsed']
+    assert profiling._active == []
+
+
+def test_python_profiling(tmpdir):
+    with Profiler(report_file=str(tmpdir.join('profile.json')), python_profiling=True):
+        with profiling.stage('classification', python=True):
+            sorted(str(x) for x in range(10000))
+        with profiling.stage('download'):
+            pass
+    assert sorted(os.listdir(str(tmpdir))) == ['classification.prof', 'profile.json', 'tracemalloc.txt']
+    with open(str(tmpdir.join('profile.json'))) as f:
+        assert 0 < json.load(f)['counters']['traced_memory_peak']
+
+
+def test_batch_stages(manifest_dir, fake_segmentation, tmpdir):  # noqa: F811
+    manifest_dir.join('m.json').write(json.dumps([{'file': 'album.mp3', 'tracklist_file': 'tracks.txt', 'hhmmss_type': 'timestamps', 'album': 'Blues'}]))
+    with LibraryIndex(db_file=str(tmpdir.join('library.sqlite3'))) as index, Profiler() as profiler:
+        result, = BatchProcessor(str(tmpdir.mkdir('library')), replaygain=False, index=index).run(load_manifest(str(manifest_dir.join('m.json'))))
+    report = profiler.report()
+    assert result.succeeded
+    assert [report['totals'][x]['count'] for x in ('segmentation', 'analysis', 'copy', 'tagging', 'tag', 'indexing')] == [1, 1, 3, 1, 3, 1]
+    assert report['counters']['bytes_copied'] == sum(os.path.getsize(x) for x in result.tracks)
+    assert sorted(x['track'] for x in report['stages'] if x['stage'] == 'tag') == sorted(os.path.basename(x) for x in result.tracks)
@@ -1,12 +1,17 @@
 import os
 import sys
+import threading
 
 import mutagen
 import pytest
-from music_album_creation import AudioSegmenter
+from music_album_creation.audio_segmentation import (AudioSegmenter,
+                                                     SpeculativeSegmentation,
+                                                     TracksInformation)
 from music_album_creation.audio_segmentation.data import (
     SegmentationInformation, TrackTimestampsSequenceError,
     WrongTimestampFormat)
+from music_album_creation.process_watchdog import (CommandCancelledError,
+                                                 ProcessWatchdog)
 
 this_dir = os.path.dirname(os.path.realpath(__file__))
 
@@ -61,3 +66,42 @@ class TestSegmenting:
         file_names = sorted(os.listdir(segmenter.target_directory))
         assert file_names == names
         assert [abs(getattr(mutagen.File(os.path.join(segmenter.target_directory, x[0])).info, 'length', 0) - x[1]) < 1 for x in zip(file_names, durations)]
+
+
+class TestSpeculativeSegmentation:
+
+    def test_confirmed_speculation_surfaces_errors(self, test_audio_file_path):
+        tracks_info = TracksInformation([['t1', '0:00'], ['t2', '1:00'], ['t3', '0:35']])
+        speculation = SpeculativeSegmentation(test_audio_file_path, tracks_info, 'timestamps')
+        assert speculation.matches('Timestamps (predicted)')
+        assert not speculation.matches('Durations')
+        with pytest.raises(TrackTimestampsSequenceError):
+            speculation.result()
+        speculation.discard()
+        assert not os.path.isdir(speculation.target_directory)
+
+    def test_closing_removes_confirmed_tracks(self, monkeypatch):
+        def segment(self, album_file, track_file, *args, **kwargs):
+            with open(track_file, 'wb') as f:
+                f.write(b'audio')
+            return 0
+        monkeypatch.setattr(AudioSegmenter, '_segment', segment)
+        tracks_info = TracksInformation([['t1', '0:00'], ['t2', '1:00']])
+        with SpeculativeSegmentation('album.mp3', tracks_info, 'timestamps') as speculation:
+            assert all(os.path.isfile(x) for x in speculation.result())
+        assert not os.path.isdir(speculation.target_directory)
+
+    def test_discarding_kills_the_running_cut(self, monkeypatch):
+        started = threading.Event()
+
+        def segment(self, album_file, track_file, *args, **kwargs):
+            self._watchdog = ProcessWatchdog(poll_interval=0.05)
+            started.set()
+            return self._watchdog.run([sys.executable, '-c', 'import time; time.sleep(30)']).returncode
+        monkeypatch.setattr(AudioSegmenter, '_segment', segment)
+        speculation = SpeculativeSegmentation('album.mp3', TracksInformation([['t1', '0:00'], ['t2', '1:00']]), 'timestamps')
+        started.wait(5)
+        speculation.discard()
+        with pytest.raises(CommandCancelledError):
+            speculation.result()
+        assert not os.path.isdir(speculation.target_directory)
@@ -2,8 +2,12 @@
 
 import pytest
 from music_album_creation.audio_segmentation import Timestamp
-from music_album_creation.audio_segmentation.data import to_timestamps_info
-from music_album_creation.tracks_parsing import StringParser
+from music_album_creation.audio_segmentation.data import (
+    SegmentationInformation, TrackTable, TrackTimestampsSequenceError,
+    WrongTimestampFormat,
+    segmentation_information, to_timestamps_info)
+from music_album_creation.tracks_parsing import (StringParser, TrackParser,
+                                                 TrackParsingError)
 
 
 @pytest.fixture(scope='module')
@@ -15,6 +19,7 @@ def track_durations():
 def track_timestamps():
     return ["0:00", "0:12", "0:50", "1:10", "1:35", "1:45", "2:15"]
 
+
 @pytest.fixture(scope='module')
 def delimeters1():
     return ['. ', ' - ', '.  ', '  -  ', '.   ']
@@ -38,21 +43,25 @@ def track_names():
             'Οικογενειακή Συνωμοσία'
             ]
 
+
 @pytest.fixture(scope='module')
 def delimeters2():
     return [' ', ' - ', '  -  ', '   -   ', ' -    ']
 
+
 @pytest.fixture(scope='module')
 def timestamps_info_string(delimeters1, track_names, delimeters2, track_timestamps):
     return build_string(delimeters1, track_names, delimeters2, track_timestamps)
 
+
 @pytest.fixture(scope='module')
 def durations_info_string(delimeters1, track_names, delimeters2, track_durations):
     return build_string(delimeters1, track_names, delimeters2, track_durations) + '\n'
 
 
 def build_string(dels1, names, dels2, hhmmss_list):
-    return '\n'.join(['{}{}{}{}{}'.format(i+1, dels1[i % len(dels1)], x[0], dels2[i % len(dels2)], x[1]) for i, x in enumerate(zip(names, hhmmss_list))])
+    return '\n'.join(['{}{}{}{}{}'.format(i+1, dels1[i % len(dels1)], x[0], dels2[i % len(dels2)], x[1])
+                      for i, x in enumerate(zip(names, hhmmss_list))])
 
 
 class TestSplitters:
@@ -64,10 +73,12 @@ class TestSplitters:
         assert StringParser.parse_hhmmss_string(durations_info_string) == [[x, y] for x, y in zip(track_names, track_durations)]
 
     def test_durations_list_converion(self, track_durations, track_timestamps):
-        assert [int(Timestamp(_[1])) for _ in to_timestamps_info([['a', x] for x in track_durations])] == [int(Timestamp(_)) for _ in track_timestamps]
+        assert [int(Timestamp(_[1])) for _ in to_timestamps_info([['a', x] for x in track_durations])] == \
+            [int(Timestamp(_)) for _ in track_timestamps]
 
     def test_convert_to_timestamps(self, durations_info_string, track_timestamps, track_names):
-        assert list(map(Timestamp, StringParser.convert_to_timestamps(durations_info_string))) == list(map(Timestamp, track_timestamps[:len(track_names)]))
+        assert list(map(Timestamp, StringParser.convert_to_timestamps(durations_info_string))) == \
+            list(map(Timestamp, track_timestamps[:len(track_names)]))
 
     @pytest.mark.parametrize("video_title, artist, album, year", [
         ("Alber Jupiter - We Are Just Floating In Space (2019) (New Full Album)", "Alber Jupiter",
@@ -78,6 +89,12 @@ class TestSplitters:
     def test_youtube_video_title_parsing(self, video_title, artist, album, year):
         assert StringParser.parse_album_info(video_title) == {'artist': artist, 'album': album, 'year': year}
 
+    def test_album_info_parsing_returns_copies_of_the_cached_result(self):
+        info = StringParser.parse_album_info("My Artist - My Album (2001)")
+        info['album'] = 'Edited'
+        assert StringParser.parse_album_info("My Artist - My Album (2001)")['album'] == 'My Album'
+        assert StringParser.parse_album_info("My Album") == {'album': 'My Album'}
+
     @pytest.mark.parametrize("track_file, track_number, track_name", [
         ("Thievery Corporation/The Cosmic Game (2005)/14 - The Supreme Illusion (Feat- Gunjan).mp3", '14',
          'The Supreme Illusion (Feat- Gunjan)'),
@@ -93,7 +110,8 @@ class TestSplitters:
         ("Remember Me - Original Soundtrack (2013)/12. The Ego Room.mp3", '12', 'The Ego Room'),
         ("Queens of the Stone Age/Like a Clockwork/02 I Sat By the Ocean.mp3", '02', 'I Sat By the Ocean'),
         ("Ill Nino/[2010] Dead New World/05 - Bleed Like You.mp3", '05', 'Bleed Like You'),
-        ("Urban Dance Squad/Urban Dance Squad - Life 'n Perspectives of a Genuine Crossover/03. Life 'n Perspectives I.mp3", '03', "Life 'n Perspectives I"),
+        ("Urban Dance Squad/Urban Dance Squad - Life 'n Perspectives of a Genuine Crossover/03. Life 'n Perspectives I.mp3", '03',
+         "Life 'n Perspectives I"),
         ("Cesaria Evora/Cesaria Evora - Cafe Atlantico/06-Carnaval De Sao Vicente.mp3", '06', 'Carnaval De Sao Vicente'),
         ("Dala Sun/Sala Dun (2010)/04 - Fuck It Away.mp3", '04', 'Fuck It Away'),
         ("In This Moment/Blood (2012)/01- Rise With Me.mp3", '01', 'Rise With Me'),
@@ -102,6 +120,26 @@ class TestSplitters:
         assert StringParser.parse_track_number_n_name(track_file) == {'track_number': track_number,
                                                                       'track_name': track_name}
 
+
+class TestTrackParser:
+
+    def test_batch_tracklist_parsing_collects_failures(self, timestamps_info_string, track_names, track_timestamps):
+        result = TrackParser().parse_tracklist('{}\n\n-- no time here --\n'.format(timestamps_info_string))
+        assert result.parsed == [[x, y] for x, y in zip(track_names, track_timestamps)]
+        assert [(f.position, f.text) for f in result.failures] == [(len(track_timestamps) + 2, '-- no time here --')]
+
+    def test_batch_file_names_parsing(self):
+        result = StringParser.engine.parse_file_names(['Rotor/Rotor 2001/06 A Madrugada.mp3', 'cover.jpg'])
+        assert result.parsed == {'Rotor/Rotor 2001/06 A Madrugada.mp3': {'track_number': '06', 'track_name': 'A Madrugada'}}
+        assert [f.position for f in result.failures] == [1]
+
+    def test_immutable(self):
+        with pytest.raises(AttributeError):
+            StringParser.engine._track_file = None
+        with pytest.raises(TrackParsingError):
+            StringParser.engine.parse_track_line('-- no time here --')
+
+
 def test_timestamp():
     assert Timestamp('45:17') <= Timestamp('50:00') and Timestamp('0:0:34') < Timestamp('1:34')
     assert Timestamp('1:0:34') >= Timestamp('56:36') and Timestamp('1:1:34') > Timestamp('0:4')
@@ -110,6 +148,74 @@ def test_timestamp():
     assert Timestamp('0:0:9') == Timestamp('0:0:09') == Timestamp('00:0:09') == Timestamp('0:0:09') == Timestamp('09')
     assert hash(Timestamp('12')) == hash(Timestamp('0:12')) == hash(Timestamp('00:0:12')) == hash(Timestamp('00:12'))
     assert hash(Timestamp('9')) == hash(Timestamp('0:09')) == hash(Timestamp('09')) == hash(Timestamp('00:09')) == hash(Timestamp('00:9'))
-    assert hash(Timestamp('0:0:9')) == hash(Timestamp('0:0:09')) == hash(Timestamp('00:0:09')) == hash(Timestamp('0:0:09')) == hash(Timestamp('09'))
+    assert hash(Timestamp('0:0:9')) == hash(Timestamp('0:0:09')) == hash(Timestamp('00:0:09')) == hash(Timestamp('0:0:09')) == \
+        hash(Timestamp('09'))
 
     assert int(Timestamp('23:57') - Timestamp('16:43')) == 434
+
+
+@pytest.mark.parametrize("hhmmss, milliseconds, canonical", [
+    ('0:05.5', 5500, '0:05.500'),
+    ('26:03:00', 93780000, '26:03:00'),
+    ('1:0:34.25', 3634250, '1:00:34.250'),
+])
+def test_timestamp_precision_and_long_durations(hhmmss, milliseconds, canonical):
+    assert Timestamp(hhmmss).milliseconds == milliseconds
+    assert str(Timestamp(hhmmss)) == canonical
+    assert Timestamp(canonical) is Timestamp(hhmmss)
+
+
+def test_timestamp_arithmetic():
+    assert Timestamp('23:59:59.5') + Timestamp('0:00.75') == Timestamp('24:00:00.25')
+    assert Timestamp('1:12.5').seconds == '72.5' and Timestamp('1:12').seconds == '72'
+    assert Timestamp.from_duration(90061.5) == Timestamp('25:01:01.5')
+    with pytest.raises(WrongTimestampFormat):
+        Timestamp('0:10') - Timestamp('0:11')
+
+
+@pytest.mark.parametrize("hhmmss", ['1:a0', '1:72', '', '1::00', '0:00.', '0:00.1234', '1:2:3:4', ' 0:10'])
+def test_wrong_timestamp_format(hhmmss):
+    with pytest.raises(WrongTimestampFormat):
+        Timestamp(hhmmss)
+
+
+def test_timestamp_cache_is_bounded():
+    for milliseconds in range(Timestamp.cache_size + 100):
+        Timestamp.from_milliseconds(milliseconds)
+    assert len(Timestamp._cache) == Timestamp.cache_size
+
+
+class TestTrackTable:
+
+    def test_long_mix_from_durations(self):
+        table = TrackTable.from_durations(['t{}'.format(i) for i in range(600)], ['3:00'] * 600)
+        assert table.timestamps()[-1] == '29:57:00'
+        assert table.spans()[-2:] == [('599 - t598', '107640', '107820'), ('600 - t599', '107820')]
+        assert StringParser.convert_to_timestamps('\n'.join('{}. t{} - 3:00'.format(i + 1, i) for i in range(600)))[-1] == '29:57:00'
+
+    def test_sub_second_spans(self):
+        assert segmentation_information([['a', '0:00'], ['b', '1:12.5']]) == [['01 - a', '0', '72.5'], ['02 - b', '72.5']]
+
+    def test_non_increasing_timestamps(self):
+        with pytest.raises(TrackTimestampsSequenceError,
+                           match="Track '3 - c' starting timestamp '0:35' should be 'bigger' than track's '2 - b'; '1:00'"):
+            TrackTable.from_timestamps(['a', 'b', 'c'], ['0:00', '1:00', '0:35'])
+
+    def test_segmentation_information_from_spans(self):
+        spans = [['01 - a', '0', '72.5'], ['02 - b', '72.5']]
+        expected = SegmentationInformation.from_tracks_information([['a', '0:00'], ['b', '1:12.5']], 'timestamps')
+        assert SegmentationInformation(spans) == SegmentationInformation(tracks_info=spans) == expected
+        assert SegmentationInformation(tracks_info=spans).tracks_info == spans
+        assert SegmentationInformation([['intro', 0, 10], ['outro', 10]]).tracks_info == [['intro', '0', '10'], ['outro', '10']]
+        with pytest.raises(TypeError):
+            SegmentationInformation()
+
+    def test_hhmmss_format_does_not_wrap_around_days(self):
+        assert StringParser.hhmmss_format(90000) == '25:00:00'
+
+    def test_value_equality(self):
+        assert TrackTable.from_durations(['a', 'b'], ['1:00', '2:00']) == TrackTable.from_timestamps(['a', 'b'], ['0:00', '1:00'])
+        assert TrackTable.from_durations(['a', 'b'], ['1:00', '2:00']) != TrackTable.from_timestamps(['a', 'b'], ['0:00', '1:01'])
+        assert TrackTable(['a', 'b'], [0, 1000]) != TrackTable(['a', 'c'], [0, 1000])
+        assert SegmentationInformation.from_multiline('1. a 0:00\n2. b 1:00', 'timestamps') == \
+            SegmentationInformation.from_multiline('1. a 1:00\n2. b 0:30', 'durations')
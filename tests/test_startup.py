@@ -0,0 +1,57 @@
+"""Guards the start up time of the package's commands: importing them should not import heavy dependencies or have side effects"""
+import json
+import subprocess
+import sys
+import time
+
+import pytest
+
+HEAVY_MODULES = ['sklearn', 'PyInquirer', 'lxml', 'mutagen', 'tqdm', 'numpy']
+
+# seconds 'create-album --help' may take on top of starting python and importing click
+HELP_OVERHEAD_BUDGET = 0.5
+
+
+def imported_modules(module, cwd, statement=''):
+    code = "import json, sys; import {}; {}; print(json.dumps(sorted(m for m in {} if m in sys.modules)))".format(
+        module, statement or 'pass', HEAVY_MODULES)
+    return json.loads(subprocess.check_output([sys.executable, '-c', code], cwd=cwd).decode().splitlines()[-1])
+
+
+@pytest.mark.parametrize("module, allowed", [
+    ('music_album_creation', []),
+    ('music_album_creation.create_album', []),
+    ('music_album_creation.library_layout', []),
+    ('music_album_creation.metadata', ['mutagen']),
+])
+def test_import_is_lazy(module, allowed, tmpdir):
+    assert imported_modules(module, str(tmpdir)) == allowed
+    assert tmpdir.listdir() == []  # ie no 'file.log' gets created
+
+
+def test_package_exports_its_classes_lazily(tmpdir):
+    statement = "assert music_album_creation.MetadataDealer is music_album_creation.metadata.MetadataDealer"
+    assert imported_modules('music_album_creation', str(tmpdir), statement=statement) == ['mutagen']
+
+
+def test_create_album_help_imports_no_heavy_dependencies(tmpdir):
+    statement = "from music_album_creation.create_album import main; main(['--help'], standalone_mode=False)"
+    assert imported_modules('music_album_creation.create_album', str(tmpdir), statement=statement) == []
+
+
+def fastest_run(code, cwd, repeat=5):
+    """The least wall-clock time, out of a few runs, of a python process running the code; the least is the least noisy"""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.check_output([sys.executable, '-c', code], cwd=cwd)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def test_create_album_help_startup_time(tmpdir, record_property):
+    floor = fastest_run('import click', str(tmpdir))
+    elapsed = fastest_run("from music_album_creation.create_album import main; main(['--help'], standalone_mode=False)", str(tmpdir))
+    record_property('create_album_help_seconds', round(elapsed, 3))
+    record_property('create_album_help_overhead_seconds', round(elapsed - floor, 3))
+    assert elapsed - floor < HELP_OVERHEAD_BUDGET
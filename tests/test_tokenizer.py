@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+"""Fuzzes the linear time track line tokenizer against the track line regex and checks it stays linear on adversarial lines"""
+import random
+import re
+
+import pytest
+from music_album_creation import tracks_tokenizer
+from music_album_creation.tracks_parsing import StringParser
+from music_album_creation.tracks_tokenizer import tokenize_track_line
+
+
+@pytest.fixture(scope='module')
+def track_line_regex():
+    return re.compile(r"(?: {track_number} {sep1})? ( {track_name} ) {sep2} ({hhmmss})".format(**StringParser.regexes), re.X)
+
+
+@pytest.fixture(scope='module')
+def fuzz_alphabet():
+    return list(u"ab1209 :.-,)(\t'’!Ζό\xa0") + [u'  ', u' - ', u'12:', u'0:0', u'--', u').', u'(a']
+
+
+def search(regex, line):
+    match = regex.search(line.strip())
+    return tuple(match.groups()) if match else None
+
+
+def test_fuzzing_against_regex(track_line_regex, fuzz_alphabet):
+    rand = random.Random(1)
+    for _ in range(20000):
+        line = u''.join(rand.choice(fuzz_alphabet) for _ in range(rand.randint(0, 16)))
+        assert tokenize_track_line(line) == search(track_line_regex, line), line
+
+
+@pytest.fixture
+def steps(monkeypatch):
+    """Counts the regex calls and the _TrackLine method calls the tokenizer makes; a measure of its work, unlike timings"""
+    counter = [0]
+
+    class CountingRegex(object):
+        def __init__(self, regex):
+            self._regex = regex
+
+        def __getattr__(self, name):
+            def call(*args, **kwargs):
+                counter[0] += 1
+                return getattr(self._regex, name)(*args, **kwargs)
+            return call
+
+    def counting(method):
+        def call(*args, **kwargs):
+            counter[0] += 1
+            return method(*args, **kwargs)
+        return call
+    for name in ('_digit', '_word_start', '_words', '_spaces', '_sep1_marks', '_sep2_marks', '_track_seps'):
+        monkeypatch.setattr(tracks_tokenizer, name, CountingRegex(getattr(tracks_tokenizer, name)))
+    for name in ('time_start', 'track_number_end', 'name_reach', '_next_word', 'tail_reach', 'inner_reach', 'hhmmss'):
+        monkeypatch.setattr(tracks_tokenizer._TrackLine, name, counting(getattr(tracks_tokenizer._TrackLine, name)))
+    return counter
+
+
+@pytest.mark.parametrize("word", [u'ab, ', u'a-', u'Ab-c ', u'1', u'1 ', u'(a) '])
+def test_adversarial_lines_in_linear_time(word, steps):
+    """Lines of words and punctuation lacking a timestamp; the regex search is (at least) quadratic on these"""
+    def nb_steps(nb_words):
+        steps[0] = 0
+        assert tokenize_track_line(u'1. ' + word * nb_words) is None or word.startswith(u'1')
+        return steps[0]
+    small, large = nb_steps(1000), nb_steps(8000)
+    assert large <= 8 * small + 100  # linear; a quadratic tokenizer would take about 64 times the steps
@@ -0,0 +1,41 @@
+import os
+import sys
+import time
+
+import pytest
+from music_album_creation.process_watchdog import (CommandStalledError,
+                                                   CommandTimeoutError,
+                                                   ProcessWatchdog)
+
+
+def python_command(code):
+    return [sys.executable, '-c', code]
+
+
+class TestProcessWatchdog:
+
+    def test_completed_command(self):
+        ro = ProcessWatchdog(timeout=10, stall_timeout=10).run(python_command("print('gav')"), capture_stdout=True)
+        assert ro.returncode == 0
+        assert ro.stdout.strip() == b'gav'
+        assert ro.statistics.nb_stalls == 0
+
+    def test_stalled_command(self):
+        with pytest.raises(CommandStalledError) as e:
+            ProcessWatchdog(stall_timeout=0.5, stall_threshold=0.2).run(python_command("import time; time.sleep(10)"), capture_stdout=True)
+        assert 0.5 <= e.value.statistics.longest_stall < 5
+
+    def test_progressing_command_timeout(self):
+        code = "import sys, time\nwhile 1:\n    sys.stdout.write('.'); sys.stdout.flush(); time.sleep(0.05)"
+        with pytest.raises(CommandTimeoutError) as e:
+            ProcessWatchdog(timeout=0.6, stall_timeout=0.5).run(python_command(code), capture_stdout=True)
+        assert 0 < e.value.statistics.bytes_read
+        assert e.value.statistics.elapsed < 5
+
+    @pytest.mark.skipif(os.name != 'posix', reason="the process group gets killed on posix only")
+    def test_output_held_open_by_a_lingering_child(self):
+        code = "import subprocess, sys; subprocess.Popen([sys.executable, '-c', 'import time; time.sleep(30)']); print('gav')"
+        start = time.time()
+        ro = ProcessWatchdog(drain_timeout=0.5).run(python_command(code), capture_stdout=True)
+        assert ro.returncode == 0 and ro.stdout.strip() == b'gav'
+        assert time.time() - start < 5